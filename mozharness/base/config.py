@@ -24,11 +24,15 @@ TODO:
   these settings are set.
 """
 
+import ast
 from copy import deepcopy
+import hashlib
+import marshal
 from optparse import OptionParser, Option, OptionGroup
 import os
+import platform
 import sys
-import urllib2
+import tempfile
 import socket
 import time
 try:
@@ -135,10 +139,190 @@ class ReadOnlyDict(dict):
             result[k] = deepcopy(v, memo)
         return result
 
+# Config cache {{{1
+# Evaluated config files are cached here as marshalled dicts.  Set
+# $MOZHARNESS_CONFIG_CACHE to use another directory, or to '' to turn the
+# cache off.  It's always safe to delete.
+CONFIG_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.mozharness',
+                                'config-cache')
+CONFIG_CACHE_VERSION = 1
+
+# What python configs may look at and still be cached.  Each of these is
+# included in the cache key, along with any environment variables the
+# config reads.
+CONFIG_CACHE_INPUTS = {
+    'os.getcwd': os.getcwd,
+    'os.path.abspath': os.getcwd,
+    'os.path.realpath': os.getcwd,
+    'os.path.expanduser': lambda: os.path.expanduser('~'),
+    'os.name': lambda: os.name,
+    'os.uname': lambda: hasattr(os, 'uname') and os.uname(),
+    'sys.executable': lambda: sys.executable,
+    'sys.platform': lambda: sys.platform,
+    'socket.gethostname': socket.gethostname,
+    'platform.system': platform.system,
+    'platform.machine': platform.machine,
+    'platform.architecture': platform.architecture,
+}
+CONFIG_CACHE_PURE_NAMES = (
+    'copy.copy', 'copy.deepcopy', 'os.path.join', 'os.path.dirname',
+    'os.path.basename', 'os.path.split', 'os.path.splitext',
+    'os.path.normpath', 'os.sep', 'os.pathsep', 'os.linesep',
+    'os.path.sep', 'os.path.pathsep',
+)
+CONFIG_CACHE_UNSAFE_BUILTINS = (
+    '__import__', 'eval', 'execfile', 'file', 'globals', 'input', 'locals',
+    'open', 'raw_input', 'reload', 'vars',
+)
+
+
+def _query_config_inputs(source):
+    """Work out what a python config's result depends on, besides its
+    source.  Returns a (sorted list of CONFIG_CACHE_INPUTS names, sorted
+    list of environment variable names) tuple, or None if it does anything
+    else that we can't account for, in which case it isn't cached.
+    """
+    tree = ast.parse(source)
+    modules = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Exec):
+            return None
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                modules[alias.asname or alias.name.split('.')[0]] = \
+                    alias.name if alias.asname else alias.name.split('.')[0]
+        elif isinstance(node, ast.ImportFrom):
+            for alias in node.names:
+                modules[alias.asname or alias.name] = '%s.%s' % (node.module, alias.name)
+        elif isinstance(node, ast.Name) and node.id in CONFIG_CACHE_UNSAFE_BUILTINS:
+            return None
+
+    parents = {}
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+
+    inputs = set()
+    env_names = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Name) or node.id not in modules:
+            continue
+        # Find the longest dotted name rooted at this module.
+        dotted = modules[node.id]
+        top = node
+        while isinstance(parents.get(top), ast.Attribute):
+            top = parents[top]
+            dotted += '.' + top.attr
+            if dotted in CONFIG_CACHE_INPUTS or dotted in CONFIG_CACHE_PURE_NAMES:
+                break
+        if dotted in CONFIG_CACHE_PURE_NAMES:
+            continue
+        if dotted in CONFIG_CACHE_INPUTS:
+            inputs.add(dotted)
+            continue
+        # os.environ['X'], os.environ.get('X'[, default]) or os.getenv('X')
+        key = None
+        parent = parents.get(top)
+        if dotted == 'os.getenv' and isinstance(parent, ast.Call) and parent.func is top:
+            key = parent.args and parent.args[0]
+        elif dotted == 'os.environ' and isinstance(parent, ast.Subscript):
+            key = isinstance(parent.slice, ast.Index) and parent.slice.value
+        elif dotted == 'os.environ.get' and isinstance(parent, ast.Call) and parent.func is top:
+            key = parent.args and parent.args[0]
+        if isinstance(key, ast.Str):
+            env_names.add(key.s)
+            continue
+        return None
+    return sorted(inputs), sorted(env_names)
+
+
+def _query_config_fingerprint(inputs):
+    names, env_names = inputs
+    return (
+        [(name, CONFIG_CACHE_INPUTS[name]()) for name in names],
+        [(name, os.environ.get(name)) for name in env_names],
+    )
+
+
+def _query_config_cache_path(file_path, config_dict_name):
+    cache_dir = os.environ.get('MOZHARNESS_CONFIG_CACHE', CONFIG_CACHE_DIR)
+    if not cache_dir:
+        return None
+    name = hashlib.sha1('%s\0%s' % (os.path.abspath(file_path),
+                                    config_dict_name)).hexdigest()
+    return os.path.join(cache_dir, name)
+
+
+def _read_config_cache(cache_path, key):
+    """Return the cached config for key, or None."""
+    try:
+        with open(cache_path, 'rb') as fh:
+            entry = marshal.load(fh)
+        if entry['key'] != key:
+            return None
+        if entry['inputs'] is not None and \
+                entry['fingerprint'] != _query_config_fingerprint(entry['inputs']):
+            return None
+        return entry['config']
+    except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+        return None
+
+
+def _write_config_cache(cache_path, key, config, inputs):
+    entry = {
+        'key': key,
+        'config': config,
+        'inputs': inputs,
+        'fingerprint': inputs and _query_config_fingerprint(inputs),
+    }
+    try:
+        data = marshal.dumps(entry)
+    except ValueError:
+        # e.g. the config contains a function
+        return
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        # The cache is only an optimization.
+        pass
+
+
+def clear_config_cache():
+    """Remove all the cached config files."""
+    cache_dir = os.environ.get('MOZHARNESS_CONFIG_CACHE', CONFIG_CACHE_DIR)
+    if cache_dir and os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+
+
 # parse_config_file {{{1
+class MissingConfigDictError(KeyError):
+    """A python config file doesn't create its config dictionary.  This
+    is a KeyError, as it always has been, so that it can be told apart from
+    KeyErrors raised by the config's own code."""
+    pass
+
+
 def parse_config_file(file_name, quiet=False, search_path=None,
-                      config_dict_name="config"):
+                      config_dict_name="config", cache=True):
     """Read a config file and return a dictionary.
+
+    Unless cache is False, the result is cached (see CONFIG_CACHE_DIR),
+    keyed on the file's path, mtime, size and contents, and for python
+    configs, on whatever else they read, e.g. os.getcwd() or environment
+    variables.
+
+    Raises MissingConfigDictError if a python config doesn't create
+    config_dict_name.
     """
     file_path = None
     if os.path.exists(file_name):
@@ -153,24 +337,45 @@ def parse_config_file(file_name, quiet=False, search_path=None,
                 break
         else:
             raise IOError("Can't find %s in %s!" % (file_name, search_path))
+    if not file_name.endswith('.py') and not file_name.endswith('.json'):
+        raise RuntimeError("Unknown config file type %s!" % file_name)
+    cache_path = cache and _query_config_cache_path(file_path, config_dict_name)
+    if cache_path:
+        with open(file_path, 'rb') as fh:
+            source = fh.read()
+        st = os.stat(file_path)
+        key = (CONFIG_CACHE_VERSION, sys.version, os.path.abspath(file_path),
+               config_dict_name, st.st_mtime, st.st_size,
+               hashlib.sha1(source).hexdigest())
+        config = _read_config_cache(cache_path, key)
+        if config is not None:
+            return config
+    inputs = None
     if file_name.endswith('.py'):
         global_dict = {}
         local_dict = {}
         execfile(file_path, global_dict, local_dict)
+        if config_dict_name not in local_dict:
+            raise MissingConfigDictError(config_dict_name)
         config = local_dict[config_dict_name]
-    elif file_name.endswith('.json'):
+        if cache_path:
+            inputs = _query_config_inputs(source)
+            if inputs is None:
+                return config
+    else:
         fh = open(file_path)
         config = {}
         json_config = json.load(fh)
         config = dict(json_config)
         fh.close()
-    else:
-        raise RuntimeError("Unknown config file type %s!" % file_name)
+    if cache_path:
+        _write_config_cache(cache_path, key, config, inputs)
     # TODO return file_path
     return config
 
 
 def download_config_file(url, file_name):
+    import urllib2
     n = 0
     attempts = 5
     sleeptime = 60
@@ -316,6 +521,11 @@ class BaseConfig(object):
             dest="append_to_log", default=False,
             help="Append to the log"
         )
+        log_option_group.add_option(
+            "--async-log", action="store_true",
+            dest="log_async", default=False,
+            help="Write the logs from a background thread"
+        )
         log_option_group.add_option(
             "--multi-log", action="store_const", const="multi",
             dest="log_type", help="Log using MultiFileLogger"
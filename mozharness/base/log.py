@@ -14,9 +14,18 @@ TODO:
 from datetime import datetime
 import logging
 import os
+import Queue
 import sys
+import tempfile
+import threading
 import traceback
 
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
 # Define our own FATAL_LEVEL
 FATAL_LEVEL = logging.CRITICAL + 10
 logging.addLevelName(FATAL_LEVEL, 'FATAL')
@@ -211,6 +220,147 @@ pre-context-line setting in error_list.)
             self.parse_single_line(line)
 
 
+# AsyncLogWriter {{{1
+class AsyncLogWriter(logging.Handler):
+    """A single logging handler that stands in for all of a BaseLogger's
+    console and file handlers when log_async is set.
+
+    emit() only queues the record.  A writer thread formats each record
+    once per distinct formatter, and writes it to every destination whose
+    level it meets, in batches of up to batch_size records.  Streams are
+    flushed whenever the queue runs dry, and by flush(), which blocks until
+    everything queued before it has been written.
+    """
+    def __init__(self, batch_size=1000):
+        logging.Handler.__init__(self)
+        self.batch_size = batch_size
+        # [stream, minimum level number, formatter, close stream on close()]
+        self.destinations = []
+        self.queue = Queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._write_loop,
+                                       name='AsyncLogWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_destination(self, stream, level, formatter, close_stream=False):
+        self.destinations.append((stream, level, formatter, close_stream))
+
+    def emit(self, record):
+        self.queue.put(record)
+
+    def _write_batch(self, records):
+        buffers = [[] for _ in self.destinations]
+        for record in records:
+            formatted = {}
+            for i, (stream, level, formatter, _) in enumerate(self.destinations):
+                if record.levelno < level:
+                    continue
+                if formatter not in formatted:
+                    try:
+                        line = formatter.format(record)
+                        if isinstance(line, unicode):
+                            line = line.encode(getattr(stream, 'encoding', None) or 'utf-8',
+                                               'replace')
+                        formatted[formatter] = line + '\n'
+                    except Exception:
+                        self.handleError(record)
+                        formatted[formatter] = ''
+                buffers[i].append(formatted[formatter])
+        for (stream, _, _, _), lines in zip(self.destinations, buffers):
+            if lines:
+                stream.write(''.join(lines))
+
+    def _flush_streams(self):
+        for stream, _, _, _ in self.destinations:
+            stream.flush()
+
+    def _write_loop(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            records = []
+            for item in items:
+                if isinstance(item, logging.LogRecord):
+                    records.append(item)
+                    continue
+                # A flush() event, or None from close()
+                self._write_batch(records)
+                records = []
+                self._flush_streams()
+                if item is None:
+                    return
+                item.set()
+            self._write_batch(records)
+            if self.queue.empty():
+                self._flush_streams()
+
+    def flush(self):
+        if self.closed or not self.thread.is_alive():
+            return
+        if threading.current_thread() is self.thread:
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        # Event.wait() without a timeout can't be interrupted in python 2.
+        while not done.wait(1) and self.thread.is_alive():
+            pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.thread.is_alive():
+                self.queue.put(None)
+                self.thread.join()
+            for stream, _, _, close_stream in self.destinations:
+                if close_stream:
+                    stream.close()
+        logging.Handler.close(self)
+
+
+# BufferedLog {{{1
+class BufferedLog(object):
+    """Stands in for a log_obj, holding on to messages until flush() logs
+    them to the real log_obj, so that e.g. the output of commands running
+    at the same time can be logged as separate, contiguous sections.
+
+    Messages are spooled to a temporary file rather than kept in memory.
+    FATAL messages flush the buffer and go straight through.
+    """
+    def __init__(self, log_obj):
+        self.log_obj = log_obj
+        self.buffer = tempfile.TemporaryFile()
+        self.lock = threading.Lock()
+
+    def log_message(self, message, level=INFO, exit_code=-1,
+                    post_fatal_callback=None):
+        if level == FATAL:
+            self.flush()
+            return self.log_obj.log_message(message, level=level,
+                                            exit_code=exit_code,
+                                            post_fatal_callback=post_fatal_callback)
+        if isinstance(message, str):
+            message = message.decode('utf-8', 'replace')
+        with self.lock:
+            self.buffer.write(json.dumps([level, message]) + '\n')
+
+    def flush(self):
+        with self.lock:
+            self.buffer.seek(0)
+            for line in self.buffer:
+                level, message = json.loads(line)
+                self.log_obj.log_message(message, level=str(level))
+            self.buffer.seek(0)
+            self.buffer.truncate()
+
+    def close(self):
+        self.buffer.close()
+
+
 # BaseLogger {{{1
 class BaseLogger(object):
     """Create a base logging class.
@@ -231,6 +381,7 @@ class BaseLogger(object):
         log_to_raw=False,
         logger_name='',
         append_to_log=False,
+        log_async=False,
     ):
         self.log_format = log_format
         self.log_date_format = log_date_format
@@ -240,6 +391,8 @@ class BaseLogger(object):
         self.log_name = log_name
         self.log_dir = log_dir
         self.append_to_log = append_to_log
+        self.log_async = log_async
+        self.async_writer = None
 
         # Not sure what I'm going to use this for; useless unless we
         # can have multiple logging objects that don't trample each other
@@ -284,6 +437,10 @@ class BaseLogger(object):
         self.logger = ROOT_LOGGER
         self.logger.setLevel(self.get_logger_level())
         self._clear_handlers()
+        if self.log_async:
+            self.async_writer = AsyncLogWriter()
+            self.logger.addHandler(self.async_writer)
+            self.all_handlers.append(self.async_writer)
         if self.log_to_console:
             self.add_console_handler()
         if self.log_to_raw:
@@ -301,6 +458,16 @@ class BaseLogger(object):
             for handler in self.all_handlers:
                 self.logger.removeHandler(handler)
             self.all_handlers = []
+        if getattr(self, 'async_writer', None):
+            self.async_writer.close()
+            self.async_writer = None
+
+    def flush(self):
+        """Make sure everything logged so far has been written out, e.g.
+        before reading or copying the log files.
+        """
+        for handler in self.all_handlers:
+            handler.flush()
 
     def __del__(self):
         logging.shutdown()
@@ -308,9 +475,13 @@ class BaseLogger(object):
 
     def add_console_handler(self, log_level=None, log_format=None,
                             date_format=None):
+        formatter = self.get_log_formatter(log_format=log_format,
+                                           date_format=date_format)
+        if self.async_writer:
+            self.async_writer.add_destination(sys.stderr, logging.NOTSET, formatter)
+            return
         console_handler = logging.StreamHandler()
-        console_handler.setFormatter(self.get_log_formatter(log_format=log_format,
-                                                            date_format=date_format))
+        console_handler.setFormatter(formatter)
         self.logger.addHandler(console_handler)
         self.all_handlers.append(console_handler)
 
@@ -318,10 +489,16 @@ class BaseLogger(object):
                          date_format=None):
         if not self.append_to_log and os.path.exists(log_path):
             os.remove(log_path)
+        formatter = self.get_log_formatter(log_format=log_format,
+                                           date_format=date_format)
+        if self.async_writer:
+            self.async_writer.add_destination(open(log_path, 'a', 1024 ** 2),
+                                              self.get_logger_level(log_level),
+                                              formatter, close_stream=True)
+            return
         file_handler = logging.FileHandler(log_path)
         file_handler.setLevel(self.get_logger_level(log_level))
-        file_handler.setFormatter(self.get_log_formatter(log_format=log_format,
-                                                         date_format=date_format))
+        file_handler.setFormatter(formatter)
         self.logger.addHandler(file_handler)
         self.all_handlers.append(file_handler)
 
@@ -342,6 +519,7 @@ class BaseLogger(object):
                 self.logger.log(FATAL_LEVEL, "Running post_fatal callback...")
                 post_fatal_callback(message=message, exit_code=exit_code)
             self.logger.log(FATAL_LEVEL, 'Exiting %d' % exit_code)
+            self.flush()
             raise SystemExit(exit_code)
 
 
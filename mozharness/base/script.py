@@ -10,25 +10,30 @@ script.py, along with config.py and log.py, represents the core of
 mozharness.
 """
 
+import bz2
 import codecs
+import copy
 from contextlib import contextmanager
 import errno
-import gzip
-import inspect
+import itertools
 import os
 import platform
 import pprint
+import random
 import re
 import shutil
 import socket
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
-import urllib2
-import httplib
-import urlparse
+import types
 import hashlib
+import zlib
 if os.name == 'nt':
     try:
         import win32file
@@ -43,11 +48,419 @@ try:
 except ImportError:
     import json
 
-from mozprocess import ProcessHandler
 from mozharness.base.config import BaseConfig
 from mozharness.base.log import SimpleFileLogger, MultiFileLogger, \
     LogMixin, OutputParser, DEBUG, INFO, ERROR, FATAL
 
+# Same suffix as external_tools/purge_builds.py, so it can clean up any
+# directories we moved out of the way but didn't finish deleting.
+CLOBBER_SUFFIX = '.deleteme'
+
+
+def _rmtree_parallel(path, errors, num_threads=4):
+    """Delete the directory tree at `path', removing its top-level entries
+    on `num_threads' threads.
+
+    This runs on a background thread for ScriptMixin.rmtree(background=True),
+    so rather than logging or raising, (path, exception) tuples are appended
+    to `errors'.
+    """
+    def _remove(p):
+        try:
+            if os.path.isdir(p) and not os.path.islink(p):
+                shutil.rmtree(p)
+            else:
+                os.remove(p)
+        except OSError, e:
+            errors.append((p, e))
+
+    # Split the work up by the entries one level below the top, since the
+    # top level of an objdir or work_dir only has a handful of entries.
+    entries = []
+    try:
+        for name in os.listdir(path):
+            p = os.path.join(path, name)
+            if os.path.isdir(p) and not os.path.islink(p):
+                entries.extend([os.path.join(p, n) for n in os.listdir(p)])
+            else:
+                entries.append(p)
+    except OSError, e:
+        errors.append((path, e))
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(num_threads)
+    try:
+        pool.map(_remove, entries)
+    finally:
+        pool.close()
+        pool.join()
+    _remove(path)
+
+
+# ioctl request number for a copy-on-write clone (linux/fs.h FICLONE).
+FICLONE = 0x40049409
+
+
+def _reflink(src, dest):
+    """Make dest a copy-on-write clone of src, if the platform and
+    filesystem support it.  Returns True on success.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src, 'rb') as src_fh:
+        with open(dest, 'wb') as dest_fh:
+            try:
+                fcntl.ioctl(dest_fh.fileno(), FICLONE, src_fh.fileno())
+            except IOError:
+                return False
+    shutil.copystat(src, dest)
+    return True
+
+
+def _copy_file(src, dest, copy_mode='copy'):
+    """Copy src to dest for ScriptMixin.copytree(), as a hard link, reflink
+    or full copy (see copy_mode there), replacing dest if it exists.
+    """
+    # Never write through an existing (possibly hard linked) dest.
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if copy_mode == 'hardlink' and hasattr(os, 'link'):
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            # e.g. EXDEV; fall back to copying.
+            pass
+    elif copy_mode == 'reflink' and _reflink(src, dest):
+        return
+    shutil.copy2(src, dest)
+
+
+# gzip files are compressed in parallel blocks, the way pigz does it: each
+# block is raw-deflated separately and ends in a sync flush, so the blocks
+# can be concatenated into a single gzip member.  bzip2 blocks could only be
+# compressed in parallel as separate streams, which python 2's bz2.BZ2File
+# doesn't read, so each bzip2 file is compressed in one stream.
+COMPRESSION_BLOCK_SIZE = 1024 * 1024
+COMPRESSION_SUFFIXES = {
+    'gzip': '.gz',
+    'bzip2': '.bz2',
+}
+# The same defaults as python's gzip and bz2 modules; pass a lower level (or
+# set config['compression_level']) to favour speed over size.
+COMPRESSION_LEVELS = {
+    'gzip': 9,
+    'bzip2': 9,
+}
+# For intermediate artifacts, where speed matters more than size.
+FAST_COMPRESSION_LEVEL = 1
+
+
+def _gzip_file(in_fh, out_fh, level, pool, block_slots, block_size):
+    """Write in_fh to out_fh as a single gzip member, deflating block_size
+    blocks on pool.
+
+    block_slots is a semaphore shared by all the files being compressed
+    at once, which bounds how many blocks are read ahead in total.
+    Returns the number of bytes read.
+    """
+    xfl = {9: 2, 1: 4}.get(level, 0)
+    mtime = int(os.fstat(in_fh.fileno()).st_mtime)
+    out_fh.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, mtime, xfl, 255))
+    crc = 0
+    size = 0
+    pending = []
+    try:
+        while True:
+            if not block_slots.acquire(False):
+                if pending:
+                    # Don't wait for a slot while holding some.
+                    out_fh.write(pending.pop(0).get())
+                    block_slots.release()
+                    continue
+                block_slots.acquire()
+            data = in_fh.read(block_size)
+            if not data:
+                block_slots.release()
+                break
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            pending.append(pool.apply_async(_deflate_block, ((level, data, False), )))
+        while pending:
+            out_fh.write(pending.pop(0).get())
+            block_slots.release()
+    finally:
+        for _ in pending:
+            block_slots.release()
+    # Every block ended in a sync flush, so finish with an empty last block.
+    out_fh.write(_deflate_block((level, '', True)))
+    out_fh.write(struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+    return size
+
+
+def _compress_file(src, dest, compression, level, pool, block_slots,
+                   block_size=COMPRESSION_BLOCK_SIZE):
+    """Compress src to dest; see _gzip_file() for pool and block_slots,
+    which bzip2 doesn't use.  Returns the number of bytes read.
+    """
+    with open(src, 'rb') as in_fh:
+        with open(dest, 'wb') as out_fh:
+            if compression == 'gzip':
+                return _gzip_file(in_fh, out_fh, level, pool, block_slots,
+                                  block_size)
+            # bz2 releases the GIL, so files are still compressed in parallel
+            # with each other.
+            size = 0
+            compressor = bz2.BZ2Compressor(level)
+            while True:
+                data = in_fh.read(block_size)
+                if not data:
+                    break
+                size += len(data)
+                out_fh.write(compressor.compress(data))
+            out_fh.write(compressor.flush())
+    return size
+
+
+def _deflate_block(args):
+    """Raw-deflate one block of a zip member.  Every block but the last
+    ends with a sync flush, so the blocks can just be concatenated.
+    """
+    level, data, last = args
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def _zip_member_info(src, arcname):
+    import zipfile
+    st = os.stat(src)
+    date_time = time.localtime(st.st_mtime)[:6]
+    if date_time[0] < 1980:
+        date_time = (1980, 1, 1, 0, 0, 0)
+    # zip only stores even seconds
+    date_time = date_time[:5] + (date_time[5] // 2 * 2, )
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.file_size = st.st_size
+    return zinfo
+
+
+def _strip_zip64_extra(extra):
+    """Drop the zip64 field from a zip extra field; ZipInfo.FileHeader()
+    adds its own when it's needed.
+    """
+    fields = []
+    while len(extra) >= 4:
+        header_id, size = struct.unpack('<HH', extra[:4])
+        if header_id != 1:
+            fields.append(extra[:4 + size])
+        extra = extra[4 + size:]
+    return ''.join(fields)
+
+
+def _write_zip_members(zf, members, level, pool, num_threads, block_size):
+    """Stream (src, zinfo) members into the ZipFile zf, deflating
+    block_size blocks on pool, across member boundaries, so small members
+    are compressed in parallel with each other as well.
+    """
+    import zipfile
+
+    def _blocks():
+        for src, zinfo in members:
+            with open(src, 'rb') as fh:
+                data = fh.read(block_size)
+                first = True
+                while True:
+                    next_data = fh.read(block_size)
+                    yield zinfo, data, first, not next_data
+                    if not next_data:
+                        break
+                    data, first = next_data, False
+
+    blocks = _blocks()
+    zip64 = {}
+    while True:
+        window = list(itertools.islice(blocks, 2 * num_threads))
+        if not window:
+            break
+        result = pool.map_async(_deflate_block,
+                                [(level, data, last) for _, data, _, last in window])
+        for (zinfo, data, first, last), deflated in zip(window, result.get()):
+            if first:
+                # Same zip64 heuristic as ZipFile.write()
+                zip64[zinfo.filename] = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+                zinfo.header_offset = zf.fp.tell()
+                zinfo.CRC = zinfo.compress_size = zinfo.file_size = 0
+                zf.fp.write(zinfo.FileHeader(zip64[zinfo.filename]))
+            zinfo.CRC = zlib.crc32(data, zinfo.CRC) & 0xffffffff
+            zinfo.file_size += len(data)
+            zinfo.compress_size += len(deflated)
+            zf.fp.write(deflated)
+            if last:
+                # Go back and fill in the crc and sizes.
+                position = zf.fp.tell()
+                zf.fp.seek(zinfo.header_offset)
+                zf.fp.write(zinfo.FileHeader(zip64[zinfo.filename]))
+                zf.fp.seek(position)
+                zf.filelist.append(zinfo)
+                zf.NameToInfo[zinfo.filename] = zinfo
+
+
+def _copy_zip_member(zf, old_zf, old_zinfo):
+    """Copy a member of old_zf into zf as is, without recompressing it."""
+    import zipfile
+    old_zf.fp.seek(old_zinfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           old_zf.fp.read(zipfile.sizeFileHeader))
+    old_zf.fp.seek(header[zipfile._FH_FILENAME_LENGTH] +
+                   header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+    zinfo = copy.copy(old_zinfo)
+    # Any data descriptor isn't copied, so the header has to be complete.
+    zinfo.flag_bits &= ~0x08
+    zinfo.extra = _strip_zip64_extra(zinfo.extra)
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader(zinfo.file_size > zipfile.ZIP64_LIMIT or
+                                 zinfo.compress_size > zipfile.ZIP64_LIMIT))
+    remaining = zinfo.compress_size
+    while remaining > 0:
+        data = old_zf.fp.read(min(remaining, COMPRESSION_BLOCK_SIZE))
+        if not data:
+            raise IOError("%s is truncated" % old_zinfo.filename)
+        zf.fp.write(data)
+        remaining -= len(data)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+
+def _write_zip_data(zf, zinfo, data, level):
+    """Add a member with contents `data` to zf, deflated at level."""
+    import zipfile
+    zinfo = copy.copy(zinfo)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.flag_bits &= ~0x08
+    zinfo.extra = _strip_zip64_extra(zinfo.extra)
+    deflated = _deflate_block((level, data, True))
+    zinfo.CRC = zlib.crc32(data) & 0xffffffff
+    zinfo.file_size = len(data)
+    zinfo.compress_size = len(deflated)
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader(zinfo.file_size > zipfile.ZIP64_LIMIT or
+                                 zinfo.compress_size > zipfile.ZIP64_LIMIT))
+    zf.fp.write(deflated)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+
+def rewrite_zip(src, dest, remove=(), replace=None, level=9):
+    """Copy the zip file src to dest, leaving out the members that match
+    the fnmatch patterns in `remove', and giving the members named in the
+    `replace' {arcname: data} dict new contents, deflated at level.
+    Replaced members keep their place; new ones go at the end.  Everything
+    else is copied as is, without recompressing it.
+
+    src and dest can be paths or file objects, so nested zips (e.g. an
+    omni.ja inside an apk) can be rewritten in memory.  This doesn't log,
+    so it can run in a worker process; it raises zipfile.BadZipfile,
+    IOError or OSError on failure.
+    """
+    import fnmatch
+    import zipfile
+    replace = dict(replace or {})
+    old_zf = zipfile.ZipFile(src, 'r')
+    try:
+        zf = zipfile.ZipFile(dest, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        try:
+            for old_zinfo in old_zf.infolist():
+                name = old_zinfo.filename
+                if name in replace:
+                    _write_zip_data(zf, old_zinfo, replace.pop(name), level)
+                elif not [p for p in remove if fnmatch.fnmatchcase(name, p)]:
+                    _copy_zip_member(zf, old_zf, old_zinfo)
+            for name in sorted(replace):
+                zinfo = zipfile.ZipInfo(name, time.localtime()[:6])
+                zinfo.external_attr = 0644 << 16L
+                _write_zip_data(zf, zinfo, replace[name], level)
+            zf._didModify = True
+        finally:
+            zf.close()
+    finally:
+        old_zf.close()
+
+
+# Set to a _KeepAliveConnections in download_files() worker threads.
+_download_connections = threading.local()
+
+
+class _KeepAliveConnections(object):
+    """Persistent httplib connections, one per (scheme, host), for the
+    downloads run on one thread.  urllib2 opens a new connection (and
+    TLS session) for every request.
+    """
+    def __init__(self):
+        self.connections = {}
+
+    def handles(self, url):
+        import urllib
+        scheme = url.split(':', 1)[0].lower()
+        return scheme in ('http', 'https') and scheme not in urllib.getproxies()
+
+    def _request(self, scheme, netloc, path, timeout):
+        import httplib
+        key = (scheme, netloc)
+        conn = self.connections.get(key)
+        if conn is not None:
+            try:
+                conn.request('GET', path)
+                return conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                # The server dropped the idle connection; retry on a new one.
+                conn.close()
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(netloc, timeout=timeout)
+        self.connections[key] = conn
+        conn.request('GET', path)
+        return conn.getresponse()
+
+    def urlopen(self, url, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                max_redirects=5):
+        """Like urllib2.urlopen(url), following redirects and raising
+        urllib2.HTTPError for anything but a 200."""
+        import urllib
+        import urllib2
+        import urlparse
+        for _ in range(max_redirects + 1):
+            parts = urlparse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            response = self._request(parts.scheme.lower(), parts.netloc,
+                                     path, timeout)
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307) and location:
+                response.read()
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.status != 200:
+                response.read()
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                                        response.msg, None)
+            # What urllib2 does, so the body reads like a file.
+            response.recv = response.read
+            fp = socket._fileobject(response, close=True)
+            return urllib.addinfourl(fp, response.msg, url, response.status)
+        raise urllib2.HTTPError(url, response.status,
+                                "Too many redirects", response.msg, None)
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+
 
 # ScriptMixin {{{1
 class ScriptMixin(object):
@@ -62,6 +475,10 @@ class ScriptMixin(object):
 
     env = None
     script_obj = None
+    retry_stats = None
+    # BaseScript gives each script its own lock.
+    retry_stats_lock = threading.Lock()
+    background_rmtrees = None
 
     # Simple filesystem commands {{{2
     def mkdir_p(self, path, error_level=ERROR):
@@ -80,9 +497,15 @@ class ScriptMixin(object):
             self.debug("mkdir_p: %s Already exists." % path)
 
     def rmtree(self, path, log_level=INFO, error_level=ERROR,
-               exit_code=-1):
+               exit_code=-1, background=False):
         """
         Returns None for success, not None for failure
+
+        If `background' is True and path is a directory, it is renamed out
+        of the way and deleted on a background thread, so the caller can
+        carry on (and recreate path) right away.  Use
+        wait_for_background_rmtree() to make sure deletion has finished;
+        BaseScript.run() does this after the post-run listeners.
         """
         self.log("rmtree: %s" % path, level=log_level)
         error_message = "Unable to remove %s!" % path
@@ -99,6 +522,9 @@ class ScriptMixin(object):
             )
         if os.path.exists(path):
             if os.path.isdir(path):
+                if background and not os.path.islink(path) and \
+                        self._background_rmtree(path, log_level=log_level):
+                    return
                 return self.retry(
                     shutil.rmtree,
                     error_level=error_level,
@@ -119,6 +545,70 @@ class ScriptMixin(object):
         else:
             self.debug("%s doesn't exist." % path)
 
+    def _background_rmtree(self, path, log_level=INFO):
+        """Helper method for rmtree(background=True).
+
+        Atomically moves path into a new sibling directory ending in
+        CLOBBER_SUFFIX, and starts a thread to delete that.
+
+        Returns True if path has been moved, False if the caller should
+        delete it in the foreground instead.
+        """
+        parent, name = os.path.split(os.path.abspath(path))
+        log_dir = getattr(getattr(self, 'log_obj', None), 'abs_log_dir', None)
+        if log_dir and (log_dir + os.sep).startswith(os.path.abspath(path) + os.sep):
+            # Don't move our own open logs out from under us.
+            return False
+        try:
+            clobber_dir = tempfile.mkdtemp(prefix='%s.' % name,
+                                           suffix=CLOBBER_SUFFIX, dir=parent)
+        except OSError, e:
+            self.log("Unable to create a directory next to %s (%s); deleting in the foreground." %
+                     (path, str(e)), level=log_level)
+            return False
+        try:
+            os.rename(path, os.path.join(clobber_dir, name))
+        except OSError, e:
+            self.log("Unable to move %s out of the way (%s); deleting in the foreground." %
+                     (path, str(e)), level=log_level)
+            os.rmdir(clobber_dir)
+            return False
+        self.log("rmtree: moved %s to %s; deleting in the background." %
+                 (path, clobber_dir), level=log_level)
+        errors = []
+        thread = threading.Thread(
+            target=_rmtree_parallel, name="rmtree %s" % clobber_dir,
+            args=(clobber_dir, errors),
+            kwargs={'num_threads': self.config.get('rmtree_threads', 4)},
+        )
+        thread.start()
+        if self.background_rmtrees is None:
+            self.background_rmtrees = []
+        self.background_rmtrees.append((clobber_dir, thread, errors))
+        return True
+
+    def wait_for_background_rmtree(self, log_level=INFO, error_level=ERROR):
+        """Wait for all rmtree(background=True) deletions to finish.
+
+        Returns the number of directories that couldn't be fully deleted.
+        """
+        failures = 0
+        while self.background_rmtrees:
+            clobber_dir, thread, errors = self.background_rmtrees.pop(0)
+            if thread.is_alive():
+                self.log("Waiting for background deletion of %s." % clobber_dir,
+                         level=log_level)
+                start = time.time()
+                thread.join()
+                self.log("Background deletion of %s finished after %d seconds." %
+                         (clobber_dir, time.time() - start), level=log_level)
+            if errors:
+                failures += 1
+                for error_path, e in errors:
+                    self.log("Unable to remove %s: %s" % (error_path, str(e)),
+                             level=error_level)
+        return failures
+
     def _is_windows(self):
         system = platform.system()
         if system in ("Windows", "Microsoft"):
@@ -192,6 +682,7 @@ class ScriptMixin(object):
         win32file.RemoveDirectory('\\\\?\\' + path)
 
     def get_filename_from_url(self, url):
+        import urlparse
         parsed = urlparse.urlsplit(url.rstrip('/'))
         if parsed.path != '':
             return parsed.path.rsplit('/', 1)[-1]
@@ -200,12 +691,21 @@ class ScriptMixin(object):
 
     def _urlopen(self, url, **kwargs):
         """ This method can be overwritten to extend its complexity
+
+        In download_files() threads, http(s) urls reuse that thread's
+        connection to the host.
         """
+        connections = getattr(_download_connections, 'value', None)
+        if connections is not None and connections.handles(url):
+            return connections.urlopen(url, **kwargs)
+        import urllib2
         return urllib2.urlopen(url, **kwargs)
 
     def _download_file(self, url, file_name):
         """ Helper script for download_file()
         """
+        import urllib2
+        import urlparse
         # If our URLs look like files, prefix them with file:// so they can
         # be loaded like URLs.
         if not (url.startswith("http") or url.startswith("file://")):
@@ -267,6 +767,8 @@ class ScriptMixin(object):
             Split out so we can alter the retry logic in
             mozharness.mozilla.testing.gaia_test.
             """
+        import httplib
+        import urllib2
         retry_args = dict(
             failure_status=None,
             retry_exceptions=(urllib2.HTTPError, urllib2.URLError,
@@ -309,6 +811,67 @@ class ScriptMixin(object):
             self.info("Downloaded %d bytes." % os.path.getsize(file_name))
         return status
 
+    def download_files(self, files, num_threads=None, create_parent_dir=True,
+                       error_level=ERROR, exit_code=3, retry_config=None):
+        """ download_file() each (url, file_name) in files, num_threads
+        (config['download_threads'], default 4) at a time.  Each thread
+        keeps its http(s) connections open, so consecutive downloads from
+        the same host don't reconnect.
+
+        Returns a list with download_file()'s result for each file (the
+        file name for success, None for failure), so
+        len(filter(None, results)) is the success count.
+        """
+        from multiprocessing.pool import ThreadPool
+        files = list(files)
+        if not files:
+            return []
+        if num_threads is None:
+            num_threads = self.config.get('download_threads', 4)
+        num_threads = max(1, min(num_threads, len(files)))
+        self.info("Downloading %d files on %d threads." % (len(files), num_threads))
+        all_connections = []
+        fatal = []
+        thread_retry_config = {'jitter': self.config.get('retry_jitter', True)}
+        thread_retry_config.update(retry_config or {})
+
+        def _download(args):
+            (url, file_name) = args
+            if fatal:
+                return None
+            if getattr(_download_connections, 'value', None) is None:
+                _download_connections.value = _KeepAliveConnections()
+                all_connections.append(_download_connections.value)
+            try:
+                return self.download_file(
+                    url, os.path.basename(file_name),
+                    parent_dir=os.path.dirname(file_name) or None,
+                    create_parent_dir=create_parent_dir,
+                    error_level=error_level, exit_code=exit_code,
+                    retry_config=thread_retry_config)
+            except SystemExit, e:
+                fatal.append(e)
+                return None
+
+        start = time.time()
+        pool = ThreadPool(num_threads)
+        try:
+            results = pool.map(_download, files, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            for connections in all_connections:
+                connections.close()
+        if fatal:
+            raise fatal[0]
+        elapsed = time.time() - start
+        downloaded = [r for r in results if r]
+        size = sum(os.path.getsize(r) for r in downloaded)
+        self.info("Downloaded %d of %d files (%d bytes) in %.1f seconds (%.1f MB/s)." %
+                  (len(downloaded), len(files), size, elapsed,
+                   size / max(elapsed, 0.001) / 1024 ** 2))
+        return results
+
     def move(self, src, dest, log_level=INFO, error_level=ERROR,
              exit_code=-1):
         self.log("Moving %s to %s" % (src, dest), level=log_level)
@@ -330,17 +893,13 @@ class ScriptMixin(object):
         os.chmod(path, mode)
 
     def copyfile(self, src, dest, log_level=INFO, error_level=ERROR, copystat=False, compress=False):
+        """Copy src to dest.  If compress is True, gzip it on the way; it
+        may also be one of the compressions in COMPRESSION_SUFFIXES.
+        """
         if compress:
-            self.log("Compressing %s to %s" % (src, dest), level=log_level)
-            try:
-                infile = open(src, "rb")
-                outfile = gzip.open(dest, "wb")
-                outfile.writelines(infile)
-                outfile.close()
-                infile.close()
-            except IOError, e:
-                self.log("Can't compress %s to %s: %s!" % (src, dest, str(e)),
-                         level=error_level)
+            if self.compress_files([(src, dest)],
+                                   compression='gzip' if compress is True else compress,
+                                   log_level=log_level, error_level=error_level):
                 return -1
         else:
             self.log("Copying %s to %s" % (src, dest), level=log_level)
@@ -359,8 +918,179 @@ class ScriptMixin(object):
                          level=error_level)
                 return -1
 
+    def compress_files(self, files, compression='gzip', level=None,
+                       num_threads=None, remove_src=False, log_level=INFO,
+                       error_level=ERROR, block_size=COMPRESSION_BLOCK_SIZE):
+        """Compress each (src, dest) pair in `files'.
+
+        The files are compressed concurrently, and gzip files are compressed
+        in blocks across num_threads threads (config['compression_threads'],
+        or the number of cpus, by default), with at most 2 * num_threads
+        blocks in memory; see COMPRESSION_BLOCK_SIZE.
+
+        compression is 'gzip' or 'bzip2'.  bzip2 files are written as a
+        single stream, so each one is compressed on one thread; only
+        separate bzip2 files are compressed in parallel.  level defaults to
+        config['compression_level'], or COMPRESSION_LEVELS; pass
+        FAST_COMPRESSION_LEVEL for intermediate files.  If remove_src is
+        True, each src is deleted once it's been compressed, like gzip(1)
+        and bzip2(1) do.
+
+        Returns the number of files that couldn't be compressed.
+        """
+        if compression not in COMPRESSION_SUFFIXES:
+            self.log("Unknown compression %s!" % compression, level=error_level)
+            return len(files)
+        if level is None:
+            level = self.config.get('compression_level',
+                                    COMPRESSION_LEVELS[compression])
+        from multiprocessing import cpu_count
+        from multiprocessing.pool import ThreadPool
+        if num_threads is None:
+            num_threads = self.config.get('compression_threads', cpu_count())
+        num_threads = max(num_threads, 1)
+
+        def _compress(src_dest):
+            src, dest = src_dest
+            start = time.time()
+            try:
+                size = _compress_file(src, dest, compression, level,
+                                      block_pool, block_slots,
+                                      block_size=block_size)
+                if remove_src:
+                    os.remove(src)
+            except (IOError, OSError), e:
+                if os.path.exists(dest):
+                    os.remove(dest)
+                return src, dest, None, str(e)
+            return src, dest, size, time.time() - start
+
+        block_pool = ThreadPool(num_threads)
+        block_slots = threading.BoundedSemaphore(2 * num_threads)
+        file_pool = ThreadPool(min(num_threads, len(files)) or 1)
+        try:
+            results = file_pool.map(_compress, files)
+        finally:
+            file_pool.close()
+            block_pool.close()
+            file_pool.join()
+            block_pool.join()
+        failures = 0
+        for src, dest, size, elapsed in results:
+            if size is None:
+                self.log("Can't compress %s to %s: %s!" % (src, dest, elapsed),
+                         level=error_level)
+                failures += 1
+            else:
+                self.log("Compressed %s to %s (%s, %d bytes -> %d bytes, %.1fs)" %
+                         (src, dest, compression, size, os.path.getsize(dest),
+                          elapsed), level=log_level)
+        return failures
+
+    def zip_files(self, zip_name, members, level=None, num_threads=None,
+                  update=True, log_level=INFO, error_level=ERROR,
+                  block_size=COMPRESSION_BLOCK_SIZE):
+        """Write zip_name from (src, arcname) `members', where a src
+        directory adds everything under it below arcname.  Files are
+        streamed straight into the archive, so there's no need to copy them
+        into a staging tree first.
+
+        Members are deflated in parallel on num_threads threads
+        (config['compression_threads'], or the number of cpus, by default),
+        and large members are deflated in parallel blocks.  level defaults
+        to config['compression_level'], or COMPRESSION_LEVELS['gzip'].
+
+        Like `zip -u', if update is True and zip_name exists, its members
+        that aren't in `members' are kept.  Members whose src has the same
+        size and mtime are copied over without recompressing them.
+
+        Returns None for success, not None for failure.
+        """
+        if level is None:
+            level = self.config.get('compression_level',
+                                    COMPRESSION_LEVELS['gzip'])
+        from multiprocessing import cpu_count
+        from multiprocessing.pool import ThreadPool
+        if num_threads is None:
+            num_threads = self.config.get('compression_threads', cpu_count())
+        num_threads = max(num_threads, 1)
+        self.log("Creating %s" % zip_name, level=log_level)
+        # Later members replace earlier ones, as they would in a staging tree.
+        sources = {}
+        arcnames = []
+        try:
+            for src, arcname in members:
+                paths = [(src, arcname)]
+                if os.path.isdir(src):
+                    paths = []
+                    for root, dirs, files in os.walk(src, followlinks=True):
+                        dirs.sort()
+                        for name in sorted(files):
+                            path = os.path.join(root, name)
+                            paths.append((path, os.path.join(
+                                arcname, os.path.relpath(path, src))))
+                for path, name in paths:
+                    name = os.path.normpath(name).replace(os.sep, '/').lstrip('/')
+                    if name not in sources:
+                        arcnames.append(name)
+                    sources[name] = path
+            new_members = [(sources[a], _zip_member_info(sources[a], a))
+                           for a in arcnames]
+        except OSError, e:
+            self.log("Can't zip up %s: %s!" % (zip_name, str(e)), level=error_level)
+            return -1
+
+        import zipfile
+        old_zf = None
+        tmp_name = zip_name + '.tmp'
+        pool = ThreadPool(num_threads)
+        try:
+            if update and os.path.exists(zip_name):
+                old_zf = zipfile.ZipFile(zip_name, 'r')
+            unchanged = []
+            changed = []
+            for src, zinfo in new_members:
+                old_zinfo = old_zf and old_zf.NameToInfo.get(zinfo.filename)
+                if old_zinfo and old_zinfo.file_size == zinfo.file_size and \
+                        old_zinfo.date_time == zinfo.date_time:
+                    unchanged.append(old_zinfo)
+                else:
+                    changed.append((src, zinfo))
+            if old_zf:
+                unchanged.extend([z for z in old_zf.infolist()
+                                  if z.filename not in sources])
+            zf = zipfile.ZipFile(tmp_name, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+            try:
+                for old_zinfo in unchanged:
+                    _copy_zip_member(zf, old_zf, old_zinfo)
+                _write_zip_members(zf, changed, level, pool, num_threads,
+                                   block_size)
+                zf._didModify = True
+            finally:
+                zf.close()
+            if old_zf:
+                old_zf.close()
+                old_zf = None
+            if os.path.exists(zip_name):
+                os.remove(zip_name)
+            os.rename(tmp_name, zip_name)
+        except (IOError, OSError, zipfile.BadZipfile, zipfile.LargeZipFile), e:
+            self.log("Can't zip up %s: %s!" % (zip_name, str(e)), level=error_level)
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            return -1
+        finally:
+            pool.close()
+            pool.join()
+            if old_zf:
+                old_zf.close()
+        self.log("Wrote %d member(s) to %s; %d copied from the existing zip" %
+                 (len(changed) + len(unchanged), zip_name, len(unchanged)),
+                 level=log_level)
+
     def copytree(self, src, dest, overwrite='no_overwrite', log_level=INFO,
-                 error_level=ERROR):
+                 error_level=ERROR, incremental=False, copy_mode='copy',
+                 num_threads=None):
         """an implementation of shutil.copytree however it allows for
         dest to exist and implements different overwrite levels.
         overwrite uses:
@@ -368,50 +1098,135 @@ class ScriptMixin(object):
         'overwrite_if_exists' will only overwrite destination paths that have
                    the same path names relative to the root of the src and
                    destination tree
-        'clobber' will replace the whole destination tree(clobber) if it exists"""
+        'clobber' will replace the whole destination tree(clobber) if it exists
+
+        If `incremental' is True, 'overwrite_if_exists' leaves destination
+        files with the same size and mtime as their source alone, rsync
+        style, and merges into existing destination directories rather than
+        replacing them.
+
+        `copy_mode' can be 'copy', 'hardlink' (hard link files where
+        possible) or 'reflink' (copy-on-write clone where the filesystem
+        supports it); both of the latter fall back to copying.
+
+        Files are copied on `num_threads' threads, defaulting to
+        self.config.get('copytree_threads', 4).
+        """
 
         self.info('copying tree: %s to %s' % (src, dest))
+        if overwrite not in ('no_overwrite', 'overwrite_if_exists', 'clobber'):
+            self.fatal("%s is not a valid argument for param overwrite" % (overwrite))
+        if copy_mode not in ('copy', 'hardlink', 'reflink'):
+            self.fatal("%s is not a valid argument for param copy_mode" % (copy_mode))
+        if num_threads is None:
+            num_threads = self.config.get('copytree_threads', 4)
+        start = time.time()
         try:
             if overwrite == 'clobber' or not os.path.exists(dest):
                 self.rmtree(dest)
-                shutil.copytree(src, dest)
-            elif overwrite == 'no_overwrite' or overwrite == 'overwrite_if_exists':
-                files = os.listdir(src)
-                for f in files:
-                    abs_src_f = os.path.join(src, f)
-                    abs_dest_f = os.path.join(dest, f)
-                    if not os.path.exists(abs_dest_f):
-                        if os.path.isdir(abs_src_f):
-                            self.mkdir_p(abs_dest_f)
-                            self.copytree(abs_src_f, abs_dest_f,
-                                          overwrite='clobber')
-                        else:
-                            shutil.copy2(abs_src_f, abs_dest_f)
-                    elif overwrite == 'no_overwrite':  # destination path exists
-                        if os.path.isdir(abs_src_f) and os.path.isdir(abs_dest_f):
-                            self.copytree(abs_src_f, abs_dest_f,
-                                          overwrite='no_overwrite')
-                        else:
-                            self.debug('ignoring path: %s as destination: \
-                                    %s exists' % (abs_src_f, abs_dest_f))
-                    else:  # overwrite == 'overwrite_if_exists' and destination exists
-                        self.debug('overwriting: %s with: %s' %
-                                   (abs_dest_f, abs_src_f))
-                        self.rmtree(abs_dest_f)
-
-                        if os.path.isdir(abs_src_f):
-                            self.mkdir_p(abs_dest_f)
-                            self.copytree(abs_src_f, abs_dest_f,
-                                          overwrite='overwrite_if_exists')
-                        else:
-                            shutil.copy2(abs_src_f, abs_dest_f)
-            else:
-                self.fatal("%s is not a valid argument for param overwrite" % (overwrite))
-        except (IOError, shutil.Error):
+                overwrite = None
+            dirs, files, skipped = self._plan_copytree(src, dest, overwrite,
+                                                       incremental)
+            for src_dir, dest_dir in dirs:
+                os.makedirs(dest_dir)
+        except (IOError, OSError, shutil.Error):
             self.exception("There was an error while copying %s to %s!" % (src, dest),
                            level=error_level)
             return -1
 
+        errors = []
+
+        def _copy(item):
+            try:
+                _copy_file(item[0], item[1], copy_mode)
+            except (IOError, OSError, shutil.Error), e:
+                errors.append((item[0], e))
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max(1, min(num_threads, len(files))))
+        try:
+            pool.map(_copy, files)
+        finally:
+            pool.close()
+            pool.join()
+        for src_dir, dest_dir in reversed(dirs):
+            try:
+                shutil.copystat(src_dir, dest_dir)
+            except OSError, e:
+                errors.append((src_dir, e))
+        if errors:
+            for path, e in errors:
+                self.log("Can't copy %s: %s" % (path, str(e)), level=error_level)
+            self.log("There was an error while copying %s to %s!" % (src, dest),
+                     level=error_level)
+            return -1
+
+        elapsed = max(time.time() - start, 0.001)
+        num_bytes = sum([item[2] for item in files])
+        self.log("copytree: copied %d files (%d bytes) in %.2f seconds: "
+                 "%.1f files/s, %.1f MB/s; skipped %d unchanged files" %
+                 (len(files), num_bytes, elapsed, len(files) / elapsed,
+                  num_bytes / elapsed / 1024 ** 2, skipped), level=log_level)
+
+    def _plan_copytree(self, src, dest, overwrite, incremental):
+        """Helper method for copytree().
+
+        Walks src, stat()ing each entry once, and works out what needs
+        copying to dest according to `overwrite' (None means dest doesn't
+        exist yet).  Conflicting destination paths are removed here.
+
+        Returns a tuple of: the list of (src_dir, dest_dir) directories to
+        create, parents first; the list of (src_file, dest_file, size)
+        files to copy; and the number of unchanged files skipped.
+        """
+        dirs = []
+        files = []
+        skipped = 0
+        todo = [(src, dest, overwrite)]
+        if overwrite is None:
+            dirs.append((src, dest))
+        while todo:
+            src_dir, dest_dir, mode = todo.pop()
+            for name in sorted(os.listdir(src_dir)):
+                abs_src_f = os.path.join(src_dir, name)
+                abs_dest_f = os.path.join(dest_dir, name)
+                src_stat = os.stat(abs_src_f)
+                src_is_dir = stat.S_ISDIR(src_stat.st_mode)
+                dest_stat = None
+                if mode is not None:
+                    try:
+                        dest_stat = os.stat(abs_dest_f)
+                    except OSError:
+                        pass
+                if dest_stat is not None:
+                    dest_is_dir = stat.S_ISDIR(dest_stat.st_mode)
+                    if mode == 'no_overwrite':
+                        if src_is_dir and dest_is_dir:
+                            todo.append((abs_src_f, abs_dest_f, mode))
+                        else:
+                            self.debug('ignoring path: %s as destination: \
+                                    %s exists' % (abs_src_f, abs_dest_f))
+                        continue
+                    # overwrite == 'overwrite_if_exists' and destination exists
+                    if incremental and src_is_dir and dest_is_dir:
+                        todo.append((abs_src_f, abs_dest_f, mode))
+                        continue
+                    if incremental and not src_is_dir and not dest_is_dir and \
+                            src_stat.st_size == dest_stat.st_size and \
+                            int(src_stat.st_mtime) == int(dest_stat.st_mtime):
+                        skipped += 1
+                        continue
+                    self.debug('overwriting: %s with: %s' %
+                               (abs_dest_f, abs_src_f))
+                    if src_is_dir or dest_is_dir:
+                        self.rmtree(abs_dest_f, log_level=DEBUG)
+                if src_is_dir:
+                    dirs.append((abs_src_f, abs_dest_f))
+                    todo.append((abs_src_f, abs_dest_f, None))
+                else:
+                    files.append((abs_src_f, abs_dest_f, src_stat.st_size))
+        return dirs, files, skipped
+
     def write_to_file(self, file_path, contents, verbose=True,
                       open_mode='w', create_parent_dir=False,
                       error_level=ERROR):
@@ -515,10 +1330,38 @@ class ScriptMixin(object):
         return None
 
     # More complex commands {{{2
+    def query_retry_stats(self):
+        """Returns (and creates) the dict of retry() metrics for this
+        script: the number of retry() calls that had to retry, the number of
+        retries, and the total number of seconds spent sleeping between them.
+        """
+        with self.retry_stats_lock:
+            if self.retry_stats is None:
+                self.retry_stats = {'calls': 0, 'retries': 0, 'sleep': 0.0}
+            return self.retry_stats
+
+    def _query_retry_sleeptime(self, attempt, sleeptime, max_sleeptime,
+                               jitter=True):
+        """Exponential backoff for retry().
+
+        Returns the number of seconds to sleep after failed attempt number
+        `attempt': `sleeptime' doubled for every previous attempt, to a
+        maximum of `max_sleeptime'.  With `jitter', return a random time
+        between 0 and that ("full jitter"), so that many jobs failing
+        against the same server don't all retry at the same moment.
+        """
+        delay = sleeptime * 2 ** (attempt - 1)
+        if attempt > 1 and delay > max_sleeptime:
+            delay = max_sleeptime
+        if jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
     def retry(self, action, attempts=None, sleeptime=60, max_sleeptime=5 * 60,
               retry_exceptions=(Exception, ), good_statuses=None, cleanup=None,
               error_level=ERROR, error_message="%(action)s failed after %(attempts)d tries!",
-              failure_status=-1, log_level=INFO, args=(), kwargs={}):
+              failure_status=-1, log_level=INFO, args=(), kwargs={},
+              jitter=None, exception_policies=None):
         """ Generic retry command.
             Ported from tools util.retry.
 
@@ -529,10 +1372,20 @@ class ScriptMixin(object):
             defaulting to 60 and doubling each retry attempt, to a maximum of
             `max_sleeptime'.
 
+            `jitter' randomizes each sleep between 0 and that value, and
+            defaults to self.config.get('retry_jitter', False).  Callers
+            that retry many things at once, e.g. from a thread pool, turn it
+            on so their retries don't all hit the server together.
+
             `retry_exceptions' is a tuple of Exceptions that should be caught.
             If exceptions other than those listed in `retry_exceptions' are
             raised from `action', they will be raised immediately.
 
+            `exception_policies' is an optional dict of Exception class to a
+            dict that overrides any of 'attempts', 'sleeptime' and
+            'max_sleeptime' when that exception is caught, e.g.
+            {socket.timeout: {'sleeptime': 5, 'max_sleeptime': 30}}.
+
             `good_statuses' is a tuple of return values which, if specified,
             will result in retrying if the return value isn't listed.
 
@@ -543,6 +1396,10 @@ class ScriptMixin(object):
 
             `args' and `kwargs' are a tuple and dict of arguments to pass onto
             to `callable'.
+
+            Sleeping between retries across the whole script is limited to
+            self.config.get('retry_budget') seconds, if set; once that's used
+            up, retry() gives up after the first failed attempt.
             """
         if not callable(action):
             self.fatal("retry() called with an uncallable method %s!" % action)
@@ -553,9 +1410,17 @@ class ScriptMixin(object):
         if max_sleeptime < sleeptime:
             self.debug("max_sleeptime %d less than sleeptime %d" % (
                        max_sleeptime, sleeptime))
+        if jitter is None:
+            jitter = self.config.get("retry_jitter", False)
+        retry_budget = self.config.get("retry_budget")
+        stats = self.query_retry_stats()
         n = 0
-        while n <= attempts:
+        # The only way out of the loop other than success is the attempts
+        # check below, since an exception policy may allow more attempts
+        # than `attempts'.
+        while True:
             retry = False
+            policy = {}
             n += 1
             try:
                 self.log("retry: Calling %s with args: %s, kwargs: %s, attempt #%d" %
@@ -567,22 +1432,46 @@ class ScriptMixin(object):
                 retry = True
                 error_message = "%s\nCaught exception: %s" % (error_message, str(e))
                 self.log('retry: attempt #%d caught exception: %s' % (n, str(e)), level=INFO)
+                # The most specific exception class with a policy wins.
+                for exception_class in getattr(type(e), '__mro__', (type(e), )):
+                    if exception_class in (exception_policies or {}):
+                        policy = exception_policies[exception_class]
+                        break
 
             if not retry:
                 return status
             else:
                 if cleanup:
                     cleanup()
-                if n == attempts:
+                if n >= policy.get('attempts', attempts):
+                    self.log(error_message % {'action': action, 'attempts': n}, level=error_level)
+                    return failure_status
+                delay = self._query_retry_sleeptime(
+                    n, policy.get('sleeptime', sleeptime),
+                    policy.get('max_sleeptime', max_sleeptime), jitter=jitter)
+                # retry() may run on several threads at once; the sleep is
+                # counted before sleeping, so that concurrent retries can't
+                # overspend the budget between them.
+                with self.retry_stats_lock:
+                    if n == 1:
+                        stats['calls'] += 1
+                    stats['retries'] += 1
+                    budget_used_up = (retry_budget is not None and
+                                      stats['sleep'] >= retry_budget)
+                    if not budget_used_up:
+                        if retry_budget is not None:
+                            delay = min(delay, retry_budget - stats['sleep'])
+                        if delay > 0:
+                            stats['sleep'] += delay
+                if budget_used_up:
+                    self.log("retry: retry budget of %d seconds used up; giving up" %
+                             retry_budget, level=log_level)
                     self.log(error_message % {'action': action, 'attempts': n}, level=error_level)
                     return failure_status
-                if sleeptime > 0:
+                if delay > 0:
                     self.log("retry: Failed, sleeping %d seconds before retrying" %
-                             sleeptime, level=log_level)
-                    time.sleep(sleeptime)
-                    sleeptime = sleeptime * 2
-                    if sleeptime > max_sleeptime:
-                        sleeptime = max_sleeptime
+                             delay, level=log_level)
+                    time.sleep(delay)
 
     def query_env(self, partial_env=None, replace_dict=None,
                   purge_env=(),
@@ -719,6 +1608,8 @@ class ScriptMixin(object):
 
         try:
             if output_timeout:
+                from mozprocess import ProcessHandler
+
                 def processOutput(line):
                     parser.add_lines(line)
 
@@ -1026,38 +1917,6 @@ class BaseScript(ScriptMixin, LogMixin, object):
                  default_log_level="info", **kwargs):
         super(BaseScript, self).__init__()
 
-        # Collect decorated methods. We simply iterate over the attributes of
-        # the current class instance and look for signatures deposited by
-        # the decorators.
-        self._listeners = dict(
-            pre_run=[],
-            pre_action=[],
-            post_action=[],
-            post_run=[],
-        )
-        for k in dir(self):
-            item = getattr(self, k)
-
-            # We only decorate methods, so ignore other types.
-            if not inspect.ismethod(item):
-                continue
-
-            if hasattr(item, '_pre_run_listener'):
-                self._listeners['pre_run'].append(k)
-
-            if hasattr(item, '_pre_action_listener'):
-                self._listeners['pre_action'].append((
-                    k,
-                    item._pre_action_listener))
-
-            if hasattr(item, '_post_action_listener'):
-                self._listeners['post_action'].append((
-                    k,
-                    item._post_action_listener))
-
-            if hasattr(item, '_post_run_listener'):
-                self._listeners['post_run'].append(k)
-
         self.return_code = 0
         self.log_obj = None
         self.abs_dirs = None
@@ -1065,6 +1924,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
             config_options = []
         self.summary_list = []
         self.failures = []
+        self.retry_stats_lock = threading.Lock()
         rw_config = ConfigClass(config_options=config_options, **kwargs)
         self.config = rw_config.get_read_only_config()
         self.actions = tuple(rw_config.actions)
@@ -1096,6 +1956,60 @@ class BaseScript(ScriptMixin, LogMixin, object):
         if self.config.get("dump_config"):
             self.dump_config(exit_on_finish=True)
 
+        # Collect decorated methods.  This is done last, so --list-actions
+        # (which exits while parsing the config) and --dump-config don't pay
+        # for it.  The registry is worked out once per class.
+        self._listeners = dict((k, list(v)) for k, v in
+                               self._query_listener_registry().items())
+
+    @classmethod
+    def _query_listener_registry(cls):
+        """Return (and cache on cls) the methods with signatures deposited
+        by the PreScriptRun/PostScriptAction/etc. decorators, in the same
+        form as self._listeners.
+
+        The class dicts along the mro are looked at directly, rather than
+        getattr() on an instance, so properties aren't evaluated.
+        """
+        registry = cls.__dict__.get('_listener_registry')
+        if registry is not None:
+            return registry
+        registry = dict(
+            pre_run=[],
+            pre_action=[],
+            post_action=[],
+            post_run=[],
+        )
+        for k in dir(cls):
+            for klass in cls.__mro__:
+                if k in klass.__dict__:
+                    item = klass.__dict__[k]
+                    break
+            else:
+                continue
+
+            # We only decorate methods, so ignore other types.
+            if not isinstance(item, types.FunctionType):
+                continue
+
+            if hasattr(item, '_pre_run_listener'):
+                registry['pre_run'].append(k)
+
+            if hasattr(item, '_pre_action_listener'):
+                registry['pre_action'].append((
+                    k,
+                    item._pre_action_listener))
+
+            if hasattr(item, '_post_action_listener'):
+                registry['post_action'].append((
+                    k,
+                    item._post_action_listener))
+
+            if hasattr(item, '_post_run_listener'):
+                registry['post_run'].append(k)
+        cls._listener_registry = registry
+        return registry
+
     def _dump_config_hierarchy(self, cfg_files):
         """ interpret each config file used.
 
@@ -1108,36 +2022,29 @@ class BaseScript(ScriptMixin, LogMixin, object):
         # ignore those.
         dirs = self.query_abs_dirs()
         cfg_files_dump_config = {}  # we will dump this to file
-        # keep track of keys that did not come from a config file
-        keys_not_from_file = set(self.config.keys())
         if not cfg_files:
             cfg_files = []
         self.info("Total config files: %d" % (len(cfg_files)))
         if len(cfg_files):
             self.info("cfg files used from lowest precedence to highest:")
-        for i, (target_file, target_dict) in enumerate(cfg_files):
-            unique_keys = set(target_dict.keys())
-            unique_dict = {}
-            # iterate through the target_dicts remaining 'higher' cfg_files
-            remaining_cfgs = cfg_files[slice(i + 1, len(cfg_files))]
-            # where higher == more precedent
-            for ii, (higher_file, higher_dict) in enumerate(remaining_cfgs):
-                # now only keep keys/values that are not overwritten by a
-                # higher config
-                unique_keys = unique_keys.difference(set(higher_dict.keys()))
-            # unique_dict we know now has only keys/values that are unique to
-            # this config file.
-            unique_dict = dict(
+        # Work out which keys/values are unique to each config file from the
+        # highest precedence down, so that each file's keys only need
+        # comparing against the keys of all the files above it at once.
+        higher_keys = set()
+        unique_dicts = []
+        for target_file, target_dict in reversed(cfg_files):
+            unique_keys = set(target_dict.keys()) - higher_keys
+            unique_dicts.append(dict(
                 (key, target_dict.get(key)) for key in unique_keys
-            )
-            cfg_files_dump_config[target_file] = unique_dict
+            ))
+            higher_keys.update(target_dict.keys())
+        unique_dicts.reverse()
+        for i, (target_file, target_dict) in enumerate(cfg_files):
+            cfg_files_dump_config[target_file] = unique_dicts[i]
             self.action_message("Config File %d: %s" % (i + 1, target_file))
-            self.info(pprint.pformat(unique_dict))
-            # let's also find out which keys/values from self.config are not
-            # from each target config file dict
-            keys_not_from_file = keys_not_from_file.difference(
-                set(target_dict.keys())
-            )
+            self.info(pprint.pformat(unique_dicts[i]))
+        # keep track of keys that did not come from a config file
+        keys_not_from_file = set(self.config.keys()) - higher_keys
         not_from_file_dict = dict(
             (key, self.config.get(key)) for key in keys_not_from_file
         )
@@ -1175,6 +2082,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
     def copy_logs_to_upload_dir(self):
         """Copies logs to the upload directory"""
         self.info("Copying logs to upload dir...")
+        self.log_obj.flush()
         log_files = ['localconfig.json']
         for log_name in self.log_obj.log_files.keys():
             log_files.append(self.log_obj.log_files[log_name])
@@ -1300,6 +2208,8 @@ class BaseScript(ScriptMixin, LogMixin, object):
                     self.error("Exception during post-run listener: %s" %
                                traceback.format_exc())
 
+            self.wait_for_background_rmtree()
+
             if not post_success:
                 self.fatal("Aborting due to failure in post-run listener.")
         if self.config.get("copy_logs_post_run", True):
@@ -1316,7 +2226,8 @@ class BaseScript(ScriptMixin, LogMixin, object):
         Delete the working directory
         """
         dirs = self.query_abs_dirs()
-        self.rmtree(dirs['abs_work_dir'], error_level=FATAL)
+        self.rmtree(dirs['abs_work_dir'], error_level=FATAL,
+                    background=self.config.get('background_clobber', True))
 
     def query_abs_dirs(self):
         """We want to be able to determine where all the important things
@@ -1371,6 +2282,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
             "log_format": '%(asctime)s %(levelname)8s - %(message)s',
             "log_to_console": True,
             "append_to_log": False,
+            "log_async": False,
         }
         log_type = self.config.get("log_type", "multi")
         for key in log_config.keys():
@@ -1402,6 +2314,10 @@ class BaseScript(ScriptMixin, LogMixin, object):
                     """log is closed; print as a default. Ran into this
                     when calling from __del__()"""
                     print "### Log is closed! (%s)" % item['message']
+        stats = self.query_retry_stats()
+        if stats['retries']:
+            self.info("retry: %d retries over %d retry() calls, %d seconds sleeping" %
+                      (stats['retries'], stats['calls'], stats['sleep']))
 
     def add_summary(self, message, level=INFO):
         self.summary_list.append({'message': message, 'level': level})
@@ -1458,7 +2374,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
             dest_file = os.path.basename(dest)
             dest_dir = os.path.join(upload_dir, os.path.dirname(dest))
         if compress and not dest_filename_given:
-            dest_file += ".gz"
+            dest_file += COMPRESSION_SUFFIXES['gzip' if compress is True else compress]
         dest = os.path.join(dest_dir, dest_file)
         if not os.path.exists(target):
             self.log("%s doesn't exist!" % target, level=error_level)
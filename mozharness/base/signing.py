@@ -12,6 +12,7 @@ import hashlib
 import os
 import re
 import subprocess
+import time
 
 from mozharness.base.errors import JarsignerErrorList, ZipErrorList, ZipalignErrorList
 from mozharness.base.log import OutputParser, IGNORE, DEBUG, INFO, ERROR, FATAL
@@ -162,3 +163,63 @@ class AndroidSigningMixin(object):
                             error_list=ZipalignErrorList):
             self.log("Unable to zipalign %s to %s!" % (unaligned_apk, aligned_apk), level=error_level)
             return -1
+
+    def sign_and_align_apks(self, apks, keystore, storepass, keypass,
+                            key_alias, remove_signature=True,
+                            num_threads=None, error_list=None,
+                            error_level=ERROR):
+        """
+        Signs and zipaligns each (unsigned_apk, signed_apk) pair in apks.
+        jarsigner and zipalign are separate processes, so the sign+align
+        pipelines run concurrently on num_threads threads
+        (config['signing_threads'], defaulting to the number of cpus).
+
+        Returns a {(unsigned_apk, signed_apk): status} dict, where status
+        is None on success, or 'sign' or 'align' for the step that failed.
+        """
+        from multiprocessing import cpu_count
+        from multiprocessing.pool import ThreadPool
+        apks = list(apks)
+        if not apks:
+            return {}
+        if num_threads is None:
+            num_threads = self.config.get('signing_threads', cpu_count())
+        num_threads = max(1, min(num_threads, len(apks)))
+        self.info("Signing and aligning %d apks on %d threads." %
+                  (len(apks), num_threads))
+        fatal = []
+
+        def _sign_and_align(paths):
+            (unsigned_apk, signed_apk) = paths
+            if fatal:
+                return paths, 'sign'
+            try:
+                if self.sign_apk(unsigned_apk, keystore, storepass, keypass,
+                                 key_alias, remove_signature=remove_signature,
+                                 error_list=error_list,
+                                 error_level=error_level) != 0:
+                    return paths, 'sign'
+                if os.path.dirname(signed_apk):
+                    self.mkdir_p(os.path.dirname(signed_apk))
+                if self.align_apk(unsigned_apk, signed_apk,
+                                  error_level=error_level):
+                    return paths, 'align'
+            except SystemExit, e:
+                fatal.append(e)
+                return paths, 'sign'
+            return paths, None
+
+        start = time.time()
+        pool = ThreadPool(num_threads)
+        try:
+            results = dict(pool.map(_sign_and_align, apks, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+        if fatal:
+            raise fatal[0]
+        elapsed = time.time() - start
+        self.info("Signed and aligned %d of %d apks in %.1f seconds (%.1f apks/second)." %
+                  (len([s for s in results.values() if s is None]), len(apks),
+                   elapsed, len(apks) / max(elapsed, 0.001)))
+        return results
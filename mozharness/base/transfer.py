@@ -9,7 +9,6 @@
 
 import os
 import pprint
-import urllib2
 try:
     import simplejson as json
     assert json
@@ -111,6 +110,7 @@ class TransferMixin(object):
             return -3
 
     def load_json_from_url(self, url, timeout=30, log_level=DEBUG):
+        import urllib2
         self.log("Attempting to download %s; timeout=%i" % (url, timeout),
                  level=log_level)
         try:
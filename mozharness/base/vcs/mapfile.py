@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Indexed hg<->git mapfiles.
+
+hg-git writes its mappings to a text mapfile, one "<git sha> <hg sha>" line
+per commit, in no particular order.  A MapfileIndex keeps the same mappings
+in binary form, so they can be looked up in either direction in O(log n),
+the ones added since an earlier point (a watermark) can be read back
+without diffing whole mapfiles, and several mapfiles can be merged without
+sorting them again.
+
+An index at `path` is made up of:
+
+  path       the log: 40 byte records (20 byte git sha, 20 byte hg sha) in
+             the order they were added.  It's only ever appended to, so a
+             record count is a watermark.
+  path.git   the first `indexed` log records, sorted by git sha.
+  path.hg    the same records with the hg sha first, sorted by hg sha.
+  path.json  the index id, `indexed`, and the size and mtime of the
+             mapfiles the index was last updated from.
+
+Records added after the sorted files were written are kept in memory, and
+merged into them by compact() once there are enough of them.
+
+A MapfileIndex can be shared between threads: each one has a lock around
+its updates, compactions and lookups.
+"""
+
+import binascii
+import heapq
+import mmap
+import os
+import threading
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+SHA_SIZE = 20
+RECORD_SIZE = 2 * SHA_SIZE
+# "<git sha> <hg sha>\n"
+LINE_SIZE = 4 * SHA_SIZE + 2
+# Records read or written at a time when streaming the files.
+CHUNK_RECORDS = 4096
+# Merge the in-memory records into the sorted files once there are this
+# many, or an eighth of the sorted records if that's more.
+COMPACT_MIN = 10000
+WATERMARK_PREFIX = 'mapfile-index'
+
+
+def _iter_chunked(fh, end):
+    """Yield the records in fh from its current position to offset end."""
+    position = fh.tell()
+    while position < end:
+        data = fh.read(min(end - position, RECORD_SIZE * CHUNK_RECORDS))
+        if not data:
+            break
+        position += len(data)
+        for i in xrange(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+            yield data[i:i + RECORD_SIZE]
+
+
+def _write_chunked(fh, records):
+    buf = []
+    count = 0
+    for record in records:
+        buf.append(record)
+        if len(buf) >= CHUNK_RECORDS:
+            fh.write(''.join(buf))
+            count += len(buf)
+            buf = []
+    fh.write(''.join(buf))
+    return count + len(buf)
+
+
+def read_mapfile(mapfile):
+    """Return the mappings in a text mapfile as git sha first records."""
+    with open(mapfile, 'rb') as fh:
+        data = fh.read()
+    lines = len(data) // LINE_SIZE
+    if len(data) % LINE_SIZE == 0 and \
+            data[2 * SHA_SIZE::LINE_SIZE].count(' ') == lines and \
+            data[LINE_SIZE - 1::LINE_SIZE].count('\n') == lines:
+        # Well formed, so convert the whole file at once.
+        try:
+            data = binascii.unhexlify(data.replace(' ', '').replace('\n', ''))
+            return [data[i:i + RECORD_SIZE]
+                    for i in xrange(0, len(data), RECORD_SIZE)]
+        except TypeError:
+            pass
+    records = []
+    for line in data.splitlines():
+        shas = line.split()
+        if len(shas) != 2 or len(shas[0]) != 40 or len(shas[1]) != 40:
+            continue
+        try:
+            records.append(binascii.unhexlify(shas[0] + shas[1]))
+        except TypeError:
+            continue
+    return records
+
+
+def _swap(record):
+    return record[SHA_SIZE:] + record[:SHA_SIZE]
+
+
+# MapfileIndex {{{1
+class MapfileIndex(object):
+    """ An append-only, binary index of hg<->git mappings; see the module
+        docstring for the layout.  Shas are passed in and returned as hex.
+        """
+    def __init__(self, path):
+        self.path = path
+        self.meta = None
+        self._count = 0
+        self._tail = {'git': {}, 'hg': {}}
+        self._sorted = {'git': None, 'hg': None}
+        self._lock = threading.RLock()
+        self._load()
+
+    def __len__(self):
+        return self._count
+
+    def _write_meta(self):
+        tmp_file = self.path + '.json.tmp'
+        with open(tmp_file, 'w') as fh:
+            json.dump(self.meta, fh)
+        os.rename(tmp_file, self.path + '.json')
+
+    def _load(self):
+        meta = None
+        if os.path.exists(self.path + '.json') and os.path.exists(self.path):
+            try:
+                with open(self.path + '.json') as fh:
+                    meta = json.load(fh)
+            except ValueError:
+                meta = None
+        if meta is None:
+            # New, or missing its metadata: start over.
+            meta = {'id': binascii.hexlify(os.urandom(8)), 'indexed': 0,
+                    'sources': {}}
+            open(self.path, 'wb').close()
+        self.meta = meta
+        size = os.path.getsize(self.path)
+        if size % RECORD_SIZE:
+            # An append was interrupted; drop the partial record.
+            with open(self.path, 'r+b') as fh:
+                fh.truncate(size - size % RECORD_SIZE)
+        self._count = size // RECORD_SIZE
+        indexed = meta['indexed']
+        for key in ('git', 'hg'):
+            sorted_file = '%s.%s' % (self.path, key)
+            if not os.path.exists(sorted_file) or \
+                    os.path.getsize(sorted_file) != indexed * RECORD_SIZE:
+                indexed = 0
+        if indexed > self._count:
+            indexed = 0
+        if indexed != meta['indexed']:
+            # The sorted files are out of date; rebuild them from the log.
+            meta['indexed'] = indexed = 0
+            for key in ('git', 'hg'):
+                open('%s.%s' % (self.path, key), 'wb').close()
+        self._write_meta()
+        with open(self.path, 'rb') as fh:
+            fh.seek(indexed * RECORD_SIZE)
+            for record in _iter_chunked(fh, self._count * RECORD_SIZE):
+                self._tail['git'][record[:SHA_SIZE]] = record[SHA_SIZE:]
+                self._tail['hg'][record[SHA_SIZE:]] = record[:SHA_SIZE]
+        self._open_sorted()
+        self._maybe_compact()
+
+    def _open_sorted(self):
+        if not self.meta['indexed']:
+            return
+        for key in ('git', 'hg'):
+            with open('%s.%s' % (self.path, key), 'rb') as fh:
+                self._sorted[key] = mmap.mmap(fh.fileno(), 0,
+                                              access=mmap.ACCESS_READ)
+
+    def close(self):
+        with self._lock:
+            for key in ('git', 'hg'):
+                if self._sorted[key] is not None:
+                    self._sorted[key].close()
+                    self._sorted[key] = None
+
+    # Lookups {{{2
+    def _bisect(self, key, prefix):
+        """Return the position of the first sorted record >= prefix."""
+        mm = self._sorted[key]
+        lo, hi = 0, self.meta['indexed']
+        length = len(prefix)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = mid * RECORD_SIZE
+            if mm[offset:offset + length] < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _lookup(self, key, sha):
+        """Return the sha that the full or abbreviated `key` sha maps to,
+        or None if it's unknown or ambiguous."""
+        sha = sha.lower()
+        try:
+            prefix = binascii.unhexlify(sha + '0' * (len(sha) % 2))
+        except TypeError:
+            return None
+        if not prefix or len(prefix) > SHA_SIZE:
+            return None
+        with self._lock:
+            matches = self._query_matches(key, sha, prefix)
+        if len(matches) != 1:
+            return None
+        return binascii.hexlify(matches.values()[0])
+
+    def _query_matches(self, key, sha, prefix):
+        """Return up to two {`key` sha: other sha} records matching the
+        hex sha, whose binary prefix is `prefix`."""
+        matches = {}
+        tail = self._tail[key]
+        if len(sha) == 2 * SHA_SIZE:
+            if prefix in tail:
+                matches[prefix] = tail[prefix]
+        else:
+            for k, v in tail.iteritems():
+                if binascii.hexlify(k).startswith(sha):
+                    matches[k] = v
+        if self._sorted[key] is not None and len(matches) < 2:
+            mm = self._sorted[key]
+            i = self._bisect(key, prefix)
+            while i < self.meta['indexed'] and len(matches) < 2:
+                record = mm[i * RECORD_SIZE:(i + 1) * RECORD_SIZE]
+                if not binascii.hexlify(record[:SHA_SIZE]).startswith(sha):
+                    break
+                matches[record[:SHA_SIZE]] = record[SHA_SIZE:]
+                i += 1
+        return matches
+
+    def lookup_git(self, hg_sha):
+        """Return the git sha for a full or abbreviated hg sha, or None."""
+        return self._lookup('hg', hg_sha)
+
+    def lookup_hg(self, git_sha):
+        """Return the hg sha for a full or abbreviated git sha, or None."""
+        return self._lookup('git', git_sha)
+
+    def _iter_sorted(self, key):
+        """Yield every record, `key` sha first, sorted by `key` sha."""
+        with self._lock:
+            tail = sorted(k + v for (k, v) in self._tail[key].iteritems())
+            indexed = self.meta['indexed']
+            if not indexed:
+                return iter(tail)
+            # compact() renames new sorted files into place, so this keeps
+            # reading the ones we opened.
+            fh = open('%s.%s' % (self.path, key), 'rb')
+        return heapq.merge(_iter_chunked(fh, indexed * RECORD_SIZE), tail)
+
+    def mappings(self, order='hg'):
+        """Yield every (git sha, hg sha) pair, sorted by the `order` sha."""
+        for record in self._iter_sorted(order):
+            if order == 'hg':
+                record = _swap(record)
+            yield binascii.hexlify(record[:SHA_SIZE]), binascii.hexlify(record[SHA_SIZE:])
+
+    # Updates {{{2
+    def _add_records(self, records):
+        """Append the git sha first records whose git sha isn't indexed yet.
+        Returns the number added."""
+        with self._lock:
+            return self._add_records_locked(records)
+
+    def _add_records_locked(self, records):
+        tail = self._tail['git']
+        indexed = self.meta['indexed']
+        if indexed and len(records) * 32 >= indexed:
+            # Lots of records: drop the ones that are already indexed in one
+            # go, rather than looking each of them up.
+            with open(self.path + '.git', 'rb') as fh:
+                records = set(records).difference(
+                    _iter_chunked(fh, indexed * RECORD_SIZE))
+        new_records = {}
+        for record in sorted(records):
+            git_bin = record[:SHA_SIZE]
+            if git_bin in tail or git_bin in new_records:
+                continue
+            if indexed:
+                offset = self._bisect('git', git_bin) * RECORD_SIZE
+                if self._sorted['git'][offset:offset + SHA_SIZE] == git_bin:
+                    continue
+            new_records[git_bin] = record
+        if new_records:
+            new_records = sorted(new_records.itervalues())
+            with open(self.path, 'ab') as fh:
+                _write_chunked(fh, new_records)
+            for record in new_records:
+                tail[record[:SHA_SIZE]] = record[SHA_SIZE:]
+                self._tail['hg'][record[SHA_SIZE:]] = record[:SHA_SIZE]
+            self._count += len(new_records)
+            self._maybe_compact()
+        return len(new_records)
+
+    def add(self, mappings):
+        """Add (git sha, hg sha) pairs whose git sha isn't indexed yet.
+        Returns the number added."""
+        records = []
+        for (git_sha, hg_sha) in mappings:
+            record = binascii.unhexlify(git_sha) + binascii.unhexlify(hg_sha)
+            if len(record) != RECORD_SIZE:
+                raise ValueError("Not a full sha: %s %s" % (git_sha, hg_sha))
+            records.append(record)
+        return self._add_records(records)
+
+    def update(self, mapfile):
+        """Add the mappings in the text mapfile `mapfile` that aren't indexed
+        yet.  This is a no-op if mapfile's size and mtime haven't changed
+        since the last update() from it.  Returns the number added."""
+        st = os.stat(mapfile)
+        source = [st.st_size, st.st_mtime]
+        source_key = os.path.abspath(mapfile)
+        with self._lock:
+            if self.meta['sources'].get(source_key) == source:
+                return 0
+            added = self._add_records_locked(read_mapfile(mapfile))
+            self.meta['sources'][source_key] = source
+            self._write_meta()
+        return added
+
+    def _maybe_compact(self):
+        if len(self._tail['git']) >= max(COMPACT_MIN, self.meta['indexed'] // 8):
+            self.compact()
+
+    def compact(self):
+        """Merge the records kept in memory into the sorted files."""
+        with self._lock:
+            if not self._tail['git']:
+                return
+            for key in ('git', 'hg'):
+                with open('%s.%s.tmp' % (self.path, key), 'wb') as fh:
+                    _write_chunked(fh, self._iter_sorted(key))
+            self.close()
+            for key in ('git', 'hg'):
+                sorted_file = '%s.%s' % (self.path, key)
+                os.rename(sorted_file + '.tmp', sorted_file)
+            self.meta['indexed'] = self._count
+            self._write_meta()
+            self._tail = {'git': {}, 'hg': {}}
+            self._open_sorted()
+
+    # Watermarks {{{2
+    def query_watermark(self, count=None):
+        """Return a watermark for the first `count` records (default: all
+        of them right now), for since() on a later run."""
+        if count is None:
+            count = self._count
+        return "%s %s %d\n" % (WATERMARK_PREFIX, self.meta['id'], count)
+
+    def parse_watermark(self, text):
+        """Return the record count in a query_watermark() string, or None if
+        it isn't a watermark for this index (e.g. the index was rebuilt)."""
+        fields = (text or '').split()
+        if len(fields) != 3 or fields[0] != WATERMARK_PREFIX or \
+                fields[1] != self.meta['id'] or not fields[2].isdigit():
+            return None
+        count = int(fields[2])
+        if count > self._count:
+            return None
+        return count
+
+    def since(self, watermark):
+        """Yield the (git sha, hg sha) pairs added after the first
+        `watermark` records, in the order they were added."""
+        with self._lock:
+            count = self._count
+        with open(self.path, 'rb') as fh:
+            fh.seek(watermark * RECORD_SIZE)
+            for record in _iter_chunked(fh, count * RECORD_SIZE):
+                yield binascii.hexlify(record[:SHA_SIZE]), binascii.hexlify(record[SHA_SIZE:])
+
+
+def merge_mapfiles(indexes, dest):
+    """ Write the mappings in `indexes` to the text mapfile `dest`, sorted by
+        hg sha with one line per hg sha, like
+        |sort --unique -t ' ' --key=2| over their mapfiles.  The indexes are
+        already sorted, so this is a streaming merge.  Returns the number of
+        lines written.
+        """
+    def lines():
+        last_hg = None
+        for record in heapq.merge(*[index._iter_sorted('hg') for index in indexes]):
+            hg_bin = record[:SHA_SIZE]
+            if hg_bin != last_hg:
+                last_hg = hg_bin
+                yield '%s %s\n' % (binascii.hexlify(record[SHA_SIZE:]),
+                                   binascii.hexlify(hg_bin))
+    with open(dest, 'wb') as fh:
+        return _write_chunked(fh, lines())
@@ -38,6 +38,7 @@ class VCSSyncScript(VCSScript):
         text = ''
         error_contents = ''
         max_log_sample_size = c.get('email_max_log_sample_size') # default defined in vcs_sync.py
+        self.log_obj.flush()
         error_log = os.path.join(dirs['abs_log_dir'], self.log_obj.log_files[ERROR])
         info_log = os.path.join(dirs['abs_log_dir'], self.log_obj.log_files[INFO])
         if os.path.exists(error_log) and os.path.getsize(error_log) > 0:
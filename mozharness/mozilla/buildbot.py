@@ -75,6 +75,7 @@ class BuildbotMixin(object):
             if self.config.get("buildbot_max_log_size") and self.log_obj:
                 # Find the path to the default log
                 dirs = self.query_abs_dirs()
+                self.log_obj.flush()
                 log_file = os.path.join(
                     dirs['abs_log_dir'],
                     self.log_obj.log_files[self.log_obj.log_level]
@@ -16,7 +16,6 @@ import os
 import pprint
 import subprocess
 import time
-import uuid
 import copy
 import glob
 import logging
@@ -493,6 +492,7 @@ def generate_build_ID():
 
 
 def generate_build_UID():
+    import uuid
     return uuid.uuid4().hex
 
 
@@ -1378,6 +1378,7 @@ or run without that action (ie: --no-{action})"
             self.warning('No files from the build system to upload to S3: uploadFiles property is missing or empty.')
 
         # Also upload our mozharness log files
+        self.log_obj.flush()
         files.extend([os.path.join(self.log_obj.abs_log_dir, x) for x in self.log_obj.log_files.values()])
 
         for upload_file in files:
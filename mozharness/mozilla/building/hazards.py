@@ -3,6 +3,7 @@ import json
 import re
 
 from mozharness.base.errors import MakefileErrorList
+from mozharness.base.script import FAST_COMPRESSION_LEVEL
 from mozharness.mozilla.buildbot import TBPL_WARNING
 
 
@@ -158,11 +159,18 @@ jobs = 2
                  ('hazards.txt',
                   'hazards',
                   'list of just the hazards, together with gcFunction reason for each'))
-        for f, short, long in files:
-            builder.copy_to_upload_dir(os.path.join(analysis_dir, f),
-                                    short_desc=short,
-                                    long_desc=long,
-                                    compress=True)
+        # These can be large, so compress them all at once, and quickly,
+        # rather than one at a time via copy_to_upload_dir(compress=True).
+        to_compress = []
+        for f, _, _ in files:
+            src = os.path.join(analysis_dir, f)
+            if not os.path.exists(src):
+                builder.error("%s doesn't exist!" % src)
+                continue
+            to_compress.append((src, os.path.join(upload_dir, f + '.gz')))
+        builder.compress_files(to_compress, compression='gzip',
+                               level=builder.config.get('compression_level',
+                                                        FAST_COMPRESSION_LEVEL))
 
     def upload_results(self, builder):
         """Upload the results of the analysis."""
@@ -93,21 +93,39 @@ class LocalesMixin(ChunkingMixin):
             locales = self.read_from_file(locales_file).split()
         return locales
 
-    def run_compare_locales(self, locale, halt_on_failure=False):
+    def query_compare_locales_command(self, locale, merge_dir=None):
+        """Return the compare-locales command for locale, as a dict with
+        the 'command', 'cwd', 'env' and 'error_list' to run it with.
+        """
         dirs = self.query_abs_dirs()
+        if merge_dir is None:
+            merge_dir = dirs['abs_merge_dir']
         compare_locales_script = os.path.join(dirs['abs_compare_locales_dir'],
                                               'scripts', 'compare-locales')
         env = self.query_env(partial_env={'PYTHONPATH':
                              os.path.join(dirs['abs_compare_locales_dir'],
                                           'lib')})
-        compare_locales_error_list = list(PythonErrorList)
-        self.rmtree(dirs['abs_merge_dir'])
-        self.mkdir_p(dirs['abs_merge_dir'])
         command = "python %s -m %s l10n.ini %s %s" % (compare_locales_script,
-                  dirs['abs_merge_dir'], dirs['abs_l10n_dir'], locale)
+                  merge_dir, dirs['abs_l10n_dir'], locale)
+        return {
+            'command': command,
+            'cwd': dirs['abs_locales_src_dir'],
+            'env': env,
+            'error_list': list(PythonErrorList),
+        }
+
+    def run_compare_locales(self, locale, halt_on_failure=False, merge_dir=None):
+        dirs = self.query_abs_dirs()
+        if merge_dir is None:
+            merge_dir = dirs['abs_merge_dir']
+        compare_locales = self.query_compare_locales_command(locale, merge_dir=merge_dir)
+        self.rmtree(merge_dir)
+        self.mkdir_p(merge_dir)
         self.info("*** BEGIN compare-locales %s" % locale)
-        status = self.run_command(command, error_list=compare_locales_error_list,
-                                  cwd=dirs['abs_locales_src_dir'], env=env,
+        status = self.run_command(compare_locales['command'],
+                                  error_list=compare_locales['error_list'],
+                                  cwd=compare_locales['cwd'],
+                                  env=compare_locales['env'],
                                   halt_on_failure=halt_on_failure)
         self.info("*** END compare-locales %s" % locale)
         return status
@@ -111,7 +111,8 @@ class MultiLocaleBuild(LocalesMixin, MercurialScript):
         if c['work_dir'] != '.':
             path = os.path.join(c['base_work_dir'], c['work_dir'])
             if os.path.exists(path):
-                self.rmtree(path, error_level=FATAL)
+                self.rmtree(path, error_level=FATAL,
+                            background=c.get('background_clobber', True))
         else:
             self.info("work_dir is '.'; skipping for now.")
 
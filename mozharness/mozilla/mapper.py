@@ -6,18 +6,108 @@
 # ***** END LICENSE BLOCK *****
 """Support for hg/git mapper
 """
-import urllib2
+import hashlib
+import os
+import threading
 import time
 try:
     import simplejson as json
 except ImportError:
     import json
 
+from mozharness.base.log import ERROR, FATAL
+
+# Guards the in-memory mapper caches and their on-disk mapfiles, since
+# query_mapper_revisions() looks revisions up from several threads.
+_mapper_cache_lock = threading.RLock()
+
 
 class MapperMixin:
+    _mapper_cache = None
+
+    def _query_mapper_service(self, url):
+        """
+        Returns the part of a mapper url before "{project}", which is the
+        same for the lookup, mapfile and insert urls of one mapper service.
+        """
+        return url.split('{project}', 1)[0]
+
+    def query_mapper_cache_file(self, mapper_url, project):
+        """
+        Returns the path of the local append-only mapfile for `project` on
+        the mapper service at `mapper_url`, or None if
+        config['mapper_cache_dir'] isn't set.
+
+        The mapfile uses the same "<hg_rev> <git_rev>" line format as the
+        vcs-sync mapfiles.
+        """
+        cache_dir = self.config.get('mapper_cache_dir')
+        if not cache_dir:
+            return None
+        service = hashlib.sha1(self._query_mapper_service(mapper_url)).hexdigest()[:12]
+        return os.path.join(cache_dir, '%s-%s-mapfile' % (project, service))
+
+    def query_mapper_cache(self, mapper_url, project):
+        """
+        Returns (and caches) the in-memory revision lookup for `project` on
+        the mapper service at `mapper_url`.
+
+        This is a dict of {'git': {hg_rev: git_rev}, 'hg': {git_rev: hg_rev}},
+        i.e. keyed by the vcs you want the revision for, as in query_mapper().
+        It is populated from query_mapper_cache_file() the first time it's
+        queried.
+        """
+        key = (self._query_mapper_service(mapper_url), project)
+        with _mapper_cache_lock:
+            if self._mapper_cache is None:
+                self._mapper_cache = {}
+            if key not in self._mapper_cache:
+                cache = {'git': {}, 'hg': {}}
+                cache_file = self.query_mapper_cache_file(mapper_url, project)
+                if cache_file and os.path.exists(cache_file):
+                    self.info('Reading %s mapper cache from %s' % (project, cache_file))
+                    with open(cache_file) as fh:
+                        for line in fh:
+                            revs = line.split()
+                            if len(revs) != 2:
+                                continue
+                            cache['git'][revs[0]] = revs[1]
+                            cache['hg'][revs[1]] = revs[0]
+                self._mapper_cache[key] = cache
+            return self._mapper_cache[key]
+
+    def add_mapper_cache_entries(self, mapper_url, project, mappings):
+        """
+        Adds (hg_rev, git_rev) pairs in `mappings` to the in-memory cache for
+        `project` on `mapper_url`, and appends the ones we didn't know about
+        yet to the local mapfile, if there is one.
+
+        Returns the number of new mappings.
+        """
+        cache = self.query_mapper_cache(mapper_url, project)
+        new_lines = []
+        with _mapper_cache_lock:
+            for hg_rev, git_rev in mappings:
+                if cache['git'].get(hg_rev) == git_rev:
+                    continue
+                cache['git'][hg_rev] = git_rev
+                cache['hg'][git_rev] = hg_rev
+                new_lines.append('%s %s\n' % (hg_rev, git_rev))
+            cache_file = self.query_mapper_cache_file(mapper_url, project)
+            if new_lines and cache_file:
+                try:
+                    if not os.path.isdir(os.path.dirname(cache_file)):
+                        os.makedirs(os.path.dirname(cache_file))
+                    with open(cache_file, 'a') as fh:
+                        fh.writelines(new_lines)
+                except (IOError, OSError), err:
+                    # The cache is only an optimization.
+                    self.warning('Unable to update mapper cache %s: %s' % (cache_file, str(err)))
+        return len(new_lines)
+
     def query_mapper(self, mapper_url, project, vcs, rev,
                      require_answer=True, attempts=30, sleeptime=30,
-                     project_name=None):
+                     project_name=None, error_level=FATAL):
         """
         Returns the mapped revision for the target vcs via a mapper service
 
@@ -36,12 +126,19 @@ class MapperMixin:
             project_name (str): Used for logging only to give a more
                 descriptive name to the project, otherwise just uses the
                 project parameter
+            error_level (str): The level to log at if all the attempts
+                fail; anything below FATAL returns None instead of exiting.
 
         Returns:
             A revision string, or None
         """
+        import urllib2
         if project_name is None:
             project_name = project
+        cached_rev = self.query_mapper_cache(mapper_url, project)[vcs].get(rev)
+        if cached_rev:
+            self.info('Mapped %s revision %s to %s %s from cache' % (project_name, rev, vcs, cached_rev))
+            return cached_rev
         url = mapper_url.format(project=project, vcs=vcs, rev=rev)
         self.info('Mapping %s revision to %s using %s' % (project_name, vcs, url))
         n = 1
@@ -54,11 +151,19 @@ class MapperMixin:
                         raise Exception("Mapper returned a revision of None; maybe it needs more time.")
                     else:
                         self.warning("Mapper returned a revision of None.  Accepting because require_answer is False.")
-                return j['%s_rev' % vcs]
+                        return None
+                mapped_rev = j['%s_rev' % vcs]
+                if vcs == 'git':
+                    self.add_mapper_cache_entries(mapper_url, project, [(rev, mapped_rev)])
+                else:
+                    self.add_mapper_cache_entries(mapper_url, project, [(mapped_rev, rev)])
+                return mapped_rev
             except Exception, err:
                 self.warning('Error: %s' % str(err))
                 if n == attempts:
-                    self.fatal('Giving up on %s %s revision for %s.' % (project_name, vcs, rev))
+                    self.log('Giving up on %s %s revision for %s.' % (project_name, vcs, rev),
+                             level=error_level)
+                    return None
                 if sleeptime > 0:
                     self.info('Sleeping %i seconds before retrying' % sleeptime)
                     time.sleep(sleeptime)
@@ -66,6 +171,241 @@ class MapperMixin:
             finally:
                 n += 1
 
+    def query_mapper_mapfile(self, mapfile_url, project, attempts=5,
+                             sleeptime=30, project_name=None):
+        """
+        Downloads the full mapfile for `project` from a mapper service that
+        supports it, and adds its mappings to the local cache.
+
+        Args:
+            mapfile_url (str): url of the mapfile; "{project}" will be
+                replaced. The mapfile has one "<hg_rev> <git_rev>" pair
+                per line.
+            project (str): The name of the mapper project
+            attempts (int): How many times to try to download the mapfile
+            sleeptime (int): How long to sleep between attempts
+            project_name (str): Used for logging only
+
+        Returns:
+            The number of mappings read, or None on failure.
+        """
+        import urllib2
+        if project_name is None:
+            project_name = project
+        url = mapfile_url.format(project=project)
+        self.info('Fetching %s mapfile from %s' % (project_name, url))
+        for n in range(1, attempts + 1):
+            try:
+                r = urllib2.urlopen(url, timeout=60)
+                mappings = []
+                for line in r:
+                    revs = line.split()
+                    if len(revs) == 2:
+                        mappings.append(tuple(revs))
+                self.add_mapper_cache_entries(mapfile_url, project, mappings)
+                return len(mappings)
+            except Exception, err:
+                self.warning('Error: %s' % str(err))
+                if n < attempts and sleeptime > 0:
+                    self.info('Sleeping %i seconds before retrying' % sleeptime)
+                    time.sleep(sleeptime)
+        self.warning('Unable to fetch the %s mapfile; falling back to single lookups.' % project_name)
+        return None
+
+    def query_mapper_revisions(self, mapper_url, project, vcs, revs,
+                               mapfile_url=None, num_threads=None,
+                               project_name=None, **kwargs):
+        """
+        Returns a dict mapping each revision in `revs` to its revision in
+        the target vcs.
+
+        Revisions are resolved from the local cache first.  If any are left
+        and `mapfile_url` is given, the project's whole mapfile is fetched in
+        a single request.  Anything still unknown is looked up concurrently
+        via query_mapper() on `num_threads` threads, defaulting to
+        config['mapper_threads'] or 8.
+
+        See query_mapper docs for the remaining parameters; `kwargs` are
+        passed through to query_mapper().
+        """
+        if project_name is None:
+            project_name = project
+        error_level = kwargs.pop('error_level', FATAL)
+        cache = self.query_mapper_cache(mapper_url, project)[vcs]
+        missing = [rev for rev in set(revs) if rev not in cache]
+        if missing and mapfile_url:
+            self.query_mapper_mapfile(mapfile_url, project,
+                                      attempts=min(kwargs.get('attempts', 5), 5),
+                                      sleeptime=kwargs.get('sleeptime', 30),
+                                      project_name=project_name)
+            missing = [rev for rev in missing if rev not in cache]
+        results = dict((rev, cache[rev]) for rev in set(revs) if rev in cache)
+        if not missing:
+            return results
+
+        def _lookup(rev):
+            # Only the main thread may fatal(); workers just log errors.
+            return rev, self.query_mapper(mapper_url, project, vcs, rev,
+                                          project_name=project_name,
+                                          error_level=ERROR, **kwargs)
+
+        from multiprocessing.pool import ThreadPool
+        if num_threads is None:
+            num_threads = self.config.get('mapper_threads', 8)
+        self.info('Mapping %d %s revision(s) to %s on %d thread(s)' %
+                  (len(missing), project_name, vcs, num_threads))
+        pool = ThreadPool(min(num_threads, len(missing)))
+        try:
+            lookups = pool.map(_lookup, missing)
+        finally:
+            pool.close()
+            pool.join()
+        failed = []
+        for rev, mapped_rev in lookups:
+            if mapped_rev is None and kwargs.get('require_answer', True):
+                failed.append(rev)
+            results[rev] = mapped_rev
+        if failed:
+            self.log('Giving up on %s %s revisions for %s.' %
+                     (project_name, vcs, ', '.join(sorted(failed))),
+                     level=error_level)
+        return results
+
+    def publish_mappings(self, insert_url, lines, headers=None,
+                         num_threads=None, chunk_size=200, min_chunk_size=20,
+                         max_chunk_size=2000, target_seconds=10, attempts=5,
+                         sleeptime=10, timeout=60, project_name=None):
+        """
+        Posts `lines` ("<git_rev> <hg_rev>\n" mapfile lines) to a mapper
+        insert url, e.g. <mapper>/<project>/insert/ignoredups.
+
+        The lines are sent in chunks, several at a time on `num_threads`
+        threads (default config['mapper_publish_threads'] or 4), each of
+        which keeps its connection to mapper open between chunks.  Chunks
+        start at `chunk_size` lines and grow or shrink, within
+        `min_chunk_size` and `max_chunk_size`, to take about
+        `target_seconds` to post; that keeps them well inside the load
+        balancer's timeout.  A failed chunk is retried, in smaller pieces,
+        up to `attempts` times.
+
+        Returns a sorted list of (start, end) ranges of `lines` that were
+        published, so callers can record how far they got and only retry
+        the rest next time.
+        """
+        import httplib
+        import threading
+        import urlparse
+        from collections import deque
+        from multiprocessing.pool import ThreadPool
+
+        if not lines:
+            return []
+        if num_threads is None:
+            num_threads = self.config.get('mapper_publish_threads', 4)
+        url = urlparse.urlsplit(insert_url)
+        if project_name is None:
+            project_name = url.path.strip('/').split('/')[0]
+        path = url.path + ('?%s' % url.query if url.query else '')
+        headers = dict(headers or {})
+        headers.setdefault('Content-Type', 'text/plain')
+        state = {
+            'next': 0,
+            'chunk_size': chunk_size,
+            'published': [],
+        }
+        retries = deque()
+        lock = threading.Lock()
+        connections = threading.local()
+
+        def _post(start, end):
+            """Post lines[start:end]; return None if it worked, or why not."""
+            conn = getattr(connections, 'conn', None)
+            if conn is None:
+                if url.scheme == 'https':
+                    conn = httplib.HTTPSConnection(url.netloc, timeout=timeout)
+                else:
+                    conn = httplib.HTTPConnection(url.netloc, timeout=timeout)
+                connections.conn = conn
+            try:
+                conn.request('POST', path, ''.join(lines[start:end]), headers)
+                response = conn.getresponse()
+                response.read()
+                if response.getheader('connection', '').lower() == 'close' or \
+                        response.version < 11:
+                    conn.close()
+                    connections.conn = None
+                if response.status != 200:
+                    return "received http %s code" % response.status
+            except Exception, e:
+                conn.close()
+                connections.conn = None
+                return str(e) or e.__class__.__name__
+            return None
+
+        def _worker(_):
+            while True:
+                with lock:
+                    if retries:
+                        start, end, attempt = retries.popleft()
+                    elif state['next'] < len(lines):
+                        start = state['next']
+                        end = min(len(lines), start + state['chunk_size'])
+                        state['next'] = end
+                        attempt = 1
+                    else:
+                        break
+                if attempt > 1 and sleeptime > 0:
+                    time.sleep(self._query_retry_sleeptime(
+                        attempt - 1, sleeptime, 5 * 60,
+                        jitter=self.config.get('retry_jitter', True)))
+                post_start = time.time()
+                error = _post(start, end)
+                elapsed = time.time() - post_start
+                with lock:
+                    if error is None:
+                        self.info("Published %s line range [%d, %d] to mapper in %.1fs" %
+                                  (project_name, start, end, elapsed))
+                        state['published'].append((start, end))
+                        # Aim for target_seconds per chunk, but don't
+                        # change the size by more than 2x at a time.
+                        scale = min(2.0, max(0.5, target_seconds / max(elapsed, 0.001)))
+                        state['chunk_size'] = int(min(max_chunk_size, max(
+                            min_chunk_size, (end - start) * scale)))
+                        continue
+                    state['chunk_size'] = max(min_chunk_size, state['chunk_size'] // 2)
+                    if attempt >= attempts:
+                        self.error("Could not publish %s line range [%d, %d] to mapper (%s) - %s; giving up" %
+                                   (project_name, start, end, insert_url, error))
+                    else:
+                        self.warning("Could not publish %s line range [%d, %d] to mapper (%s) - %s; will retry" %
+                                     (project_name, start, end, insert_url, error))
+                        # Retry in smaller pieces, in case it was too big.
+                        piece_size = max(min_chunk_size,
+                                         min(state['chunk_size'], (end - start + 1) // 2))
+                        for piece in range(start, end, piece_size):
+                            retries.append((piece, min(end, piece + piece_size),
+                                            attempt + 1))
+            conn = getattr(connections, 'conn', None)
+            if conn is not None:
+                conn.close()
+
+        num_threads = max(1, min(num_threads, len(lines) // min_chunk_size or 1))
+        self.info("Publishing %d %s mappings to %s on %d thread(s)" %
+                  (len(lines), project_name, insert_url, num_threads))
+        pool = ThreadPool(num_threads)
+        try:
+            pool.map(_worker, range(num_threads))
+        finally:
+            pool.close()
+            pool.join()
+        published = []
+        for (start, end) in sorted(state['published']):
+            if published and published[-1][1] == start:
+                published[-1] = (published[-1][0], end)
+            else:
+                published.append((start, end))
+        return published
+
     def query_mapper_git_revision(self, url, project, rev, **kwargs):
         """
         Returns the git revision for the given hg revision `rev`
@@ -9,9 +9,13 @@
 
 import os.path
 import hashlib
+import pipes
+import re
 import subprocess
 import os
 
+SHELL_VARIABLE_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
 ERROR_MSGS = {
     'undetermined_buildroot_lock': 'buildroot_lock_path does not exist.\
 Nothing to remove.'
@@ -249,3 +253,92 @@ class MockMixin(object):
             return self.get_mock_output_from_command(mock_target, *args, **kwargs)
         else:
             return super(MockMixin, self).get_output_from_command(*args, **kwargs)
+
+    def _write_job_script(self, job, job_dir, in_mock):
+        """Write the shell script for one run_concurrent_commands_m() job.
+        Each command's output goes to <index>.log in job_dir; `status'
+        ends up as "<index of the failed command> <exit status>", or
+        "- 0" if they all succeeded."""
+        lines = ['#!/bin/sh', '# %s' % job['name']]
+        status_file = pipes.quote(os.path.join(job_dir, 'status'))
+        for (i, c) in enumerate(job['commands']):
+            command = c['command']
+            if not isinstance(command, basestring):
+                command = ' '.join(pipes.quote(a) for a in command)
+            if c.get('cwd'):
+                command = 'cd %s && %s' % (pipes.quote(c['cwd']), command)
+            if c.get('env'):
+                exports = []
+                for key, value in sorted(c['env'].items()):
+                    # $HOME won't work inside the mock chroot, and sh can't
+                    # export e.g. bash's exported functions.
+                    if (in_mock and key == 'HOME') or not SHELL_VARIABLE_RE.match(key):
+                        continue
+                    exports.append('export %s=%s' % (key, pipes.quote(value)))
+                command = '; '.join(exports + [command])
+            lines += [
+                '(%s) > %s 2>&1' % (command, pipes.quote(os.path.join(job_dir, '%d.log' % i))),
+                'status=$?',
+                'if [ $status -ne 0 ]; then echo "%d $status" > %s; exit 0; fi' % (i, status_file),
+            ]
+        lines.append('echo "- 0" > %s' % status_file)
+        script = os.path.join(job_dir, 'run.sh')
+        self.write_to_file(script, '\n'.join(lines) + '\n', verbose=False)
+        return script
+
+    def run_concurrent_commands_m(self, jobs, work_dir, num_jobs=1):
+        """Run `jobs' num_jobs at a time, all inside one mock session if
+        there's a mock target, rather than one mock_mozilla call (and
+        buildroot lock) per command.  Nothing here touches
+        enable_mock()/disable_mock(), so callers don't have to either.
+
+        Each job is a dict with a 'name' and a list of 'commands', each a
+        dict with a 'command' and optionally a 'cwd' and 'env'.  A job's
+        commands run one after another, stopping at the first failure.
+        Their output isn't parsed here: it's left in per-command log files
+        under work_dir/<name>/ for the caller to parse and report on.
+
+        Returns {name: {'failed': index of the failed command or None,
+        'status': its exit status, 'logs': [log file per command run]}}.
+        If a job didn't run to completion (e.g. mock itself failed), its
+        'failed' and 'status' are None, and 'logs' has whatever it left.
+        """
+        in_mock = bool(self.get_mock_target())
+        self.rmtree(work_dir)
+        self.mkdir_p(work_dir)
+        scripts = []
+        for job in jobs:
+            job_dir = os.path.join(work_dir, job['name'])
+            self.mkdir_p(job_dir)
+            scripts.append(self._write_job_script(job, job_dir, in_mock))
+        self.write_to_file(os.path.join(work_dir, 'jobs.txt'),
+                           ''.join(pipes.quote(s) + '\n' for s in scripts),
+                           verbose=False)
+        self.info("Running %d jobs, %d at a time; logs are in %s." %
+                  (len(jobs), max(1, num_jobs), work_dir))
+        self.run_command_m('xargs -n 1 -P %d sh < %s' %
+                           (max(1, num_jobs),
+                            pipes.quote(os.path.join(work_dir, 'jobs.txt'))),
+                           cwd=work_dir)
+        results = {}
+        for job in jobs:
+            job_dir = os.path.join(work_dir, job['name'])
+            status_file = os.path.join(job_dir, 'status')
+            failed = status = None
+            logs = [os.path.join(job_dir, '%d.log' % i)
+                    for i in range(len(job['commands']))]
+            if os.path.exists(status_file):
+                (failed, status) = self.read_from_file(status_file, verbose=False).split()
+                failed = None if failed == '-' else int(failed)
+                status = int(status)
+                if failed is not None:
+                    logs = logs[:failed + 1]
+            else:
+                self.error("%s didn't finish!" % job['name'])
+                logs = [log for log in logs if os.path.exists(log)]
+            results[job['name']] = {
+                'failed': failed,
+                'status': status,
+                'logs': logs,
+            }
+        return results
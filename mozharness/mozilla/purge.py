@@ -31,6 +31,9 @@ class PurgeMixin(object):
     default_periodic_clobber = 7 * 24
 
     def purge_builds(self, basedirs=None, min_size=None, skip=None, max_age=None):
+        # Let any background clobbers finish first, so purge_builds.py sees
+        # the real free space and doesn't race them for the .deleteme dirs
+        self.wait_for_background_rmtree()
         # Try clobbering first
         c = self.config
         dirs = self.query_abs_dirs()
@@ -141,7 +144,7 @@ class PurgeMixin(object):
                 if always_clobber_dirs is None:
                     always_clobber_dirs = []
                 for path in always_clobber_dirs:
-                    self.rmtree(path)
+                    self.rmtree(path, background=c.get('background_clobber', True))
             # run purge_builds / check clobberer
             self.purge_builds()
         else:
@@ -2,9 +2,111 @@
 Module for handling repo style XML manifests
 """
 import xml.dom.minidom
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 import os
 import re
 
+SUPPORTED_TAGS = ('include', 'project', 'remote', 'default', 'manifest',
+                  'copyfile', 'remove-project')
+
+# Cache of absolute filename -> (mtime, size, root element, top-level
+# comments), so manifests included by several devices are only parsed once.
+# The cached trees are never modified.
+_parsed_manifests = {}
+
+
+class _ManifestTarget(object):
+    """
+    ElementTree parser target that keeps comments, and rejects unsupported
+    tags as soon as they're seen rather than after the whole file is parsed
+    """
+    def __init__(self):
+        self.builder = ElementTree.TreeBuilder()
+        self.depth = 0
+        self.prolog = []
+        # Exceptions raised from parser callbacks don't reliably propagate
+        # out of feed(), so _parse_manifest() checks this after each block.
+        self.error = None
+
+    def start(self, tag, attrs):
+        if self.error:
+            return
+        if tag not in SUPPORTED_TAGS:
+            self.error = ValueError("Unsupported tag: %s" % tag)
+            return
+        self.depth += 1
+        return self.builder.start(tag, attrs)
+
+    def end(self, tag):
+        if self.error:
+            return
+        self.depth -= 1
+        return self.builder.end(tag)
+
+    def data(self, data):
+        if self.depth and not self.error:
+            self.builder.data(data)
+
+    def comment(self, text):
+        if self.error:
+            return
+        if not self.depth:
+            self.prolog.append(text)
+            return
+        self.builder.start(ElementTree.Comment, {})
+        self.builder.data(text)
+        self.builder.end(ElementTree.Comment)
+
+    def close(self):
+        return self.builder.close()
+
+
+def _parse_manifest(filename):
+    """
+    Parses `filename` with a streaming ElementTree parser, without
+    processing <include> or <remove-project> nodes.
+    Returns a (root element, list of top-level comments) tuple, which is
+    cached until the file changes and so must not be modified.
+    """
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    cached = _parsed_manifests.get(filename)
+    if cached and cached[:2] == (st.st_mtime, st.st_size):
+        return cached[2:]
+    target = _ManifestTarget()
+    parser = ElementTree.XMLParser(target=target)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(65536), ''):
+            parser.feed(block)
+            if target.error:
+                raise target.error
+    root = parser.close()
+    _parsed_manifests[filename] = (st.st_mtime, st.st_size, root, target.prolog)
+    return root, target.prolog
+
+
+def _append_element(doc, parent, element):
+    """
+    Appends a DOM copy of ElementTree `element` (and its tail text) to
+    `parent`
+    """
+    if element.tag is ElementTree.Comment:
+        node = doc.createComment(element.text)
+    else:
+        node = doc.createElement(element.tag)
+        for name, value in element.items():
+            node.setAttribute(name, value)
+        if element.text:
+            node.appendChild(doc.createTextNode(element.text))
+        for child in element:
+            _append_element(doc, node, child)
+    parent.appendChild(node)
+    if element.tail:
+        parent.appendChild(doc.createTextNode(element.tail))
+
 
 def load_manifest(filename):
     """
@@ -14,42 +116,35 @@ def load_manifest(filename):
     Abort on unsupported manifest tags
     Returns the root node of the resulting DOM
     """
-    doc = xml.dom.minidom.parse(filename)
-
-    # Check that we don't have any unsupported tags
-    to_visit = list(doc.childNodes)
-    while to_visit:
-        node = to_visit.pop()
-        # Skip text nodes
-        if node.nodeType in (node.TEXT_NODE, node.COMMENT_NODE):
+    root, prolog = _parse_manifest(filename)
+    doc = xml.dom.minidom.getDOMImplementation().createDocument(None, root.tag, None)
+    manifest = doc.documentElement
+    for text in prolog:
+        doc.insertBefore(doc.createComment(text), manifest)
+    for name, value in root.items():
+        manifest.setAttribute(name, value)
+    if root.text:
+        manifest.appendChild(doc.createTextNode(root.text))
+    for element in root:
+        if element.tag != 'include':
+            _append_element(doc, manifest, element)
             continue
-
-        if node.tagName not in ('include', 'project', 'remote', 'default', 'manifest', 'copyfile', 'remove-project'):
-            raise ValueError("Unsupported tag: %s" % node.tagName)
-        to_visit.extend(node.childNodes)
-
-    # Find all <include> nodes
-    for i in doc.getElementsByTagName('include'):
-        p = i.parentNode
-
         # The name attribute is relative to where the original manifest lives
-        inc_filename = i.getAttribute('name')
+        inc_filename = element.get('name')
         inc_filename = os.path.join(os.path.dirname(filename), inc_filename)
 
-        # Parse the included file
+        # Load the included file, and insert all of its child nodes into our
+        # manifest where the include node was
         inc_doc = load_manifest(inc_filename).documentElement
-        # For all the child nodes in the included manifest, insert into our
-        # manifest just before the include node
         # We operate on a copy of childNodes because when we reparent `c`, the
         # list of childNodes is modified.
         for c in inc_doc.childNodes[:]:
-            p.insertBefore(c, i)
-        # Now we can remove the include node
-        p.removeChild(i)
+            manifest.appendChild(c)
+        if element.tail:
+            manifest.appendChild(doc.createTextNode(element.tail))
 
     # Remove all projects referenced by <remove-project>
     projects = {}
-    manifest = doc.documentElement
     to_remove = []
     for node in manifest.childNodes:
         # Skip text nodes
@@ -70,6 +165,58 @@ def load_manifest(filename):
     return doc
 
 
+def _query_index(manifest):
+    """
+    Returns (and caches on the document) an index of the manifest's
+    projects by name and by path, remotes by name, and default node.
+    Lists of project and remote nodes are kept in document order; the
+    functions in this module that add or remove nodes keep it up to date.
+    """
+    doc = manifest.ownerDocument or manifest
+    index = getattr(doc, '_repo_manifest_index', None)
+    if index is not None:
+        return index
+    index = {
+        'projects': [],
+        'projects_by_name': {},
+        'projects_by_path': {},
+        'remotes_by_name': {},
+        'default': None,
+    }
+    for node in doc.getElementsByTagName('*'):
+        if node.tagName == 'project':
+            _index_project(index, node)
+        elif node.tagName == 'remote':
+            index['remotes_by_name'].setdefault(node.getAttribute('name'), []).append(node)
+        elif node.tagName == 'default' and index['default'] is None:
+            index['default'] = node
+    doc._repo_manifest_index = index
+    return index
+
+
+def _index_project(index, node):
+    index['projects'].append(node)
+    index['projects_by_name'].setdefault(node.getAttribute('name'), []).append(node)
+    index['projects_by_path'].setdefault(node.getAttribute('path'), []).append(node)
+
+
+def _unindex_project(index, node):
+    for nodes in (index['projects'],
+                  index['projects_by_name'].get(node.getAttribute('name'), []),
+                  index['projects_by_path'].get(node.getAttribute('path'), [])):
+        if node in nodes:
+            nodes.remove(node)
+
+
+def _first_attached(nodes):
+    """
+    Returns the first node in `nodes` that is still part of the document
+    """
+    for node in nodes:
+        if node.parentNode is not None:
+            return node
+
+
 def rewrite_remotes(manifest, mapping_func, force_all=True):
     """
     Rewrite manifest remotes in place
@@ -79,6 +226,7 @@ def rewrite_remotes(manifest, mapping_func, force_all=True):
     If force_all is True, then it is an error for mapping_func to return None;
     a ValueError is raised in this case
     """
+    index = _query_index(manifest)
     for r in manifest.getElementsByTagName('remote'):
         m = mapping_func(r)
         if not m:
@@ -87,6 +235,10 @@ def rewrite_remotes(manifest, mapping_func, force_all=True):
             continue
 
         r.parentNode.replaceChild(m, r)
+        if m is not r:
+            nodes = index['remotes_by_name'][r.getAttribute('name')]
+            nodes.remove(r)
+            index['remotes_by_name'].setdefault(m.getAttribute('name'), []).append(m)
 
 
 def add_project(manifest, name, path, remote=None, revision=None):
@@ -103,6 +255,7 @@ def add_project(manifest, name, path, remote=None, revision=None):
         project.setAttribute('revision', revision)
 
     manifest.documentElement.appendChild(project)
+    _index_project(_query_index(manifest), project)
 
 
 def remove_project(manifest, name=None, path=None):
@@ -116,6 +269,7 @@ def remove_project(manifest, name=None, path=None):
     node = get_project(manifest, name, path)
     if node:
         node.parentNode.removeChild(node)
+        _unindex_project(_query_index(manifest), node)
     return node
 
 
@@ -127,21 +281,28 @@ def get_project(manifest, name=None, path=None):
     is returned.
     """
     assert name or path
-    for node in manifest.getElementsByTagName('project'):
-        if path is not None and node.getAttribute('path') == path:
-            return node
-        if node.getAttribute('name') == name:
+    index = _query_index(manifest)
+    by_name = by_path = None
+    if path is not None:
+        by_path = _first_attached(index['projects_by_path'].get(path, []))
+    if name is not None:
+        by_name = _first_attached(index['projects_by_name'].get(name, []))
+    if by_name is None or by_path is None:
+        return by_path or by_name
+    # Both matched; return whichever comes first in the manifest
+    for node in index['projects']:
+        if node is by_path or node is by_name:
             return node
 
 
 def get_remote(manifest, name):
-    for node in manifest.getElementsByTagName('remote'):
-        if node.getAttribute('name') == name:
-            return node
+    return _first_attached(_query_index(manifest)['remotes_by_name'].get(name, []))
 
 
 def get_default(manifest):
-    default = manifest.getElementsByTagName('default')[0]
+    default = _query_index(manifest)['default']
+    if default is None:
+        default = manifest.getElementsByTagName('default')[0]
     return default
 
 
@@ -177,10 +338,14 @@ def remove_group(manifest, group):
     """
     Removes all projects with groups=`group`
     """
+    index = _query_index(manifest)
     retval = []
-    for node in manifest.getElementsByTagName('project'):
+    for node in index['projects'][:]:
+        if node.parentNode is None:
+            continue
         if group in node.getAttribute('groups').split(","):
             node.parentNode.removeChild(node)
+            _unindex_project(index, node)
             retval.append(node)
     return retval
 
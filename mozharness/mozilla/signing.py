@@ -62,21 +62,27 @@ class SigningMixin(BaseSigningMixin):
 
 # MobileSigningMixin {{{1
 class MobileSigningMixin(AndroidSigningMixin, SigningMixin):
+    def query_android_signature_command(self, apk, script=None,
+                                        key_alias="nightly", tools_dir="tools/"):
+        """The command verify_android_signature() runs, from abs_work_dir."""
+        if script is None:
+            script = self.config.get('signature_verification_script')
+        return [script, "--tools-dir=%s" % tools_dir, "--%s" % key_alias,
+                "--apk=%s" % apk]
+
     def verify_android_signature(self, apk, script=None, key_alias="nightly",
                                  tools_dir="tools/", env=None):
         """Runs mjessome's android signature verification script.
         This currently doesn't check to see if the apk exists; you may want
         to do that before calling the method.
         """
-        c = self.config
         dirs = self.query_abs_dirs()
-        if script is None:
-            script = c.get('signature_verification_script')
         if env is None:
             env = self.query_env()
         return self.run_command(
-            [script, "--tools-dir=%s" % tools_dir, "--%s" % key_alias,
-             "--apk=%s" % apk],
+            self.query_android_signature_command(apk, script=script,
+                                                 key_alias=key_alias,
+                                                 tools_dir=tools_dir),
             cwd=dirs['abs_work_dir'],
             env=env,
             error_list=AndroidSignatureVerificationErrorList
@@ -11,14 +11,16 @@ https://hg.mozilla.org/build/tools/file/default/sut_tools
 '''
 
 import datetime
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import subprocess
 import sys
+import threading
 import time
 
 from mozharness.base.errors import ADBErrorList
-from mozharness.base.log import LogMixin, DEBUG
+from mozharness.base.log import LogMixin, DEBUG, ERROR, FATAL
 from mozharness.base.script import ScriptMixin
 
 
@@ -102,6 +104,14 @@ class ADBDeviceHandler(BaseDeviceHandler):
     def query_device_exe(self, exe_name):
         return self.query_exe(exe_name, exe_dict="device_exes")
 
+    def get_output_from_command(self, command, **kwargs):
+        # Several devices may be driven at once (see
+        # install_apps_on_devices()), so don't share temp files.
+        if self.device_id:
+            kwargs.setdefault('tmpfile_base_path',
+                              'tmpfile_%s' % re.sub(r'\W', '_', self.device_id))
+        return super(ADBDeviceHandler, self).get_output_from_command(command, **kwargs)
+
     def _query_config_device_id(self):
         return BaseDeviceHandler.query_device_id(self)
 
@@ -289,6 +299,48 @@ class ADBDeviceHandler(BaseDeviceHandler):
             time.sleep(interval)
         raise DeviceException("Remote Device Error: waiting for device timed out.")
 
+    def wait_for_boot_completed(self, timeout=None):
+        """Wait for the device to attach, with a blocking `adb
+        wait-for-device', and then for sys.boot_completed, polling every
+        second at first and backing off to every 10 seconds.
+
+        timeout defaults to config['device_boot_timeout'], or 300 seconds.
+        Returns True if the device finished booting in time.
+        """
+        if timeout is None:
+            timeout = self.config.get('device_boot_timeout', 300)
+        device_id = self.query_device_id()
+        adb = self.query_exe('adb')
+        deadline = time.time() + timeout
+        self.info("Waiting for %s to boot..." % device_id)
+        with open(os.devnull, 'w') as devnull:
+            proc = subprocess.Popen([adb, "-s", device_id, "wait-for-device"],
+                                    stdout=devnull, stderr=subprocess.STDOUT)
+            timer = threading.Timer(timeout, proc.kill)
+            timer.start()
+            try:
+                proc.wait()
+            finally:
+                timer.cancel()
+        if proc.returncode != 0:
+            self.warning("%s didn't attach within %d seconds." % (device_id, timeout))
+            return False
+        interval = 1
+        while True:
+            completed = self.get_output_from_command(
+                [adb, "-s", device_id, "shell", "getprop", "sys.boot_completed"],
+                silent=True, ignore_errors=True)
+            if str(completed).strip() == '1':
+                self.info("%s booted after %d seconds." %
+                          (device_id, timeout - (deadline - time.time())))
+                return True
+            if time.time() + interval > deadline:
+                self.warning("%s didn't finish booting within %d seconds." %
+                             (device_id, timeout))
+                return False
+            time.sleep(interval)
+            interval = min(interval * 2, 10)
+
     def query_device_time(self):
         device_id = self.query_device_id()
         adb = self.query_exe('adb')
@@ -337,8 +389,16 @@ class ADBDeviceHandler(BaseDeviceHandler):
                 return False
         return True
 
-    def install_app(self, file_path):
+    def install_app(self, file_path, package_name=None, error_level=FATAL):
+        """Install the apk file_path, replacing any installed package_name,
+        which defaults to config['device_package_name'].
+
+        Returns True on success; otherwise logs at error_level and returns
+        False.
+        """
         c = self.config
+        if package_name is None:
+            package_name = c.get('device_package_name')
         device_id = self.query_device_id()
         adb = self.query_exe('adb')
         uptime = self.query_device_exe('uptime')
@@ -375,36 +435,39 @@ class ADBDeviceHandler(BaseDeviceHandler):
             self.run_command([adb, "-s", device_id, "install", '-r',
                               file_path],
                              error_list=ADBErrorList)
-        else:
+            return True
+        output = self.get_output_from_command([adb, "-s", device_id,
+                                               "shell",
+                                               "ls -d /data/data/%s" %
+                                               package_name])
+        if output is not None and "No such file" not in output:
+            self.run_command([adb, "-s", device_id, "uninstall",
+                              package_name],
+                             error_list=ADBErrorList)
+
+        # A slow-booting device may not allow installs, temporarily.
+        # Retry for a while if not immediately successful.
+        # Note that "adb install" typically writes status messages
+        # to stderr and the adb return code may not differentiate
+        # successful installations from failures; instead we check
+        # the command output.
+        def _install():
             output = self.get_output_from_command([adb, "-s", device_id,
-                                                   "shell",
-                                                   "ls -d /data/data/%s" %
-                                                   c['device_package_name']])
-            if output is not None and "No such file" not in output:
-                self.run_command([adb, "-s", device_id, "uninstall",
-                                  c['device_package_name']],
-                                 error_list=ADBErrorList)
-            # A slow-booting device may not allow installs, temporarily.
-            # Wait up to a few minutes if not immediately successful.
-            # Note that "adb install" typically writes status messages
-            # to stderr and the adb return code may not differentiate
-            # successful installations from failures; instead we check
-            # the command output.
-            install_complete = False
-            retries = 0
-            while retries < 6:
-                output = self.get_output_from_command([adb, "-s", device_id,
-                                                       "install", '-r',
-                                                       file_path],
-                                                       ignore_errors=True)
-                if output and output.lower().find("success") >= 0:
-                    install_complete = True
-                    break
-                self.warning("Failed to install %s" % file_path)
-                time.sleep(30)
-                retries = retries + 1
-            if not install_complete:
-                self.fatal("Failed to install %s!" % file_path)
+                                                   "install", '-r',
+                                                   file_path],
+                                                  ignore_errors=True)
+            if not output or output.lower().find("success") < 0:
+                raise DeviceException("Failed to install %s" % file_path)
+
+        status = self.retry(_install, attempts=6,
+                            sleeptime=c.get('device_install_sleeptime', 5),
+                            max_sleeptime=30,
+                            jitter=c.get('retry_jitter', True),
+                            retry_exceptions=(DeviceException, ),
+                            error_level=error_level,
+                            error_message="Failed to install %s on %s!" %
+                            (file_path.replace('%', '%%'), device_id))
+        return status != -1
 
     def uninstall_app(self, package_name, package_root="/data/data",
                       error_level="error"):
@@ -446,6 +509,48 @@ class ADBDeviceHandler(BaseDeviceHandler):
             self.debug("%s file doesn't exist; skipping." % hosts_file)
 
 
+# install_apps_on_devices {{{1
+def install_apps_on_devices(device_apps, num_threads=None):
+    """Wait for each device to boot and install its apps, on all the
+    devices at once.
+
+    device_apps is a list of (ADBDeviceHandler, [(file_path, package_name),
+    ...]).  If a device doesn't report that it's booted, installing is
+    still attempted.
+
+    Returns a dict of device_id to {'booted': bool, 'installed': [...],
+    'failed': [...], 'seconds': ...}.
+    """
+    def _install(device_app):
+        dh, apps = device_app
+        start = time.time()
+        result = {'booted': False, 'installed': [], 'failed': []}
+        try:
+            result['booted'] = dh.wait_for_boot_completed()
+            for file_path, package_name in apps:
+                dh.info("Installing %s on %s" % (file_path, dh.device_id))
+                if dh.install_app(file_path, package_name=package_name,
+                                  error_level=ERROR):
+                    result['installed'].append(file_path)
+                else:
+                    result['failed'].append(file_path)
+        except SystemExit:
+            # fatal() from a pool thread; count what's left as failed.
+            result['failed'].extend([f for f, _ in apps
+                                     if f not in result['installed'] + result['failed']])
+        result['seconds'] = time.time() - start
+        return dh.device_id, result
+
+    if not device_apps:
+        return {}
+    pool = ThreadPool(num_threads or len(device_apps))
+    try:
+        return dict(pool.map(_install, device_apps))
+    finally:
+        pool.close()
+        pool.join()
+
+
 # SUTDeviceHandler {{{1
 class SUTDeviceHandler(BaseDeviceHandler):
     def __init__(self, **kwargs):
@@ -9,8 +9,6 @@ import copy
 import os
 import platform
 import re
-import urllib2
-import getpass
 
 from mozharness.base.config import ReadOnlyDict, parse_config_file
 from mozharness.base.errors import BaseErrorList
@@ -221,6 +219,8 @@ class TestingMixin(VirtualenvMixin, BuildbotMixin, ResourceMonitoringMixin, Tool
         This function helps dealing with downloading files while outside
         of the releng network.
         '''
+        import urllib2
+
         # Code based on http://code.activestate.com/recipes/305288-http-basic-authentication
         def _urlopen_basic_auth(url, **kwargs):
             self.info("We want to download this file %s" % url)
@@ -6,21 +6,25 @@
 # ***** END LICENSE BLOCK *****
 
 import copy
+from multiprocessing.pool import ThreadPool
 import os
+import Queue
 import sys
 import signal
 import socket
 import subprocess
 import telnetlib
+import threading
 import time
 import tempfile
+import traceback
 
 # load modules from parent dir
 sys.path.insert(1, os.path.dirname(sys.path[0]))
 
 from mozprocess import ProcessHandler
 
-from mozharness.base.log import FATAL
+from mozharness.base.log import BufferedLog, ERROR, FATAL
 from mozharness.base.script import BaseScript, PostScriptRun
 from mozharness.base.vcs.vcsbase import VCSMixin
 from mozharness.mozilla.blob_upload import BlobUploadMixin, blobupload_config_options
@@ -29,7 +33,7 @@ from mozharness.mozilla.buildbot import TBPL_WORST_LEVEL_TUPLE
 from mozharness.mozilla.testing.testbase import TestingMixin, testing_config_options
 from mozharness.mozilla.testing.unittest import EmulatorMixin
 
-from mozharness.mozilla.testing.device import ADBDeviceHandler
+from mozharness.mozilla.testing.device import ADBDeviceHandler, install_apps_on_devices
 
 
 class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, EmulatorMixin, VCSMixin, BaseScript, MozbaseMixin):
@@ -115,6 +119,8 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, EmulatorMixin, VCSMixin
         self.host_utils_url = c.get('host_utils_url')
         self.minidump_stackwalk_path = c.get("minidump_stackwalk_path")
         self.emulators = c.get('emulators')
+        self.emulator_procs = []
+        self.logcat_procs = []
         self.test_suite_definitions = c['test_suite_definitions']
         self.test_suites = c.get('test_suites')
         for suite in self.test_suites:
@@ -235,6 +241,8 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, EmulatorMixin, VCSMixin
         tmp_stdout = open(tmp_file.name, 'w')
         self.info("Created temp file %s." % tmp_file.name)
         self.info("Trying to start the emulator with this command: %s" % ' '.join(command))
+        # This stays in our process group, so that it goes away with us if
+        # buildbot kills the job.
         proc = subprocess.Popen(command, stdout=tmp_stdout, stderr=tmp_stdout, env=env)
         return {
             "process": proc,
@@ -371,8 +379,116 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, EmulatorMixin, VCSMixin
                 self.info("Killing pid %d." % pid)
                 os.kill(pid, signal.SIGKILL)
 
+    def _kill_emulator(self, emulator_index):
+        proc = self.emulator_procs[emulator_index]["process"]
+        self.info("Killing emulator %s (pid %d)." %
+                  (self.emulators[emulator_index]["name"], proc.pid))
+        # The emulator wrapper may have started the emulator binary as a
+        # child, so kill that too.
+        pids = [proc.pid]
+        p = subprocess.Popen(['ps', '-A', '-o', 'pid=,ppid='], stdout=subprocess.PIPE)
+        out, err = p.communicate()
+        for line in out.splitlines():
+            pid, ppid = [int(x) for x in line.split()]
+            if ppid == proc.pid:
+                pids.append(pid)
+        for pid in pids:
+            self.info("Killing pid %d." % pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError, e:
+                self.info("Unable to kill pid %d: %s" % (pid, str(e)))
+        proc.wait()
+
+    def _run_on_emulators(self, func):
+        """
+        Call func(emulator_index) for each emulator we need, all at once,
+        and return the results in order.  A fatal() in func returns None.
+        """
+        def _run(emulator_index):
+            try:
+                return func(emulator_index)
+            except SystemExit:
+                return None
+
+        num_emulators = len(self.test_suites)
+        pool = ThreadPool(num_emulators or 1)
+        try:
+            return pool.map(_run, range(num_emulators))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _start_emulator(self, emulator_index):
+        """
+        Launch an emulator and redirect its SUT ports, if needed.  If unable
+        to redirect the SUT ports, kill the emulator and try starting it
+        again.  Returns True if the emulator started.
+        """
+        emulator = self.emulators[emulator_index]
+        attempts = 0
+        while attempts < 3:
+            if attempts > 0:
+                self.info("Sleeping 30 seconds before retrying %s" % emulator["name"])
+                time.sleep(30)
+            attempts += 1
+            self.info('Attempt #%d to launch %s...' % (attempts, emulator["name"]))
+            self.emulator_procs[emulator_index] = self._launch_emulator(emulator_index)
+            if self.config["device_manager"] != "sut":
+                return True
+            if self._redirectSUT(emulator_index):
+                self.info("%s: %s; sut port: %s/%s" %
+                          (emulator["name"], emulator["emulator_port"], emulator["sut_port1"], emulator["sut_port2"]))
+                return True
+            self._dump_emulator_log(emulator_index)
+            self._kill_emulator(emulator_index)
+        return False
+
+    def _start_logcat(self, emulator_index):
+        """
+        Start logcat for an emulator. The adb process runs until the
+        emulator is killed, or stop_emulators() stops it. Output is
+        written directly to the blobber upload directory so that it is
+        uploaded automatically at the end of the job.
+        """
+        emulator = self.emulators[emulator_index]
+        logcat_filename = 'logcat-%s.log' % emulator["device_id"]
+        logcat_path = os.path.join(self.abs_dirs['abs_blob_upload_dir'], logcat_filename)
+        logcat_cmd = [self.adb_path, '-s', emulator["device_id"], 'logcat', '-v', 'time',
+                      'Trace:S', 'StrictMode:S', 'ExchangeService:S']
+        self.info('%s > %s' % (subprocess.list2cmdline(logcat_cmd), logcat_path))
+        with open(logcat_path, 'w') as logcat_file:
+            self.logcat_procs[emulator_index] = subprocess.Popen(
+                logcat_cmd, stdout=logcat_file, stderr=subprocess.STDOUT)
+
+    def _prepare_emulator(self, emulator_index):
+        """
+        Verify that we can communicate with an emulator, start its logcat,
+        and create the /data/anr directory on its image.
+        """
+        emulator = self.emulators[emulator_index]
+        self._check_emulator(emulator)
+        self._start_logcat(emulator_index)
+        mkdir_cmd = [self.adb_path, '-s', emulator["device_id"], 'shell', 'mkdir', '/data/anr']
+        p = subprocess.Popen(mkdir_cmd, stdout=subprocess.PIPE)
+        out, err = p.communicate()
+        self.info('%s:\n%s\n%s' % (mkdir_cmd, out, err))
+
+    def _stop_logcats(self):
+        for emulator_index, proc in enumerate(self.logcat_procs):
+            if proc is None:
+                continue
+            if proc.poll() is not None:
+                self.warning("logcat for %s exited early with %d" %
+                             (self.emulators[emulator_index]["name"], proc.returncode))
+            else:
+                proc.terminate()
+                proc.wait()
+        self.logcat_procs = []
+
     @PostScriptRun
     def _post_script(self):
+        self._stop_logcats()
         self._kill_processes(self.config["emulator_process_name"])
 
     # XXX: This and android_panda.py's function might make sense to take higher up
@@ -464,11 +580,10 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, EmulatorMixin, VCSMixin
 
         We return a dictionary with the following information:
          - subprocess object that is running the test on the emulator
-         - the filename where the stdout is going to
-         - the stdout where the output is going to
+         - the output parser for the suite, which logs to
+         - a BufferedLog, so the suite's log can be written in one piece
          - the suite name that is associated
         """
-        dirs = self.query_abs_dirs()
         cmd = self._build_command(self.emulators[emulator_index], suite_name)
         try:
             cwd = self._query_tests_dir(suite_name)
@@ -481,18 +596,38 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, EmulatorMixin, VCSMixin
         env['MOZ_UPLOAD_DIR'] = self.query_abs_dirs()['abs_blob_upload_dir']
         env['MINIDUMP_SAVE_PATH'] = self.query_abs_dirs()['abs_blob_upload_dir']
 
+        buffered_log = BufferedLog(self.log_obj)
+        parser = self.get_test_output_parser(
+            self.test_suite_definitions[suite_name]["category"],
+            config=self.config,
+            log_obj=buffered_log,
+            error_list=self.error_list)
         self.info("Running on %s the command %s" % (self.emulators[emulator_index]["name"], subprocess.list2cmdline(cmd)))
-        tmp_file = tempfile.NamedTemporaryFile(mode='w')
-        tmp_stdout = open(tmp_file.name, 'w')
-        self.info("Created temp file %s." % tmp_file.name)
         return {
-            "process": subprocess.Popen(cmd, cwd=cwd, stdout=tmp_stdout, stderr=tmp_stdout, env=env),
-            "tmp_file": tmp_file,
-            "tmp_stdout": tmp_stdout,
+            "process": subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env),
+            "parser": parser,
+            "buffered_log": buffered_log,
             "suite_name": suite_name,
             "emulator_index": emulator_index
         }
 
+    def _parse_test_output(self, p, finished):
+        """
+        Parse a suite's output as it arrives, then put the suite on the
+        `finished` queue as soon as it exits.
+        """
+        try:
+            for line in iter(p["process"].stdout.readline, ''):
+                p["parser"].parse_single_line(line.rstrip('\r\n'))
+        except Exception:
+            p["buffered_log"].log_message("Error parsing the output of %s:\n%s" %
+                                          (p["suite_name"], traceback.format_exc()),
+                                          level=ERROR)
+        finally:
+            p["process"].stdout.close()
+            p["process"].wait()
+            finished.put(p)
+
     def _tooltool_fetch(self, url):
         c = self.config
         dirs = self.query_abs_dirs()
@@ -592,72 +727,41 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, EmulatorMixin, VCSMixin
                 os.symlink(libfile, linkfile)
                 break
 
-        attempts = 0
-        redirect_failed = True
-        # Launch the required emulators and redirect the SUT ports for each. If unable
-        # to redirect the SUT ports, kill the emulators and try starting them again.
+        # Launch the required emulators and redirect the SUT ports for each,
+        # all at once. If unable to redirect an emulator's SUT ports, kill
+        # that emulator and try starting it again.
         # The wait-and-retry logic is necessary because the emulators intermittently fail
         # to respond to telnet connections immediately after startup: bug 949740. In this
         # case, the emulator log shows "ioctl(KVM_CREATE_VM) failed: Interrupted system call".
         # We do not know how to avoid this error and the only way we have found to
         # recover is to kill the emulator and start again.
-        while attempts < 3 and redirect_failed:
-            if attempts > 0:
-                self.info("Sleeping 30 seconds before retry")
-                time.sleep(30)
-            attempts += 1
-            self.info('Attempt #%d to launch emulators...' % attempts)
-            self._dump_host_state()
-            self.emulator_procs = []
-            emulator_index = 0
-            redirect_failed = False
-            for test in self.test_suites:
-                emulator_proc = self._launch_emulator(emulator_index)
-                self.emulator_procs.append(emulator_proc)
-                if self.config["device_manager"] == "sut":
-                    if self._redirectSUT(emulator_index):
-                        emulator = self.emulators[emulator_index]
-                        self.info("%s: %s; sut port: %s/%s" %
-                                  (emulator["name"], emulator["emulator_port"], emulator["sut_port1"], emulator["sut_port2"]))
-                        emulator_index += 1
-                    else:
-                        self._dump_emulator_log(emulator_index)
-                        self._kill_processes(self.config["emulator_process_name"])
-                        redirect_failed = True
-                        break
-        if redirect_failed:
-            self.fatal('We have not been able to establish a telnet connection with the emulator')
-
-        # Verify that we can communicate with each emulator
-        emulator_index = 0
-        for test in self.test_suites:
-            emulator = self.emulators[emulator_index]
-            emulator_index += 1
-            self._check_emulator(emulator)
-        # Start logcat for each emulator. Each adb process runs until the
-        # corresponding emulator is killed. Output is written directly to
-        # the blobber upload directory so that it is uploaded automatically
-        # at the end of the job.
+        self._dump_host_state()
+        self.query_env()
         self.mkdir_p(self.abs_dirs['abs_blob_upload_dir'])
-        emulator_index = 0
-        for test in self.test_suites:
-            emulator = self.emulators[emulator_index]
-            emulator_index += 1
-            logcat_filename = 'logcat-%s.log' % emulator["device_id"]
-            logcat_path = os.path.join(self.abs_dirs['abs_blob_upload_dir'], logcat_filename)
-            logcat_cmd = '%s -s %s logcat -v time Trace:S StrictMode:S ExchangeService:S > %s &' % \
-                (self.adb_path, emulator["device_id"], logcat_path)
-            self.info(logcat_cmd)
-            os.system(logcat_cmd)
-        # Create the /data/anr directory on each emulator image.
-        emulator_index = 0
-        for test in self.test_suites:
-            emulator = self.emulators[emulator_index]
-            emulator_index += 1
-            mkdir_cmd = [self.adb_path, '-s', emulator["device_id"], 'shell', 'mkdir', '/data/anr']
-            p = subprocess.Popen(mkdir_cmd, stdout=subprocess.PIPE)
-            out, err = p.communicate()
-            self.info('%s:\n%s\n%s' % (mkdir_cmd, out, err))
+        self.emulator_procs = [None] * len(self.test_suites)
+        self.logcat_procs = [None] * len(self.test_suites)
+        start_time = time.time()
+
+        def _start(emulator_index):
+            if self._start_emulator(emulator_index):
+                return time.time() - start_time
+        started_times = self._run_on_emulators(_start)
+        failed = [self.emulators[i]["name"] for i, t in enumerate(started_times) if t is None]
+        if failed:
+            self.fatal('We have not been able to establish a telnet connection with %s' %
+                       ', '.join(failed))
+
+        # Verify that we can communicate with each emulator, and get them ready.
+        def _prepare(emulator_index):
+            self._prepare_emulator(emulator_index)
+            return time.time() - start_time
+        ready_times = self._run_on_emulators(_prepare)
+        for emulator_index, ready_time in enumerate(ready_times):
+            if ready_time is None:
+                self.fatal("Unable to prepare %s!" % self.emulators[emulator_index]["name"])
+            self.info("%s: started after %d seconds, ready after %d seconds" %
+                      (self.emulators[emulator_index]["name"],
+                       started_times[emulator_index], ready_time))
 
     def download_and_extract(self):
         # This will download and extract the fennec.apk and tests.zip
@@ -676,6 +780,8 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, EmulatorMixin, VCSMixin
         assert self.installer_path is not None, \
             "Either add installer_path to the config or use --installer-path."
 
+        # Wait for all the emulators to boot and install on them at once.
+        device_apps = []
         emulator_index = 0
         for suite_name in self.test_suites:
             emulator = self.emulators[emulator_index]
@@ -692,88 +798,86 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, EmulatorMixin, VCSMixin
             dh = ADBDeviceHandler(config=config, log_obj=self.log_obj, script_obj=self)
             dh.device_id = emulator['device_id']
 
-            # Wait for Android to finish booting
-            completed = None
-            retries = 0
-            while retries < 30:
-                completed = self.get_output_from_command([self.adb_path,
-                    "-s", emulator['device_id'], "shell",
-                    "getprop", "sys.boot_completed"])
-                if completed == '1':
-                    break
-                time.sleep(10)
-                retries = retries + 1
-            if completed != '1':
-                self.warning('Retries exhausted waiting for Android boot.')
-
-            # Install Fennec
-            self.info("Installing Fennec for %s" % emulator["name"])
-            dh.install_app(self.installer_path)
-
+            apps = [(self.installer_path, self._query_package_name())]
             # Install the robocop apk if required
             if suite_name.startswith('robocop'):
-                self.info("Installing Robocop for %s" % emulator["name"])
-                config['device_package_name'] = self.config["robocop_package_name"]
-                dh.install_app(self.robocop_path)
-
-            self.info("Finished installing apps for %s" % emulator["name"])
+                apps.append((self.robocop_path, self.config["robocop_package_name"]))
+            device_apps.append((dh, apps))
+
+        self.info("Installing apps on %d emulator(s)" % len(device_apps))
+        results = install_apps_on_devices(device_apps)
+
+        failed = []
+        for emulator in self.emulators[:len(device_apps)]:
+            result = results[emulator["device_id"]]
+            if not result['booted']:
+                self.warning('%s did not report that it finished booting.' % emulator["name"])
+            self.info("%s: installed %s in %d seconds" %
+                      (emulator["name"], ', '.join(result['installed']) or 'nothing',
+                       result['seconds']))
+            if result['failed']:
+                self.error("%s: failed to install %s" %
+                           (emulator["name"], ', '.join(result['failed'])))
+                failed.append(emulator["name"])
+        if failed:
+            self.fatal("Failed to install apps on %s!" % ', '.join(failed))
 
     def run_tests(self):
         """
         Run the tests
         """
+        finished = Queue.Queue()
         procs = []
 
         emulator_index = 0
         for suite_name in self.test_suites:
-            procs.append(self._trigger_test(suite_name, emulator_index))
+            p = self._trigger_test(suite_name, emulator_index)
+            p["thread"] = threading.Thread(target=self._parse_test_output,
+                                           args=(p, finished))
+            p["thread"].daemon = True
+            p["thread"].start()
+            procs.append(p)
             emulator_index += 1
 
         joint_tbpl_status = None
         joint_log_level = None
         start_time = int(time.time())
-        while True:
-            for p in procs:
-                emulator_index = p["emulator_index"]
-                return_code = p["process"].poll()
-                if return_code is not None:
-                    suite_name = p["suite_name"]
-                    # To make reading the log of the suite not mix with the previous line
-                    sys.stdout.write('\n')
-                    self.info("##### %s log begins" % p["suite_name"])
-                    # Let's close the stdout
-                    p["tmp_stdout"].close()
-                    # Let's read the file that now has the output
-                    output = self.read_from_file(p["tmp_file"].name, verbose=False)
-                    # Let's parse the output (which also prints it)
-                    # and determine what the results should be
-                    parser = self.get_test_output_parser(
-                        self.test_suite_definitions[p["suite_name"]]["category"],
-                        config=self.config,
-                        log_obj=self.log_obj,
-                        error_list=self.error_list)
-                    for line in output.splitlines():
-                        parser.parse_single_line(line)
-
-                    # After parsing each line we should know what the summary for this suite should be
-                    tbpl_status, log_level = parser.evaluate_parser(0)
-                    parser.append_tinderboxprint_line(p["suite_name"])
-                    # After running all jobs we will report the worst status of all emulator runs
-                    joint_tbpl_status = self.worst_level(tbpl_status, joint_tbpl_status, TBPL_WORST_LEVEL_TUPLE)
-                    joint_log_level = self.worst_level(log_level, joint_log_level)
-
-                    self.info("##### %s log ends" % p["suite_name"])
-                    self._dump_emulator_log(emulator_index)
-                    procs.remove(p)
-            if procs == []:
-                break
-            else:
+        running = list(procs)
+        while running:
+            try:
+                # Wake up now and then to report on the suites still running
+                p = finished.get(timeout=30)
+            except Queue.Empty:
+                for p in running:
+                    num_errors = p["parser"].num_errors
+                    if num_errors and num_errors != p.get("reported_errors"):
+                        self.info("%s has hit %d error(s) so far" %
+                                  (p["suite_name"], num_errors))
+                        p["reported_errors"] = num_errors
                 # Every 5 minutes let's print something to stdout
                 # so buildbot won't kill the process due to lack of output
                 if int(time.time()) - start_time > 5 * 60:
                     self.info('#')
                     start_time = int(time.time())
-                time.sleep(30)
+                continue
+
+            running.remove(p)
+            p["thread"].join()
+            parser = p["parser"]
+            # To make reading the log of the suite not mix with the previous line
+            sys.stdout.write('\n')
+            self.info("##### %s log begins" % p["suite_name"])
+            # After parsing each line we should know what the summary for this suite should be
+            tbpl_status, log_level = parser.evaluate_parser(0)
+            parser.append_tinderboxprint_line(p["suite_name"])
+            p["buffered_log"].flush()
+            p["buffered_log"].close()
+            # After running all jobs we will report the worst status of all emulator runs
+            joint_tbpl_status = self.worst_level(tbpl_status, joint_tbpl_status, TBPL_WORST_LEVEL_TUPLE)
+            joint_log_level = self.worst_level(log_level, joint_log_level)
+
+            self.info("##### %s log ends" % p["suite_name"])
+            self._dump_emulator_log(p["emulator_index"])
 
         self.buildbot_status(joint_tbpl_status, level=joint_log_level)
 
@@ -781,11 +885,8 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, EmulatorMixin, VCSMixin
         '''
         Report emulator health, then make sure that every emulator has been stopped
         '''
-        emulator_index = 0
-        for test in self.test_suites:
-            emulator = self.emulators[emulator_index]
-            emulator_index += 1
-            self._check_emulator(emulator)
+        self._run_on_emulators(lambda i: self._check_emulator(self.emulators[i]))
+        self._stop_logcats()
         self._kill_processes(self.config["emulator_process_name"])
 
 if __name__ == '__main__':
@@ -9,7 +9,6 @@ import sys
 import os
 import glob
 import re
-import tempfile
 from datetime import datetime
 import urlparse
 import multiprocessing
@@ -420,11 +419,31 @@ class B2GBuild(LocalesMixin, PurgeMixin,
                                                       require_answer=self.config.get('require_git_rev', True), attempts=120)
         return '  <project name="%s" path="%s" remote="mozillaorg" revision="%s"/>' % (git_repo.replace(git_base_url, ''), local_path, l10n_git_sha)
 
+    def _prefetch_locale_git_revisions(self, manifest_config):
+        """ Map all the gaia and gecko l10n revisions we're about to need in
+        one go, so _generate_git_locale_manifest() hits the mapper cache.
+        """
+        revisions = []
+        if self.gaia_locale_revisions and \
+                self.query_do_translate_hg_to_git(gecko_config_key='gaia_l10n_git_root'):
+            revisions.extend([r['revision'] for r in self.gaia_locale_revisions.values()])
+        if self.gecko_locale_revisions and \
+                self.query_do_translate_hg_to_git(gecko_config_key='gecko_l10n_git_root'):
+            revisions.extend([r['revision'] for r in self.gecko_locale_revisions.values()])
+        if revisions:
+            # increase timeout from 15m to 60m until bug 1044515 is resolved (attempts = 120)
+            self.query_mapper_revisions(manifest_config['translate_base_url'], 'l10n', 'git',
+                                        revisions, project_name="l10n",
+                                        mapfile_url=manifest_config.get('translate_mapfile_url'),
+                                        require_answer=self.config.get('require_git_rev', True),
+                                        attempts=120)
+
     def _generate_locale_manifest(self, git_base_url="https://git.mozilla.org/release/"):
         """ Add the locales to the source manifest.
         """
         manifest_config = self.config.get('manifest', {})
         locale_manifest = []
+        self._prefetch_locale_git_revisions(manifest_config)
         if self.gaia_locale_revisions:
             gaia_l10n_git_root = None
             if self.query_do_translate_hg_to_git(gecko_config_key='gaia_l10n_git_root'):
@@ -656,28 +675,19 @@ class B2GBuild(LocalesMixin, PurgeMixin,
         if files:
             zip_name = os.path.join(dirs['work_dir'], self.config['target'] + ".zip")
             self.info("creating %s" % zip_name)
-            tmpdir = tempfile.mkdtemp()
-            try:
-                zip_dir = os.path.join(tmpdir, 'b2g-distro')
-                self.mkdir_p(zip_dir)
-                for f, target in files:
-                    if target is None:
-                        dst = os.path.join(zip_dir, os.path.basename(f))
-                    elif target.endswith('/'):
-                        dst = os.path.join(zip_dir, target, os.path.basename(f))
-                    else:
-                        dst = os.path.join(zip_dir, target)
-                    if not os.path.exists(os.path.dirname(dst)):
-                        self.mkdir_p(os.path.dirname(dst))
-                    self.copyfile(f, dst, copystat=True)
-
-                cmd = ['zip', '-r', '-9', '-u', zip_name, 'b2g-distro']
-                if self.run_command(cmd, cwd=tmpdir) != 0:
-                    self.fatal("problem zipping up files")
-                self.copy_to_upload_dir(zip_name)
-            finally:
-                self.debug("removing %s" % tmpdir)
-                self.rmtree(tmpdir)
+            members = []
+            for f, target in files:
+                if target is None:
+                    arcname = os.path.basename(f)
+                elif target.endswith('/'):
+                    arcname = os.path.join(target, os.path.basename(f))
+                else:
+                    arcname = target
+                members.append((f, os.path.join('b2g-distro', arcname)))
+            # Level 9, as with `zip -9'
+            if self.zip_files(zip_name, members, level=9):
+                self.fatal("problem zipping up files")
+            self.copy_to_upload_dir(zip_name)
 
         public_files = []
         public_upload_patterns = []
@@ -686,8 +696,10 @@ class B2GBuild(LocalesMixin, PurgeMixin,
         if gecko_config.get('package_gaia', True):
             zip_name = os.path.join(dirs['work_dir'], "gaia.zip")
             self.info("creating %s" % zip_name)
-            cmd = ['zip', '-r', '-9', '-u', zip_name, 'gaia/profile']
-            if self.run_command(cmd, cwd=dirs['work_dir']) != 0:
+            if self.zip_files(zip_name,
+                              [(os.path.join(dirs['work_dir'], 'gaia', 'profile'),
+                                'gaia/profile')],
+                              level=9):
                 self.fatal("problem zipping up gaia")
             self.copy_to_upload_dir(zip_name)
             if public_upload_patterns:
@@ -707,15 +719,21 @@ class B2GBuild(LocalesMixin, PurgeMixin,
                 if base_pattern in public_upload_patterns:
                     public_files.append(f)
 
+        if self.query_is_nightly():
+            # Compress the images all at once, replacing them with .bz2
+            # files like `bzip2 -f' would.
+            images = sorted(set(f for f in files + public_files
+                                if f.endswith(".img") and os.path.exists(f)))
+            if images:
+                self.info("compressing %s" % ", ".join(images))
+                self.compress_files([(f, "%s.bz2" % f) for f in images],
+                                    compression='bzip2', remove_src=True)
+
         for base_f in files + public_files:
             f = base_f
             if f.endswith(".img"):
                 if self.query_is_nightly():
-                    # Compress it
-                    if os.path.exists(f):
-                        self.info("compressing %s" % f)
-                        self.run_command(["bzip2", "-f", f])
-                    elif not os.path.exists("%s.bz2" % f):
+                    if not os.path.exists("%s.bz2" % f):
                         self.error("%s doesn't exist to bzip2!" % f)
                         self.return_code = 2
                         continue
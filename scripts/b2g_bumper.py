@@ -19,6 +19,7 @@ import os
 import sys
 from multiprocessing.pool import ThreadPool
 import subprocess
+import threading
 import time
 from urlparse import urlparse
 try:
@@ -48,6 +49,11 @@ class B2GBumper(VCSScript, MapperMixin):
             'dest': 'device_override',
             'help': 'specific device to process',
         }],
+        [['--git-ref-cache-ttl'], {
+            'dest': 'git_ref_cache_ttl',
+            'type': 'int',
+            'help': 'seconds before an imported git ref cache entry is looked up again (default 3600)',
+        }],
     ]
 
     def __init__(self, require_config_file=True):
@@ -82,8 +88,10 @@ class B2GBumper(VCSScript, MapperMixin):
         # Mapping of device name to manifest
         self.device_manifests = {}
 
-        # Cache of "%s:%s" % (remote url, refname) to revision hashes
+        # Cache of "%s:%s" % (remote url, refname) to revision hashes, and
+        # when each was looked up
         self._git_ref_cache = {}
+        self._git_ref_cache_times = {}
 
         # File location for persisting _git_ref_cache dictionary above as a json file
         self.git_ref_cache_file = self.config.get('git_ref_cache', os.path.join(self.query_abs_dirs()['abs_work_dir'], 'git_ref_cache.json'))
@@ -145,39 +153,117 @@ class B2GBumper(VCSScript, MapperMixin):
             return m
         repo_manifest.rewrite_remotes(manifest, mapping_func)
 
-    def resolve_git_ref(self, remote_url, revision):
-        cache_key = "%s:%s" % (remote_url, revision)
-        cmd = ['git', 'ls-remote', remote_url, revision]
+    def query_git_refs(self, remote_url, refs=None):
+        """Returns {refname: revision} for remote_url from a single
+        git ls-remote, or None if that keeps failing.  If `refs' are all
+        heads or tags, only heads or tags are listed.
+        """
+        cmd = ['git', 'ls-remote']
+        if refs and all(r.startswith(('refs/heads/', 'refs/tags/')) for r in refs):
+            if [r for r in refs if r.startswith('refs/heads/')]:
+                cmd.append('--heads')
+            if [r for r in refs if r.startswith('refs/tags/')]:
+                cmd.append('--tags')
+        cmd.append(remote_url)
         self.debug("Running %s" % cmd)
         # Retry this a few times, in case there are network errors or somesuch
         max_retries = 5
         for _ in range(max_retries):
             proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                                     stderr=subprocess.STDOUT)
-            if proc.wait() != 0:
+            output = proc.communicate()[0]
+            if proc.returncode != 0:
                 self.warning("Returned %i - sleeping and retrying" %
                              proc.returncode)
-                self.warning("%s - got output: %s" % (cache_key, proc.stdout.read()))
+                self.warning("%s - got output: %s" % (remote_url, output))
                 time.sleep(30)
                 continue
-            output = proc.stdout.read()
-            self.info("%s - got output: %s" % (cache_key, output))
-            try:
-                abs_revision = output.split()[0].strip()
-                self._git_ref_cache[cache_key] = abs_revision
-                return abs_revision
-            except IndexError:
-                # Couldn't split the output properly
-                self.warning("no output from: git ls-remote %s %s" % (remote_url, revision))
-                return None
+            git_refs = {}
+            for line in output.splitlines():
+                parts = line.split()
+                if len(parts) == 2:
+                    git_refs.setdefault(parts[1], parts[0])
+            self.info("%s - got %d refs" % (remote_url, len(git_refs)))
+            return git_refs
         return None
 
-    def resolve_refs(self, manifest):
-        worker_pool = ThreadPool(20)
-        lookup_threads_by_project = {}
-        lookup_threads_by_parameters = {}
+    def _match_git_ref(self, git_refs, revision):
+        """Return the revision that `git ls-remote <remote> <revision>'
+        would have listed first from git_refs: that of the refname
+        revision itself, or else of the first refname that ends in
+        '/<revision>' (e.g. refs/heads/b2g/v2.0 for b2g/v2.0).  Returns
+        None if nothing matches.
+        """
+        if revision in git_refs:
+            return git_refs[revision]
+        for refname in sorted(git_refs):
+            if refname.endswith('/' + revision):
+                return git_refs[refname]
+        return None
+
+    def resolve_git_refs(self, lookups):
+        """Look up each (remote_url, refname) in lookups that isn't in
+        _git_ref_cache already, with one git ls-remote per remote_url.
+        At most config['git_ls_remote_threads'] of those run at once, and
+        at most config['git_ls_remote_threads_per_host'] against the same
+        host.  Refs that can't be resolved are left out of the cache.
+        """
+        refs_by_url = {}
+        for (remote_url, revision) in lookups:
+            if "%s:%s" % (remote_url, revision) not in self._git_ref_cache:
+                refs_by_url.setdefault(remote_url, set()).add(revision)
+        if not refs_by_url:
+            return
+        num_threads = min(self.config.get('git_ls_remote_threads', 20), len(refs_by_url))
+        per_host = self.config.get('git_ls_remote_threads_per_host', 4)
+        host_semaphores = {}
+        semaphores = {}
+        for remote_url in refs_by_url:
+            host = urlparse(remote_url).netloc or remote_url.split(':')[0]
+            if host not in host_semaphores:
+                host_semaphores[host] = threading.BoundedSemaphore(per_host)
+            semaphores[remote_url] = host_semaphores[host]
+        self.info("Looking up %d refs on %d remotes" %
+                  (sum(len(r) for r in refs_by_url.values()), len(refs_by_url)))
+
+        def _query_git_refs(remote_url):
+            with semaphores[remote_url]:
+                return remote_url, self.query_git_refs(remote_url, refs_by_url[remote_url])
+
+        worker_pool = ThreadPool(num_threads)
+        try:
+            results = worker_pool.map(_query_git_refs, sorted(refs_by_url), chunksize=1)
+        finally:
+            worker_pool.close()
+            worker_pool.join()
+        now = time.time()
+        for remote_url, git_refs in results:
+            if git_refs is None:
+                continue
+            for revision in sorted(refs_by_url[remote_url]):
+                cache_key = "%s:%s" % (remote_url, revision)
+                abs_revision = self._match_git_ref(git_refs, revision)
+                if abs_revision:
+                    self.debug("%s -> %s" % (cache_key, abs_revision))
+                    self._git_ref_cache[cache_key] = abs_revision
+                    self._git_ref_cache_times[cache_key] = now
+                else:
+                    self.warning("no %s in git ls-remote %s" % (revision, remote_url))
 
-        # Resolve refnames
+    def resolve_git_ref(self, remote_url, revision):
+        self.resolve_git_refs([(remote_url, revision)])
+        return self._git_ref_cache.get("%s:%s" % (remote_url, revision))
+
+    def _is_gaia_override(self, project, revision):
+        # gaia is special - make sure we're using the same revision we used
+        # for gaia.json
+        return self.gaia_hg_revision and project.getAttribute('path') == 'gaia' and \
+            revision == self.config['gaia_git_branch']
+
+    def query_ref_lookups(self, manifest):
+        """Returns a list of (project, remote url, refname) for the projects
+        in manifest whose revisions need resolving."""
+        lookups = []
         for p in manifest.getElementsByTagName('project'):
             name = p.getAttribute('name')
             remote_url = repo_manifest.get_project_remote_url(manifest, p)
@@ -189,61 +275,40 @@ class B2GBumper(VCSScript, MapperMixin):
                            (name, revision))
                 continue
 
-            # gaia is special - make sure we're using the same revision we used
-            # for gaia.json
-            if self.gaia_hg_revision and p.getAttribute('path') == 'gaia' and revision == self.config['gaia_git_branch']:
-                git_rev = self.query_gaia_git_rev()
-                self.info("Using %s for gaia to match %s in gaia.json" % (git_rev, self.gaia_hg_revision))
-                p.setAttribute('revision', git_rev)
+            if self._is_gaia_override(p, revision):
                 continue
 
             # If there's no '/' in the revision, assume it's a head
             if '/' not in revision:
                 revision = 'refs/heads/%s' % revision
+            lookups.append((p, remote_url, revision))
+        return lookups
 
-            cache_key = "%s:%s" % (remote_url, revision)
-
-            # Check to see if we've looked up this revision on this remote
-            # before. If we have, reuse the previous value rather than looking
-            # it up again. This will make sure revisions for the same ref name
-            # are consistent between devices, as long as they use the same
-            # remote/refname.
-            if cache_key in self._git_ref_cache:
-                abs_revision = self._git_ref_cache[cache_key]
-                self.debug(
-                    "Reusing previous lookup %s -> %s" %
-                    (cache_key, abs_revision))
-                p.setAttribute('revision', abs_revision)
-                continue
+    def resolve_refs(self, manifest):
+        for p in manifest.getElementsByTagName('project'):
+            revision = repo_manifest.get_project_revision(manifest, p)
+            if self._is_gaia_override(p, revision):
+                git_rev = self.query_gaia_git_rev()
+                self.info("Using %s for gaia to match %s in gaia.json" % (git_rev, self.gaia_hg_revision))
+                p.setAttribute('revision', git_rev)
 
-            # Maybe a thread already exists for this lookup, even if the result has not
-            # yet been retrieved and placed in _git_ref_cache...
-            # Please note result.get() can be called multiple times without problems;
-            # the git command will only be executed once. Therefore we can associate many
-            # projects to the same thread result, without problems later when we call
-            # get() multiple times against the same thread result.
-            if cache_key in lookup_threads_by_parameters:
-                self.debug("Reusing currently running thread to look up %s" % cache_key)
-                lookup_threads_by_project[p] = lookup_threads_by_parameters.get(cache_key)
-            else:
-                async_result = worker_pool.apply_async(self.resolve_git_ref,
-                                                   (remote_url, revision))
-                lookup_threads_by_parameters[cache_key] = async_result
-                lookup_threads_by_project[p] = async_result
+        # Resolve refnames.  Once a revision has been looked up on a remote,
+        # the cached value is reused, so revisions for the same ref name
+        # are consistent between devices, as long as they use the same
+        # remote/refname.
+        lookups = self.query_ref_lookups(manifest)
+        self.resolve_git_refs([(url, ref) for (_, url, ref) in lookups])
 
         # TODO: alert/notify on missing repositories
-        abort = False
         failed = []
-        for p, result in lookup_threads_by_project.iteritems():
-            abs_revision = result.get(timeout=300)
-            remote_url = repo_manifest.get_project_remote_url(manifest, p)
-            revision = repo_manifest.get_project_revision(manifest, p)
+        for (p, remote_url, revision) in lookups:
+            abs_revision = self._git_ref_cache.get("%s:%s" % (remote_url, revision))
             if not abs_revision:
-                abort = True
                 self.error("Couldn't resolve reference %s %s" % (remote_url, revision))
                 failed.append(p)
+                continue
             p.setAttribute('revision', abs_revision)
-        if abort:
+        if failed:
             # Write message about how to set up syncing
             default = repo_manifest.get_default(manifest)
             for p in failed:
@@ -500,12 +565,24 @@ class B2GBumper(VCSScript, MapperMixin):
         Finally, we'll resolve absolute refs for projects that aren't fully
         specified.
         """
+        manifests = {}
         for device, device_config in self.query_devices().items():
             self.info("Massaging manifests for %s" % device)
             manifest = self.query_manifest(device)
             self.filter_projects(device_config, manifest)
             self.filter_groups(device_config, manifest)
             self.map_remotes(manifest)
+            manifests[device] = manifest
+
+        # Look up the refs for all the devices at once, so each remote
+        # only gets one git ls-remote.
+        lookups = set()
+        for manifest in manifests.values():
+            lookups.update((remote_url, revision) for (_, remote_url, revision)
+                           in self.query_ref_lookups(manifest))
+        self.resolve_git_refs(lookups)
+
+        for device, manifest in sorted(manifests.items()):
             self.resolve_refs(manifest)
             repo_manifest.cleanup(manifest)
             self.device_manifests[device] = manifest
@@ -621,15 +698,41 @@ class B2GBumper(VCSScript, MapperMixin):
     def import_git_ref_cache(self):
         """ This action imports the git ref cache created during a previous run. This is
         useful for sharing the cache across multiple branches (for example).
+
+        Entries older than config['git_ref_cache_ttl'] seconds (default an hour)
+        are dropped, so they get looked up again.
         """
-        if os.path.exists(self.git_ref_cache_file):
-            self._git_ref_cache = self._read_json(self.git_ref_cache_file)
+        if not os.path.exists(self.git_ref_cache_file):
+            return
+        contents = self._read_json(self.git_ref_cache_file) or {}
+        ttl = self.config.get('git_ref_cache_ttl')
+        if ttl is None:
+            ttl = 3600
+        now = time.time()
+        file_time = os.path.getmtime(self.git_ref_cache_file)
+        expired = 0
+        for cache_key, entry in contents.items():
+            if not isinstance(entry, dict):
+                # Caches from before entries had times
+                entry = {'revision': entry, 'time': file_time}
+            if now - entry['time'] > ttl:
+                expired += 1
+                continue
+            self._git_ref_cache[cache_key] = entry['revision']
+            self._git_ref_cache_times[cache_key] = entry['time']
+        self.info("Imported %d git refs from %s; %d had expired." %
+                  (len(contents) - expired, self.git_ref_cache_file, expired))
 
     def export_git_ref_cache(self):
         """ This action exports the git ref cache created during this run. This is useful
         for sharing the cache across multiple branches (for example).
         """
-        if self.write_to_file(self.git_ref_cache_file, json.dumps(self._git_ref_cache, sort_keys=True, indent=4) + "\n") != self.git_ref_cache_file:
+        now = time.time()
+        contents = dict((cache_key, {
+            'revision': revision,
+            'time': self._git_ref_cache_times.get(cache_key, now),
+        }) for (cache_key, revision) in self._git_ref_cache.items())
+        if self.write_to_file(self.git_ref_cache_file, json.dumps(contents, sort_keys=True, indent=4) + "\n") != self.git_ref_cache_file:
             self.add_summary(
                 "Unable to update %s with git ref cache" % self.git_ref_cache_file,
                 level=ERROR,
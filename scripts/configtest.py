@@ -6,15 +6,25 @@
 # ***** END LICENSE BLOCK *****
 """configtest.py
 
-Verify the .json and .py files in the configs/ directory are well-formed.
+Verify the .json and .py files in the configs/ directory are well-formed,
+and that the keys most scripts share (exes, default_actions,
+virtualenv_modules) have the right shape.
 Further tests to verify validity would be desirable.
 
+Configs are evaluated with parse_config_file(), the same evaluator the
+scripts use, so unchanged configs that it can cache come straight out of
+its content-hashed cache (see mozharness.base.config.CONFIG_CACHE_DIR).
+Configs it can't cache, e.g. ones that list directories, are evaluated
+every time.  With --jobs, they're evaluated in a process pool; that only
+pays off with a cold cache on a machine with several cpus.
+
 This is also a good example script to look at to understand mozharness.
 """
 
+from multiprocessing import Pool
 import os
-import pprint
 import sys
+import time
 try:
     import simplejson as json
 except ImportError:
@@ -22,8 +32,82 @@ except ImportError:
 
 sys.path.insert(1, os.path.dirname(sys.path[0]))
 
+from mozharness.base.config import MissingConfigDictError, parse_config_file
 from mozharness.base.script import BaseScript
 
+
+# Schema checks {{{1
+def _is_string_list(value):
+    return isinstance(value, (list, tuple)) and \
+        all(isinstance(v, basestring) for v in value)
+
+
+def check_config_schema(config):
+    """Return a list of problems with the well-known keys in config."""
+    errors = []
+    exes = config.get('exes')
+    if exes is not None:
+        if not isinstance(exes, dict):
+            errors.append("exes is a %s, not a dict" % type(exes).__name__)
+        else:
+            for name, exe in sorted(exes.items()):
+                if not isinstance(exe, basestring) and not _is_string_list(exe):
+                    errors.append("exes['%s'] is neither a string nor a list of strings" % name)
+    default_actions = config.get('default_actions')
+    if default_actions is not None:
+        if not _is_string_list(default_actions):
+            errors.append("default_actions is not a list of strings")
+        else:
+            duplicates = sorted(set(a for a in default_actions
+                                    if default_actions.count(a) > 1))
+            if duplicates:
+                errors.append("default_actions lists %s more than once" %
+                              ', '.join(duplicates))
+    modules = config.get('virtualenv_modules')
+    if modules is not None:
+        if not isinstance(modules, (list, tuple)):
+            errors.append("virtualenv_modules is a %s, not a list" % type(modules).__name__)
+        else:
+            for module in modules:
+                if not isinstance(module, (basestring, dict)):
+                    errors.append("virtualenv_modules entry %r is neither a string nor a dict" % (module, ))
+    return errors
+
+
+def evaluate_config_file(config_file):
+    """Evaluate config_file and check its schema.  This can run in the
+    ConfigTest process pool, so it returns a json-friendly dict rather than
+    logging.
+    """
+    result = {
+        'file': config_file,
+        'type': 'json' if config_file.endswith('.json') else 'python',
+        'status': 'good',
+        'error': None,
+        'schema_errors': [],
+    }
+    start = time.time()
+    try:
+        config = parse_config_file(config_file)
+    except MissingConfigDictError:
+        result['status'] = 'no-config'
+        result['error'] = "%s is valid python, but doesn't create a config dictionary." % config_file
+    except Exception, e:
+        # Including KeyErrors raised by the config itself
+        result['status'] = 'invalid'
+        result['error'] = "%s is invalid %s: %s" % (config_file, result['type'], str(e))
+    else:
+        if result['type'] == 'python' and not isinstance(config, dict):
+            result['status'] = 'no-config'
+            result['error'] = "%s is valid python, but doesn't create a config dictionary." % config_file
+        else:
+            result['schema_errors'] = check_config_schema(config)
+            if result['schema_errors']:
+                result['status'] = 'bad-schema'
+    result['seconds'] = time.time() - start
+    return result
+
+
 # ConfigTest {{{1
 class ConfigTest(BaseScript):
     config_options = [[
@@ -32,18 +116,35 @@ class ConfigTest(BaseScript):
       "dest": "test_files",
       "help": "Specify which config files to test"
      }
+    ], [
+     ["--jobs", "-j"],
+     {"action": "store",
+      "type": "int",
+      "dest": "jobs",
+      "help": "Number of processes to evaluate configs with (default: 1)"
+     }
+    ], [
+     ["--report-file",],
+     {"action": "store",
+      "dest": "report_file",
+      "help": "Write a json report, with per-file results and timings, here"
+     }
     ]]
 
     def __init__(self, require_config_file=False):
         self.config_files = []
+        self.config_results = None
+        self.config_results_seconds = None
         BaseScript.__init__(self, config_options=self.config_options,
                             all_actions=['list-config-files',
                                          'test-json-configs',
                                          'test-python-configs',
+                                         'write-report',
                                          'summary',
                                          ],
                             default_actions=['test-json-configs',
                                              'test-python-configs',
+                                             'write-report',
                                              'summary',
                                             ],
                             require_config_file=require_config_file)
@@ -71,6 +172,33 @@ class ConfigTest(BaseScript):
         self.config_files = config_files
         return self.config_files
 
+    def query_config_results(self):
+        """Evaluate all the config files once, in parallel, for both the
+        json and python tests, and cache the results in self.config_results.
+        """
+        if self.config_results is not None:
+            return self.config_results
+        config_files = self.query_config_files()
+        jobs = max(1, min(self.config.get('jobs') or 1, len(config_files)))
+        self.info("Evaluating %d config files in %d processes." %
+                  (len(config_files), jobs))
+        start = time.time()
+        if jobs == 1:
+            results = map(evaluate_config_file, config_files)
+        else:
+            pool = Pool(jobs)
+            try:
+                results = pool.map(evaluate_config_file, config_files,
+                                   chunksize=max(1, len(config_files) // (jobs * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        self.config_results = dict((r['file'], r) for r in results)
+        self.config_results_seconds = time.time() - start
+        self.info("Evaluated config files in %.2f seconds." %
+                  self.config_results_seconds)
+        return self.config_results
+
     def list_config_files(self):
         """ Non-default action that is mainly here to demonstrate how
         non-default actions work in a mozharness script.
@@ -79,62 +207,60 @@ class ConfigTest(BaseScript):
         for config_file in config_files:
             self.info(config_file)
 
+    def _report_results(self, config_type):
+        config_files = [f for f in self.query_config_files()
+                        if config_type == ('json' if f.endswith('.json') else 'python')]
+        results = self.query_config_results()
+        good = 0
+        for config_file in config_files:
+            result = results[config_file]
+            self.info("Testing %s." % config_file)
+            if result['status'] == 'good':
+                self.info("Good.")
+                good += 1
+            elif result['status'] == 'bad-schema':
+                self.add_summary("%s has a bad schema." % config_file,
+                                 level="error")
+                for error in result['schema_errors']:
+                    self.error(error)
+            else:
+                self.add_summary(result['error'], level="error")
+        if config_files:
+            self.add_summary("%d of %d %s config files were good." %
+                             (good, len(config_files), config_type))
+        else:
+            self.add_summary("No %s config files to test." % config_type)
+
     def test_json_configs(self):
-        """ Currently only "is this well-formed json?"
+        """ Currently "is this well-formed json?" and the schema checks.
 
         """
-        config_files = self.query_config_files()
-        filecount = [0, 0]
-        for config_file in config_files:
-            if config_file.endswith(".json"):
-                filecount[0] += 1
-                self.info("Testing %s." % config_file)
-                contents = self.read_from_file(config_file, verbose=False)
-                try:
-                    json.loads(contents)
-                except ValueError:
-                    self.add_summary("%s is invalid json." % config_file,
-                                     level="error")
-                    self.error(pprint.pformat(sys.exc_info()[1]))
-                else:
-                    self.info("Good.")
-                    filecount[1] += 1
-        if filecount[0]:
-            self.add_summary("%d of %d json config files were good." %
-                             (filecount[1], filecount[0]))
-        else:
-            self.add_summary("No json config files to test.")
+        self._report_results('json')
 
     def test_python_configs(self):
-        """Currently only "will this give me a config dictionary?"
+        """Currently "will this give me a config dictionary?" and the
+        schema checks.
 
         """
-        config_files = self.query_config_files()
-        filecount = [0, 0]
-        for config_file in config_files:
-            if config_file.endswith(".py"):
-                filecount[0] += 1
-                self.info("Testing %s." % config_file)
-                global_dict = {}
-                local_dict = {}
-                try:
-                    execfile(config_file, global_dict, local_dict)
-                except:
-                    self.add_summary("%s is invalid python." % config_file,
-                                     level="error")
-                    self.error(pprint.pformat(sys.exc_info()[1]))
-                else:
-                    if 'config' in local_dict and isinstance(local_dict['config'], dict):
-                        self.info("Good.")
-                        filecount[1] += 1
-                    else:
-                        self.add_summary("%s is valid python, but doesn't create a config dictionary." %
-                                         config_file, level="error")
-        if filecount[0]:
-            self.add_summary("%d of %d python config files were good." %
-                             (filecount[1], filecount[0]))
-        else:
-            self.add_summary("No python config files to test.")
+        self._report_results('python')
+
+    def write_report(self):
+        """Write the results as json to --report-file, if it's set."""
+        report_file = self.config.get('report_file')
+        if not report_file:
+            self.info("No --report-file specified; skipping.")
+            return
+        results = self.query_config_results()
+        statuses = {}
+        for result in results.values():
+            statuses[result['status']] = statuses.get(result['status'], 0) + 1
+        report = {
+            'seconds': self.config_results_seconds,
+            'counts': statuses,
+            'files': [results[f] for f in sorted(results)],
+        }
+        self.write_to_file(report_file, json.dumps(report, indent=2, sort_keys=True),
+                           create_parent_dir=True)
 
 # __main__ {{{1
 if __name__ == '__main__':
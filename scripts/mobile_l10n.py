@@ -12,9 +12,11 @@ Android.  This also creates nightly updates.
 
 from copy import deepcopy
 import os
+import pipes
 import re
 import subprocess
 import sys
+import time
 
 try:
     import simplejson as json
@@ -27,6 +29,7 @@ sys.path.insert(1, os.path.dirname(sys.path[0]))
 
 from mozharness.base.errors import BaseErrorList, MakefileErrorList
 from mozharness.base.log import OutputParser
+from mozharness.mozilla.signing import AndroidSignatureVerificationErrorList
 from mozharness.base.transfer import TransferMixin
 from mozharness.mozilla.buildbot import BuildbotMixin
 from mozharness.mozilla.purge import PurgeMixin
@@ -39,6 +42,16 @@ from mozharness.mozilla.mock import MockMixin
 from mozharness.mozilla.updates.balrog import BalrogMixin
 
 
+# Make arguments that give each locale its own merge and dist dirs, so
+# repack() can run locales concurrently, if config['locale_repack_dirs'] is
+# set.  Override with config['locale_repack_make_args'].
+LOCALE_REPACK_MAKE_ARGS = [
+    'LOCALE_MERGEDIR=%(merge_dir)s',
+    'DIST=%(dist_dir)s',
+    'ZIP_IN=%(en_us_package)s',
+]
+
+
 # MobileSingleLocale {{{1
 class MobileSingleLocale(MockMixin, LocalesMixin, ReleaseMixin,
                          MobileSigningMixin, TransferMixin, TooltoolMixin,
@@ -101,6 +114,14 @@ class MobileSingleLocale(MockMixin, LocalesMixin, ReleaseMixin,
          "type": "int",
          "help": "Specify the total number of chunks of locales"
          }
+    ], [
+        ['--repack-jobs', ],
+        {"action": "store",
+         "dest": "repack_jobs",
+         "type": "int",
+         "help": "Specify the number of locales to repack at once; "
+                 "needs locale_repack_dirs in the config"
+         }
     ]]
 
     def __init__(self, require_config_file=True):
@@ -272,6 +293,10 @@ class MobileSingleLocale(MockMixin, LocalesMixin, ReleaseMixin,
                  os.path.join(abs_dirs['base_work_dir'], 'tools'),
              'build_dir':
                  os.path.join(abs_dirs['base_work_dir'], 'build'),
+             'abs_locale_repacks_dir':
+                 os.path.join(abs_dirs['abs_objdir'], 'l10n-repacks'),
+             'abs_locale_repack_logs_dir':
+                 os.path.join(abs_dirs['abs_log_dir'], 'l10n-repacks'),
          }
 
          abs_dirs.update(dirs)
@@ -391,48 +416,140 @@ class MobileSingleLocale(MockMixin, LocalesMixin, ReleaseMixin,
         buildid = self.query_buildid()
         self._setup_configure(buildid=buildid)
 
-    def repack(self):
-        # TODO per-locale logs and reporting.
+    def _query_locale_repack_job(self, locale, locale_dirs=False):
+        """The commands to repack locale: compare-locales, make
+        installers-<locale> and signature verification.
+
+        If locale_dirs is True, the locale gets its own merge and dist dirs
+        (see LOCALE_REPACK_MAKE_ARGS), with its own copy of the en-US
+        package unpacked into them first, so it can be repacked alongside
+        other locales.  Otherwise it's repacked in the shared dist dir, so
+        it has to be repacked on its own.
+        """
         c = self.config
         dirs = self.query_abs_dirs()
-        locales = self.query_locales()
         make = self.query_exe("make")
         repack_env = self.query_repack_env()
         base_package_name = self.query_base_package_name()
+        locale_dir = None
+        make_args = []
+        if locale_dirs:
+            locale_dir = os.path.join(dirs['abs_locale_repacks_dir'], locale)
+            replace_dict = {
+                'locale': locale,
+                'merge_dir': os.path.join(locale_dir, 'merged'),
+                'dist_dir': os.path.join(locale_dir, 'dist'),
+                'en_us_package': os.path.join(dirs['abs_objdir'], 'dist',
+                                              base_package_name % {'locale': 'en-US'}),
+            }
+            make_args = [a % replace_dict for a in
+                         c.get('locale_repack_make_args', LOCALE_REPACK_MAKE_ARGS)]
+            merge_dir = replace_dict['merge_dir']
+            dist_dir = replace_dict['dist_dir']
+        else:
+            merge_dir = dirs['abs_merge_dir']
+            dist_dir = os.path.join(dirs['abs_objdir'], 'dist')
+        signed_path = os.path.join(dist_dir, base_package_name % {'locale': locale})
+        commands = [
+            # Like run_compare_locales(), start with an empty merge dir.
+            {'step': 'clean merge dir',
+             'command': 'rm -rf %s && mkdir -p %s' % (pipes.quote(merge_dir),
+                                                      pipes.quote(merge_dir)),
+             'error_list': []},
+            dict(self.query_compare_locales_command(locale, merge_dir=merge_dir),
+                 step='compare-locales'),
+        ]
+        if locale_dirs:
+            commands.append(
+                {'step': 'make unpack',
+                 'command': [make, 'unpack'] + make_args,
+                 'cwd': dirs['abs_locales_dir'],
+                 'env': repack_env,
+                 'error_list': MakefileErrorList})
+        commands += [
+            {'step': 'make installers-%s' % locale,
+             'command': [make, 'installers-%s' % locale] + make_args,
+             'cwd': dirs['abs_locales_dir'],
+             'env': repack_env,
+             'error_list': MakefileErrorList},
+            {'step': 'signature verification',
+             'command': self.query_android_signature_command(
+                 signed_path,
+                 script=c['signature_verification_script'],
+                 key_alias=c['key_alias']),
+             'cwd': dirs['abs_work_dir'],
+             'env': repack_env,
+             'error_list': AndroidSignatureVerificationErrorList},
+        ]
+        return {
+            'name': locale,
+            'locale_dir': locale_dir,
+            'signed_path': signed_path,
+            'commands': commands,
+        }
+
+    def repack(self):
+        """Repack the locales in a single mock session.  Each locale's
+        output is kept in its own log files under abs_locale_repack_logs_dir,
+        and is logged here one locale at a time once they're all done.
+
+        If config['locale_repack_dirs'] is set, config['repack_jobs']
+        locales are repacked at a time, each in its own merge and dist dirs;
+        otherwise they're repacked one at a time in the shared dist dir.
+        """
+        c = self.config
+        dirs = self.query_abs_dirs()
+        locales = self.query_locales()
+        base_package_name = self.query_base_package_name()
         base_package_dir = os.path.join(dirs['abs_objdir'], 'dist')
+        num_jobs = c.get('repack_jobs') or 1
+        locale_dirs = bool(c.get('locale_repack_dirs')) and num_jobs > 1
+        if num_jobs > 1 and not locale_dirs:
+            self.warning("repack_jobs is %d, but locale_repack_dirs isn't set; "
+                         "repacking one locale at a time." % num_jobs)
+            num_jobs = 1
         success_count = total_count = 0
+        jobs = []
         for locale in locales:
+            job = self._query_locale_repack_job(locale, locale_dirs=locale_dirs)
+            if locale_dirs:
+                self.rmtree(job['locale_dir'])
+                self.mkdir_p(job['locale_dir'])
+            jobs.append(job)
+        start = time.time()
+        results = self.run_concurrent_commands_m(
+            jobs, dirs['abs_locale_repack_logs_dir'], num_jobs=num_jobs)
+        elapsed = time.time() - start
+        for job in jobs:
+            locale = job['name']
+            result = results[locale]
             total_count += 1
-            self.enable_mock()
-            result = self.run_compare_locales(locale)
-            self.disable_mock()
-            if result:
-                self.add_failure(locale, message="%s failed in compare-locales!" % locale)
+            self.info("*** BEGIN repack %s" % locale)
+            for (command, log_file) in zip(job['commands'], result['logs']):
+                self.info("*** %s %s (%s)" % (command['step'], locale, log_file))
+                parser = OutputParser(config=self.config, log_obj=self.log_obj,
+                                      error_list=command['error_list'])
+                parser.add_lines(self.read_from_file(log_file, verbose=False) or '')
+            self.info("*** END repack %s" % locale)
+            if result['status'] is None:
+                self.add_failure(locale, message="%s repack didn't run!" % locale)
                 continue
-            if self.run_command_m([make, "installers-%s" % locale],
-                                  cwd=dirs['abs_locales_dir'],
-                                  env=repack_env,
-                                  error_list=MakefileErrorList,
-                                  halt_on_failure=False):
-                self.add_failure(locale, message="%s failed in make installers-%s!" % (locale, locale))
-                continue
-            signed_path = os.path.join(base_package_dir,
-                                       base_package_name % {'locale': locale})
-            # We need to wrap what this function does with mock, since
-            # MobileSigningMixin doesn't know about mock
-            self.enable_mock()
-            status = self.verify_android_signature(
-                signed_path,
-                script=c['signature_verification_script'],
-                env=repack_env,
-                key_alias=c['key_alias'],
-            )
-            self.disable_mock()
-            if status:
-                self.add_failure(locale, message="Errors verifying %s binary!" % locale)
-                # No need to rm because upload is per-locale
+            if result['failed'] is not None:
+                step = job['commands'][result['failed']]['step']
+                if step == 'signature verification':
+                    self.add_failure(locale, message="Errors verifying %s binary!" % locale)
+                else:
+                    self.add_failure(locale, message="%s failed in %s!" % (locale, step))
                 continue
+            if locale_dirs:
+                if self.move(job['signed_path'],
+                             os.path.join(base_package_dir,
+                                          base_package_name % {'locale': locale})):
+                    self.add_failure(locale, message="Can't move the %s binary into dist!" % locale)
+                    continue
+                self.rmtree(job['locale_dir'])
             success_count += 1
+        self.info("Repacked %d locales in %.1f seconds." % (total_count, elapsed))
         self.summarize_success_count(success_count, total_count,
                                      message="Repacked %d of %d binaries successfully.")
 
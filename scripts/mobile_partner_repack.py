@@ -9,14 +9,18 @@
 """
 
 from copy import deepcopy
+from cStringIO import StringIO
+from multiprocessing import Pool, cpu_count
 import os
 import sys
+import time
+import zipfile
 
 # load modules from parent dir
 sys.path.insert(1, os.path.dirname(sys.path[0]))
 
 from mozharness.base.errors import ZipErrorList
-from mozharness.base.log import FATAL
+from mozharness.base.script import rewrite_zip
 from mozharness.base.transfer import TransferMixin
 from mozharness.base.vcs.vcsbase import MercurialScript
 from mozharness.mozilla.l10n.locales import LocalesMixin
@@ -24,6 +28,40 @@ from mozharness.mozilla.release import ReleaseMixin
 from mozharness.mozilla.signing import MobileSigningMixin
 
 SUPPORTED_PLATFORMS = ["android"]
+PARTNER_PREF = 'pref("app.partner.%(partner)s", "%(partner)s");'
+
+
+def repack_apk(args):
+    """ Repack an apk with a partner update channel, without extracting
+        anything: partner.js is added to the omni.ja inside the apk in
+        memory, the signature is dropped, and everything else is copied
+        over as is.
+
+        This runs in the repack process pool, so it returns
+        (repack_path, error message or None) rather than logging.
+        """
+    (partner, orig_path, repack_path) = args
+    tmp_path = repack_path + '.tmp'
+    try:
+        if not os.path.isdir(os.path.dirname(repack_path)):
+            os.makedirs(os.path.dirname(repack_path))
+        apk = zipfile.ZipFile(orig_path, 'r')
+        try:
+            omni = StringIO(apk.read('omni.ja'))
+        finally:
+            apk.close()
+        new_omni = StringIO()
+        rewrite_zip(omni, new_omni, replace={
+            'defaults/pref/partner.js': PARTNER_PREF % {'partner': partner},
+        })
+        rewrite_zip(orig_path, tmp_path, remove=['META-INF/*'],
+                    replace={'omni.ja': new_omni.getvalue()})
+        os.rename(tmp_path, repack_path)
+    except (KeyError, zipfile.BadZipfile, zipfile.LargeZipFile, IOError, OSError), e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return repack_path, str(e)
+    return repack_path, None
 
 
 # MobilePartnerRepack {{{1
@@ -95,6 +133,30 @@ class MobilePartnerRepack(LocalesMixin, ReleaseMixin, MobileSigningMixin,
          "metavar": "INT",
          "help": "Specify the current release build num (e.g. build1, build2)"
          }
+    ], [
+        ['--repack-processes', ],
+        {"action": "store",
+         "dest": "repack_processes",
+         "type": "int",
+         "metavar": "INT",
+         "help": "Number of processes to repack with (default: number of cpus)"
+         }
+    ], [
+        ['--signing-threads', ],
+        {"action": "store",
+         "dest": "signing_threads",
+         "type": "int",
+         "metavar": "INT",
+         "help": "Number of apks to sign and align at once (default: number of cpus)"
+         }
+    ], [
+        ['--download-threads', ],
+        {"action": "store",
+         "dest": "download_threads",
+         "type": "int",
+         "metavar": "INT",
+         "help": "Number of installers to download at once (default: 4)"
+         }
     ]]
 
     def __init__(self, require_config_file=True):
@@ -155,7 +217,8 @@ class MobilePartnerRepack(LocalesMixin, ReleaseMixin, MobileSigningMixin,
             'buildnum': rc['buildnum'],
             'version': rc['version'],
         }
-        success_count = total_count = 0
+        downloads = []
+        download_platform_locales = []
         for platform in c['platforms']:
             base_installer_name = c['installer_base_names'][platform]
             base_url = c['download_base_url'] + '/' + \
@@ -169,18 +232,19 @@ class MobilePartnerRepack(LocalesMixin, ReleaseMixin, MobileSigningMixin,
                 parent_dir = '%s/original/%s/%s' % (dirs['abs_work_dir'],
                                                     platform, locale)
                 file_path = '%s/%s' % (parent_dir, installer_name)
-                self.mkdir_p(parent_dir)
-                total_count += 1
-                if not self.download_file(url, file_path):
-                    self.add_failure(platform, locale,
-                                     message="Unable to download %(platform)s:%(locale)s installer!")
-                else:
-                    success_count += 1
-        self.summarize_success_count(success_count, total_count,
+                downloads.append((url, file_path))
+                download_platform_locales.append((platform, locale))
+        results = self.download_files(downloads)
+        for ((platform, locale), result) in zip(download_platform_locales, results):
+            if not result:
+                self.add_failure(platform, locale,
+                                 message="Unable to download %(platform)s:%(locale)s installer!")
+        self.summarize_success_count(len(filter(None, results)), len(results),
                                      message="Downloaded %d of %d installers successfully.")
 
     def _repack_apk(self, partner, orig_path, repack_path):
-        """ Repack the apk with a partner update channel.
+        """ Repack the apk with a partner update channel, with zip and
+        unzip.  repack() only falls back to this if repack_apk() fails.
         Returns True for success, None for failure
         """
         dirs = self.query_abs_dirs()
@@ -229,12 +293,39 @@ class MobilePartnerRepack(LocalesMixin, ReleaseMixin, MobileSigningMixin,
             return
         return True
 
+    def _run_repacks(self, repacks):
+        """ Run repack_apk() on each (partner, orig_path, repack_path) in
+        repacks, on a pool of config['repack_processes'] processes.
+        Returns the (repack_path, error) results in order.
+        """
+        if not repacks:
+            return []
+        processes = max(1, min(self.config.get('repack_processes') or cpu_count(),
+                               len(repacks)))
+        self.info("Repacking %d apks in %d processes." % (len(repacks), processes))
+        start = time.time()
+        if processes == 1:
+            results = map(repack_apk, repacks)
+        else:
+            pool = Pool(processes)
+            try:
+                results = pool.map(repack_apk, repacks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        elapsed = time.time() - start
+        self.info("Repacked %d apks in %.1f seconds (%.1f apks/second)." %
+                  (len(repacks), elapsed, len(repacks) / max(elapsed, 0.001)))
+        return results
+
     def repack(self):
         c = self.config
         rc = self.query_release_config()
         dirs = self.query_abs_dirs()
         locales = self.query_locales()
         success_count = total_count = 0
+        repacks = []
+        repack_platform_locales = []
         for platform in c['platforms']:
             for locale in locales:
                 installer_name = c['installer_base_names'][platform] % {'version': rc['version'], 'locale': locale}
@@ -244,12 +335,20 @@ class MobilePartnerRepack(LocalesMixin, ReleaseMixin, MobileSigningMixin,
                 original_path = '%s/original/%s/%s/%s' % (dirs['abs_work_dir'], platform, locale, installer_name)
                 for partner in c['partner_config'].keys():
                     repack_path = '%s/unsigned/partner-repacks/%s/%s/%s/%s' % (dirs['abs_work_dir'], partner, platform, locale, installer_name)
-                    total_count += 1
-                    if self._repack_apk(partner, original_path, repack_path):
-                        success_count += 1
-                    else:
-                        self.add_failure(platform, locale,
-                                         message="Unable to repack %(platform)s:%(locale)s installer!")
+                    repacks.append((partner, original_path, repack_path))
+                    repack_platform_locales.append((platform, locale))
+        results = self._run_repacks(repacks)
+        for ((partner, original_path, repack_path), (platform, locale), (_, error)) in \
+                zip(repacks, repack_platform_locales, results):
+            total_count += 1
+            if error:
+                self.warning("Can't repack %s in-process (%s); trying zip and unzip." %
+                             (repack_path, error))
+                if not self._repack_apk(partner, original_path, repack_path):
+                    self.add_failure(platform, locale,
+                                     message="Unable to repack %(platform)s:%(locale)s installer!")
+                    continue
+            success_count += 1
         self.summarize_success_count(success_count, total_count,
                                      message="Repacked %d of %d installers successfully.")
 
@@ -285,6 +384,8 @@ class MobilePartnerRepack(LocalesMixin, ReleaseMixin, MobileSigningMixin,
         dirs = self.query_abs_dirs()
         locales = self.query_locales()
         success_count = total_count = 0
+        apks = []
+        apk_platform_locales = {}
         for platform in c['platforms']:
             for locale in locales:
                 installer_name = c['installer_base_names'][platform] % {'version': rc['version'], 'locale': locale}
@@ -296,22 +397,25 @@ class MobilePartnerRepack(LocalesMixin, ReleaseMixin, MobileSigningMixin,
                     signed_dir = '%s/partner-repacks/%s/%s/%s' % (dirs['abs_work_dir'], partner, platform, locale)
                     signed_path = "%s/%s" % (signed_dir, installer_name)
                     total_count += 1
-                    self.info("Signing %s %s." % (platform, locale))
                     if not os.path.exists(unsigned_path):
                         self.error("Missing apk %s!" % unsigned_path)
                         continue
-                    if self.sign_apk(unsigned_path, c['keystore'],
-                                     self.store_passphrase, self.key_passphrase,
-                                     c['key_alias']) != 0:
-                        self.add_summary("Unable to sign %s:%s apk!" % (platform, locale), level=FATAL)
-                    else:
-                        self.mkdir_p(signed_dir)
-                        if self.align_apk(unsigned_path, signed_path):
-                            self.add_failure(platform, locale,
-                                             message="Unable to align %(platform)s%(locale)s apk!")
-                            self.rmtree(signed_dir)
-                        else:
-                            success_count += 1
+                    apks.append((unsigned_path, signed_path))
+                    apk_platform_locales[(unsigned_path, signed_path)] = (platform, locale)
+        # repack() already removed the signatures.
+        results = self.sign_and_align_apks(apks, c['keystore'],
+                                           self.store_passphrase, self.key_passphrase,
+                                           c['key_alias'], remove_signature=False,
+                                           num_threads=c.get('signing_threads'))
+        for (unsigned_path, signed_path) in apks:
+            (platform, locale) = apk_platform_locales[(unsigned_path, signed_path)]
+            status = results[(unsigned_path, signed_path)]
+            if status is None:
+                success_count += 1
+                continue
+            self.add_failure(platform, locale,
+                             message="Unable to %s %%(platform)s:%%(locale)s apk!" % status)
+            self.rmtree(signed_path)
         self.summarize_success_count(success_count, total_count,
                                      message="Signed %d of %d apks successfully.")
 
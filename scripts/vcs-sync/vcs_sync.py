@@ -11,12 +11,15 @@ type conversions, as well as many-to-many (l10n, build repos, etc.)
 """
 
 from copy import deepcopy
-import mmap
+from multiprocessing.pool import ThreadPool
 import os
 import pprint
 import re
+import subprocess
 import sys
+import threading
 import time
+import urlparse
 
 try:
     import simplejson as json
@@ -36,12 +39,15 @@ from mozharness.base.errors import HgErrorList, GitErrorList
 from mozharness.base.log import INFO, ERROR, FATAL
 from mozharness.base.python import VirtualenvMixin, virtualenv_config_options
 from mozharness.base.transfer import TransferMixin
+from mozharness.base.vcs.mapfile import MapfileIndex, merge_mapfiles
 from mozharness.base.vcs.vcssync import VCSSyncScript
+from mozharness.mozilla.mapper import MapperMixin
 from mozharness.mozilla.tooltool import TooltoolMixin
 
 
 # HgGitScript {{{1
-class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
+class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, MapperMixin,
+                  VCSSyncScript):
     """ Beagle-oriented hg->git script (lots of mozilla-central hardcodes;
         assumption that we're going to be importing lots of branches).
 
@@ -52,7 +58,6 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
         script with some changes.
         """
 
-    mapfile_binary_search = None
     all_repos = None
     successful_repos = []
     config_options = [
@@ -72,6 +77,30 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
                     "embed two separate log samples into the email - so maximum "
                     "email body size can end up a little over 2x this amount).",
          }],
+        [["--repo-threads", ], {
+            "action": "store",
+            "dest": "repo_threads",
+            "type": "int",
+            "default": 4,
+            "help": "Specify how many repos to update or push at once.",
+         }],
+        [["--repo-threads-per-host", ], {
+            "action": "store",
+            "dest": "repo_threads_per_host",
+            "type": "int",
+            "default": 2,
+            "help": "Specify how many repos to pull from or push to the same "
+                    "remote host at once.",
+         }],
+        [["--target-threads", ], {
+            "action": "store",
+            "dest": "target_threads",
+            "type": "int",
+            "default": 4,
+            "help": "Specify how many of a repo's remote targets to push to "
+                    "at once.  Targets on the same host are pushed to one "
+                    "after the other.",
+         }],
     ]
 
     def __init__(self, require_config_file=True):
@@ -106,6 +135,13 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
             require_config_file=require_config_file
         )
         self.remote_targets = None
+        self.repo_map = None
+        # Guards self.repo_map and repo_update.json, which the per-repo
+        # threads all update.
+        self.repo_map_lock = threading.RLock()
+        self.host_semaphores = {}
+        self.mapfile_indexes = {}
+        self.mapfile_indexes_lock = threading.Lock()
 
     # Helper methods {{{1
     def query_abs_dirs(self):
@@ -124,6 +160,8 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
             abs_dirs['abs_work_dir'], 'mc-git-rewrite')
         abs_dirs['abs_target_dir'] = os.path.join(abs_dirs['abs_work_dir'],
                                                   'target')
+        abs_dirs['abs_mapfile_index_dir'] = os.path.join(
+            abs_dirs['abs_work_dir'], 'mapfile-index')
         if 'conversion_dir' in self.config:
             abs_dirs['abs_conversion_dir'] = os.path.join(
                 abs_dirs['abs_work_dir'], 'conversion',
@@ -306,23 +344,137 @@ intree=1
         all_repos = self.query_all_repos()
         return [repo for repo in all_repos if repo.get('repo_name') not in self.failures]
 
+    def query_repo_map(self):
+        """ Return the in-memory repo_map, read from repo_update.json the
+            first time.  Every action updates this same dict (while holding
+            self.repo_map_lock), so updates from different repos, threads and
+            actions don't overwrite each other when it's written out.
+            """
+        with self.repo_map_lock:
+            if self.repo_map is None:
+                self.repo_map = self._read_repo_update_json()
+            return self.repo_map
+
     def _query_repo_previous_status(self, repo_name, repo_map=None):
         """ Return False if previous run was unsuccessful.
             Return None if no previous run information.
             """
-        if repo_map is None:
-            repo_map = self._read_repo_update_json()
-        return repo_map.get('repos', {}).get(repo_name, {}).get('previous_push_successful')
+        with self.repo_map_lock:
+            if repo_map is None:
+                repo_map = self.query_repo_map()
+            return repo_map.get('repos', {}).get(repo_name, {}).get('previous_push_successful')
 
     def _update_repo_previous_status(self, repo_name, successful_flag, repo_map=None, write_update=False):
         """ Set the repo_name to successful_flag (False for unsuccessful, True for successful)
             """
-        if repo_map is None:
-            repo_map = self._read_repo_update_json()
-        repo_map.setdefault('repos', {}).setdefault(repo_name, {})['previous_push_successful'] = successful_flag
-        if write_update:
-            self._write_repo_update_json(repo_map)
-        return repo_map
+        with self.repo_map_lock:
+            if repo_map is None:
+                repo_map = self.query_repo_map()
+            repo_map.setdefault('repos', {}).setdefault(repo_name, {})['previous_push_successful'] = successful_flag
+            if write_update:
+                self._write_repo_update_json(repo_map)
+            return repo_map
+
+    def _query_url_host(self, url):
+        """ Return the host part of an hg or git url, or None for a local path.
+            """
+        if '://' in url:
+            host = urlparse.urlsplit(url).netloc
+        elif ':' in url and '/' not in url.split(':', 1)[0]:
+            # scp-style git@github.com:mozilla/gecko-dev.git
+            host = url.split(':', 1)[0]
+        else:
+            return None
+        return host.rsplit('@', 1)[-1] or None
+
+    def _query_repo_hosts(self, repo_config, push=False):
+        """ Return the sorted remote hosts that updating (or with push=True,
+            pushing) repo_config talks to.
+            """
+        urls = []
+        if not push:
+            urls.append(repo_config['repo'])
+        else:
+            if self.remote_targets is None:
+                self.remote_targets = self.config.get('remote_targets', {})
+            for target_config in repo_config['targets']:
+                if target_config.get("test_push"):
+                    continue
+                remote_config = self.remote_targets.get(target_config['target_dest'], target_config)
+                if remote_config.get('repo'):
+                    urls.append(remote_config['repo'])
+        return sorted(set(h for h in map(self._query_url_host, urls) if h))
+
+    def _run_on_repos(self, func, push=False, remote=True, by_conversion_dir=False):
+        """ Run func(repo_config) for each of query_all_non_failed_repos(),
+            several repos at once, and return the results in order.
+
+            At most config['repo_threads'] repos run at a time, and if remote
+            is True, at most config['repo_threads_per_host'] of them talk to
+            the same remote host (see _query_repo_hosts()) at a time.
+
+            If by_conversion_dir is True, repos that share a
+            query_abs_conversion_dir() run one after the other, since they
+            work in the same hg and git repos.
+
+            A fatal() in func stops any more repos from starting; it's
+            re-raised here once the running ones have finished.
+            """
+        repo_configs = self.query_all_non_failed_repos()
+        if not repo_configs:
+            return []
+        groups = []
+        if by_conversion_dir:
+            group_indices = {}
+            for index, repo_config in enumerate(repo_configs):
+                conversion_dir = self.query_abs_conversion_dir(repo_config)
+                if conversion_dir not in group_indices:
+                    group_indices[conversion_dir] = len(groups)
+                    groups.append([])
+                groups[group_indices[conversion_dir]].append(index)
+        else:
+            groups = [[index] for index in range(len(repo_configs))]
+        num_threads = max(1, min(self.config.get('repo_threads', 1), len(groups)))
+        per_host = max(1, self.config.get('repo_threads_per_host', num_threads))
+        fatal = []
+        results = [None] * len(repo_configs)
+
+        def _run(repo_config):
+            if fatal:
+                return None
+            semaphores = []
+            if remote:
+                with self.repo_map_lock:
+                    for host in self._query_repo_hosts(repo_config, push=push):
+                        semaphores.append(self.host_semaphores.setdefault(
+                            host, threading.BoundedSemaphore(per_host)))
+            # Always acquire in host order, so repos that share more than
+            # one host can't deadlock.
+            for semaphore in semaphores:
+                semaphore.acquire()
+            try:
+                return func(repo_config)
+            except SystemExit, e:
+                fatal.append(e)
+                return None
+            finally:
+                for semaphore in reversed(semaphores):
+                    semaphore.release()
+
+        def _run_group(indices):
+            for index in indices:
+                results[index] = _run(repo_configs[index])
+
+        self.info("Running on %d repos, %d at a time." % (len(repo_configs), num_threads))
+        pool = ThreadPool(num_threads)
+        try:
+            pool.map(_run_group, groups, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        if fatal:
+            raise fatal[0]
+        return results
 
     def _update_stage_repo(self, repo_config, retry=True, clobber=False):
         """ Update a stage repo.
@@ -423,34 +575,126 @@ intree=1
 #            else:
 #                self.fatal("Can't verify %s!" % source_dest)
 
-    def _do_push_repo(self, base_command, refs_list=None, kwargs=None):
-        """ Helper method for _push_repo() since it has to be able to break
-            out of the target_repo list loop, and the commands loop borks that.
+    def _query_git_refs(self, git, git_dir, remote=None, env=None):
+        """ Return {ref: sha} for the refs in git_dir, or with remote set,
+            the refs in that remote repo (one |git ls-remote|).  Returns
+            None if git fails.
             """
-        commands = []
-        if refs_list:
-            while len(refs_list) > 10:
-                commands.append(base_command + refs_list[0:10])
-                refs_list = refs_list[10:]
-            commands.append(base_command + refs_list)
+        if remote is None:
+            command = git + ['for-each-ref', '--format=%(objectname) %(refname)']
         else:
-            commands = [base_command]
+            command = git + ['ls-remote', remote]
+        try:
+            output = self.get_output_from_command(
+                command, cwd=git_dir, env=env, silent=True,
+                throw_exception=True,
+            )
+        except subprocess.CalledProcessError:
+            return None
+        refs = {}
+        for line in (output or '').splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                refs[parts[1]] = parts[0]
+        return refs
+
+    def _query_max_command_length(self):
+        """ How long (in bytes) a push command line may get.  The
+            environment counts towards the system limit too, so only use a
+            quarter of it.
+            """
+        max_length = self.config.get('git_push_max_command_length')
+        if max_length is None:
+            try:
+                max_length = os.sysconf('SC_ARG_MAX') // 4
+            except (AttributeError, ValueError, OSError):
+                max_length = 32 * 1024
+        return max_length
+
+    def _plan_push_commands(self, base_command, refs_list=None,
+                            local_refs=None, remote_refs=None):
+        """ Return the push commands for refs_list.  If local_refs and
+            remote_refs are known, refspecs whose remote ref is already at
+            the local ref's sha are left out; the rest are packed into as
+            few commands as _query_max_command_length() allows.
+            """
+        if not refs_list:
+            return [base_command]
+        if local_refs is not None and remote_refs is not None:
+            refspecs = []
+            for refspec in refs_list:
+                (src, _, dst) = refspec.lstrip('+').partition(':')
+                sha = local_refs.get(src)
+                if sha is None or sha != remote_refs.get(dst or src):
+                    refspecs.append(refspec)
+            if len(refspecs) < len(refs_list):
+                self.info("%d of %d refs are already up to date." %
+                          (len(refs_list) - len(refspecs), len(refs_list)))
+            refs_list = refspecs
+        max_length = self._query_max_command_length()
+        base_length = sum(len(arg) + 1 for arg in base_command)
+        commands = []
+        command = None
+        length = base_length
+        for refspec in refs_list:
+            if command is None or length + len(refspec) + 1 > max_length:
+                command = list(base_command)
+                length = base_length
+                commands.append(command)
+            command.append(refspec)
+            length += len(refspec) + 1
+        return commands
+
+    def _do_push_repo(self, base_command, refs_list=None, kwargs=None,
+                      local_refs=None, remote_refs=None):
+        """ Push refs_list with as few commands as we can; see
+            _plan_push_commands().
+            """
         if kwargs is None:
             kwargs = {}
-        for command in commands:
-            # Do the push, with retry!
+        for command in self._plan_push_commands(base_command, refs_list,
+                                                local_refs, remote_refs):
+            # Do the push, with retry!  Pushes to the same host run in
+            # parallel, so spread their retries out.
             if self.retry(
                 self.run_command,
                 args=(command, ),
                 kwargs=kwargs,
+                jitter=self.config.get('retry_jitter', True),
             ):
                 return -1
 
+    def _push_to_target(self, push, local_refs):
+        """ Push to one target planned by _push_repo().  Returns an error
+            message, or '' on success.
+            """
+        remote_refs = None
+        if push['refs_list'] and local_refs is not None:
+            remote_refs = self._query_git_refs(
+                push['git'], push['kwargs']['cwd'], remote=push['target_git_repo'],
+                env=self.query_env(partial_env=push['kwargs']['partial_env']),
+            )
+            if remote_refs is None:
+                self.warning("Can't list the refs in %s; pushing them all." %
+                             push['target_git_repo'])
+        if self._do_push_repo(push['base_command'], refs_list=push['refs_list'],
+                              kwargs=push['kwargs'], local_refs=local_refs,
+                              remote_refs=remote_refs):
+            self.error(push['error_msg'])
+            return push['error_msg']
+        return ''
+
     def _push_repo(self, repo_config):
         """ Push a repo to a path ("test_push") or remote server.
 
             This was meant to be a cross-vcs method, but currently only
             covers git pushes.
+
+            The refs to push to each target are worked out first.  Test
+            pushes run first, one at a time, and stop everything if one
+            fails.  Then the remote targets are pushed to, several hosts at
+            once (config['target_threads']), leaving out refs that are
+            already up to date on the target.
             """
         dirs = self.query_abs_dirs()
         conversion_dir = self.query_abs_conversion_dir(repo_config)
@@ -460,6 +704,8 @@ intree=1
         git = self.query_exe('git', return_type='list')
         hg = self._query_hg_exe()
         return_status = ''
+        test_pushes = []
+        remote_pushes = {}
         for target_config in repo_config['targets']:
             test_push = False
             remote_config = {}
@@ -544,48 +790,88 @@ intree=1
                                     refs_list += ['+refs/tags/%s:refs/tags/%s' % (tag_name, tag_name)]
                                     continue
                 error_msg = "%s: Can't push %s to %s!\n" % (repo_config['repo_name'], conversion_dir, target_git_repo)
-                if self._do_push_repo(
-                    base_command,
-                    refs_list=refs_list,
-                    kwargs={
+                if test_push:
+                    error_msg += "This was a test push that failed; not proceeding any further with %s!\n" % repo_config['repo_name']
+                push = {
+                    'git': git,
+                    'base_command': base_command,
+                    'refs_list': refs_list,
+                    'target_git_repo': target_git_repo,
+                    'error_msg': error_msg,
+                    'kwargs': {
                         'output_timeout': target_config.get("output_timeout", 30 * 60),
                         'cwd': os.path.join(conversion_dir, '.git'),
                         'error_list': GitErrorList,
                         'partial_env': env,
-                    }
-                ):
-                    if target_config.get("test_push"):
-                        error_msg += "This was a test push that failed; not proceeding any further with %s!\n" % repo_config['repo_name']
-                    self.error(error_msg)
-                    return_status += error_msg
-                    if target_config.get("test_push"):
-                        break
+                    },
+                }
+                if test_push:
+                    test_pushes.append(push)
+                else:
+                    host = self._query_url_host(target_git_repo)
+                    remote_pushes.setdefault(host, []).append(push)
             else:
                 # TODO write hg
                 error_msg = "%s: Don't know how to deal with vcs %s!\n" % (
                     target_config['target_dest'], target_vcs)
                 self.error(error_msg)
                 return_status += error_msg
+        local_refs = self._query_git_refs(git, os.path.join(conversion_dir, '.git'))
+        for push in test_pushes:
+            status = self._push_to_target(push, local_refs)
+            if status:
+                return return_status + status
+        if not remote_pushes:
+            return return_status
+        fatal = []
+
+        def _push_to_host(pushes):
+            statuses = []
+            for push in pushes:
+                try:
+                    statuses.append(self._push_to_target(push, local_refs))
+                except SystemExit, e:
+                    fatal.append(e)
+                    break
+            return statuses
+
+        num_threads = max(1, min(self.config.get('target_threads', 1), len(remote_pushes)))
+        pool = ThreadPool(num_threads)
+        try:
+            results = pool.map(_push_to_host,
+                               [pushes for (_, pushes) in sorted(remote_pushes.items())],
+                               chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        if fatal:
+            raise fatal[0]
+        for statuses in results:
+            return_status += ''.join(statuses)
         return return_status
 
+    def query_mapfile_index(self, mapfile, index_path=None):
+        """ Return the MapfileIndex for the text mapfile `mapfile`, updated
+            with any new mappings in it.  The index lives at index_path, or
+            next to the mapfile by default.
+            """
+        if index_path is None:
+            index_path = "%s.index" % mapfile
+        with self.mapfile_indexes_lock:
+            index = self.mapfile_indexes.get(index_path)
+            if index is None:
+                self.mkdir_p(os.path.dirname(index_path))
+                index = self.mapfile_indexes[index_path] = MapfileIndex(index_path)
+        added = index.update(mapfile)
+        if added:
+            self.info("Indexed %d new mappings from %s in %s." % (added, mapfile, index_path))
+        return index
+
     def _query_mapped_revision(self, revision=None, mapfile=None):
-        """ Use the virtualenv mapper module to search a mapfile for a
-            revision.
+        """ Look up the git revision for a (possibly abbreviated) hg
+            revision in a mapfile.
             """
-        if not callable(self.mapfile_binary_search):
-            site_packages_path = self.query_python_site_packages_path()
-            sys.path.append(os.path.join(site_packages_path, 'mapper'))
-            try:
-                from bsearch import mapfile_binary_search
-                global log
-                log = self.log_obj
-                self.mapfile_binary_search = mapfile_binary_search
-            except ImportError, e:
-                self.fatal("Can't import mapfile_binary_search! %s\nDid you create-virtualenv?" % str(e))
-        # I wish mapper did this for me, but ...
-        fd = open(mapfile, 'rb')
-        m = mmap.mmap(fd.fileno(), 0, mmap.MAP_PRIVATE, mmap.PROT_READ)
-        return self.mapfile_binary_search(m, revision)
+        return self.query_mapfile_index(mapfile).lookup_git(revision)
 
     def _post_fatal(self, message=None, exit_code=None):
         """ After we call fatal(), run this method before exiting.
@@ -626,12 +912,21 @@ intree=1
         """ The write portion of _read_repo_update_json().
             """
         dirs = self.query_abs_dirs()
-        contents = json.dumps(repo_map, sort_keys=True, indent=4)
-        self.write_to_file(
-            os.path.join(dirs['abs_upload_dir'], 'repo_update.json'),
-            contents,
-            create_parent_dir=True
-        )
+        with self.repo_map_lock:
+            contents = json.dumps(repo_map, sort_keys=True, indent=4)
+            self.write_to_file(
+                os.path.join(dirs['abs_upload_dir'], 'repo_update.json'),
+                contents,
+                create_parent_dir=True
+            )
+
+    def get_output_from_command(self, command, **kwargs):
+        """ Repos are updated on several threads at once, so give each
+            thread its own tmpfiles.
+            """
+        kwargs.setdefault('tmpfile_base_path',
+                          'tmpfile-%s' % threading.current_thread().name)
+        return super(HgGitScript, self).get_output_from_command(command, **kwargs)
 
     def _query_hg_exe(self):
         """Returns the hg executable command as a list
@@ -688,7 +983,9 @@ intree=1
         """ Adapted from repo-sync-tools/combine_mapfiles
 
             Consolidate multiple conversion processes' mapfiles into a
-            single mapfile.
+            single mapfile, sorted by hg sha.  Each mapfile is indexed in
+            abs_mapfile_index_dir, so this is a streaming merge of the
+            already sorted indexes rather than a |sort| of every mapfile.
             """
         self.info("Determining whether we need to combine mapfiles...")
         if cwd is None:
@@ -712,18 +1009,110 @@ intree=1
                 self.info("No new mapfiles to combine.")
                 return
             self.move(combined_mapfile_path, "%s.old" % combined_mapfile_path)
-        output = self.get_output_from_command(
-            ['sort', '--unique', '-t', ' ',
-             '--key=2'] + existing_mapfiles,
-            silent=True, halt_on_failure=True,
-            cwd=cwd,
-        )
-        self.write_to_file(combined_mapfile_path, output, verbose=False,
-                           error_level=FATAL)
+        index_dir = self.query_abs_dirs()['abs_mapfile_index_dir']
+        indexes = [self.query_mapfile_index(os.path.join(cwd, f),
+                                            index_path=os.path.join(index_dir, f))
+                   for f in existing_mapfiles]
+        try:
+            count = merge_mapfiles(indexes, combined_mapfile_path)
+        except (IOError, OSError), e:
+            self.fatal("Can't write %s: %s" % (combined_mapfile_path, str(e)))
+        self.info("Wrote %d mappings to %s." % (count, combined_mapfile_path))
         self.run_command(['ln', '-sf', combined_mapfile,
                           '%s-latest' % combined_mapfile],
                          cwd=cwd)
 
+    def _run_git_with_input(self, command, input_data, cwd):
+        """ Run a git command that reads input_data on stdin, such as
+            |git cat-file --batch| or |git fast-import|.  Return its output,
+            or None if it failed.
+            """
+        self.info("Running command: %s in %s (%d bytes of input)" %
+                  (command, cwd, len(input_data)))
+        try:
+            p = subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, errors = p.communicate(input_data)
+        except OSError, e:
+            self.error("Can't run %s: %s" % (command, str(e)))
+            return None
+        if p.returncode:
+            self.error("%s returned %d: %s" % (command, p.returncode, errors))
+            return None
+        return output
+
+    def _query_git_notes(self, git_dir, git_shas):
+        """ Return a dict of {git_sha: note} for the commits in git_shas that
+            have a note in refs/notes/commits, reading all the notes with one
+            |git notes list| and one |git cat-file --batch|.
+            """
+        git = self.query_exe("git", return_type="list")
+        output = self.get_output_from_command(
+            git + ['notes', 'list'],
+            cwd=git_dir, silent=True, ignore_errors=True,
+        )
+        note_blobs = {}
+        for line in (output or '').splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                note_blobs[parts[1]] = parts[0]
+        wanted = [git_sha for git_sha in git_shas if git_sha in note_blobs]
+        notes = {}
+        if not wanted:
+            return notes
+        output = self._run_git_with_input(
+            git + ['cat-file', '--batch'],
+            ''.join('%s\n' % note_blobs[git_sha] for git_sha in wanted),
+            cwd=git_dir,
+        )
+        if output is None:
+            return None
+        # Each blob comes back as "<sha> blob <size>\n<contents>\n".
+        pos = 0
+        for git_sha in wanted:
+            header_end = output.index('\n', pos)
+            size = int(output[pos:header_end].split()[2])
+            notes[git_sha] = output[header_end + 1:header_end + 1 + size]
+            pos = header_end + 1 + size + 1
+        return notes
+
+    def _write_git_notes(self, git_dir, notes):
+        """ Set the notes ({git_sha: note}) in refs/notes/commits, all in
+            one commit made with a single |git fast-import|.  Returns True if
+            successful.
+            """
+        if not notes:
+            return True
+        git = self.query_exe("git", return_type="list")
+        ident = self.get_output_from_command(
+            git + ['var', 'GIT_COMMITTER_IDENT'],
+            cwd=git_dir, silent=True,
+        )
+        if not ident:
+            self.error("Can't get a committer identity for git notes in %s!" % git_dir)
+            return False
+        parent = self.get_output_from_command(
+            git + ['rev-parse', '--verify', '-q', 'refs/notes/commits'],
+            cwd=git_dir, silent=True, ignore_errors=True,
+        )
+
+        def data(contents):
+            return 'data %d\n%s\n' % (len(contents), contents)
+
+        stream = [
+            'commit refs/notes/commits\n',
+            'committer %s\n' % ident.strip(),
+            data('Notes added by vcs_sync.py'),
+        ]
+        if parent and parent.strip():
+            stream.append('from %s\n' % parent.strip())
+        for git_sha in sorted(notes):
+            stream.append('N inline %s\n' % git_sha)
+            stream.append(data(notes[git_sha]))
+        return self._run_git_with_input(
+            git + ['fast-import', '--quiet'], ''.join(stream), cwd=git_dir,
+        ) is not None
+
     # Actions {{{1
 
     def list_repos(self):
@@ -759,108 +1148,150 @@ intree=1
             We pull the stage mirror into the work mirror, where the conversion
             is done.
             """
-        for repo_config in self.query_all_non_failed_repos():
-            self._update_stage_repo(repo_config)
+        self._run_on_repos(self._update_stage_repo)
 
-    def pull_out_new_sha_lookups(self, old_file, new_file):
-        """ This method will return an iterator which iterates through lines in file
-            new_file that do not exist in old_file. If old_file can't be read, all
-            lines in new_file are returned. It does not cause any problems if lines
-            exist in old_file that do not exist in new_file. Results are sorted by
-            the second field (text after first space in line).
+    def query_new_sha_lookups(self, done_file, mapfile):
+        """ Return (index, new_lookups) for the mappings in the mapfile
+            that mark_sha_lookups_done() hasn't recorded in done_file yet.
+            index is the mapfile's MapfileIndex, and new_lookups a list of
+            (position in index, "<git sha> <hg sha>\n" line) in the order
+            they were indexed.  If done_file can't be read, all the
+            mappings are new.
 
-            This is somewhat equivalent to:
-               ( [ ! -f "${old_file}" ] && cat "${new_file}" || diff "${old_file}" "${new_file}" | sed -n 's/> //p' ) | sort -k2"""
-        with self.opened(old_file) as (old, err):
-            if err:
-                self.info('Map file %s not found - probably first time this has run.' % old_file)
-                old_set = frozenset()
-            else:
-                old_set = frozenset(old)
-        with self.opened(new_file, 'rt') as (new, err):
+            done_file used to be a copy of the whole mapfile; if it still
+            is, the new mappings are worked out with a set difference.
+            """
+        index = self.query_mapfile_index(mapfile)
+        watermark = 0
+        done_ranges = []
+        old_set = None
+        with self.opened(done_file) as (done, err):
             if err:
-                self.error('Could not read contents of map file %s:\n%s' % (new_file, err.message))
-                new_set = frozenset()
+                self.info('Map file %s not found - probably first time this has run.' % done_file)
             else:
-                new_set = frozenset(new)
-        for line in sorted(new_set.difference(old_set), key=lambda line: line.partition(' ')[2]):
-            yield line
+                first_line = done.readline()
+                watermark = index.parse_watermark(first_line)
+                if watermark is None:
+                    self.info('%s is not a watermark for %s; diffing the whole mapfile.' %
+                              (done_file, index.path))
+                    watermark = 0
+                    old_set = frozenset([first_line]).union(done)
+                else:
+                    for line in done:
+                        fields = line.split()
+                        if len(fields) == 2 and fields[0].isdigit() and fields[1].isdigit():
+                            done_ranges.append((int(fields[0]), int(fields[1])))
+        done_ranges.sort()
+        new_lookups = []
+        for position, mapping in enumerate(index.since(watermark), watermark):
+            while done_ranges and done_ranges[0][1] <= position:
+                done_ranges.pop(0)
+            if done_ranges and done_ranges[0][0] <= position:
+                continue
+            line = '%s %s\n' % mapping
+            if old_set is None or line not in old_set:
+                new_lookups.append((position, line))
+        return index, new_lookups
 
-    def update_work_mirror(self):
-        """ Pull the latest changes into the work mirror, update the repo_map
-            json, and run |hg gexport| to convert those latest changes into
-            the git conversion repo.
+    def pull_out_new_sha_lookups(self, old_file, new_file):
+        """ Return the lines in mapfile new_file that aren't recorded as done
+            in old_file; see query_new_sha_lookups().  Results are sorted by
+            the second field (text after first space in line).
+            """
+        new_lookups = self.query_new_sha_lookups(old_file, new_file)[1]
+        return sorted((line for (position, line) in new_lookups),
+                      key=lambda line: line.partition(' ')[2])
+
+    def mark_sha_lookups_done(self, done_file, index, unfinished=()):
+        """ Record in done_file that the mappings in index, apart from the
+            ones at the positions in `unfinished`, have been handled.  This
+            is a watermark, followed by "<start> <end>" lines for any done
+            ranges past it.
+            """
+        done_ranges = []
+        start = 0
+        for position in sorted(unfinished):
+            if position > start:
+                done_ranges.append((start, position))
+            start = position + 1
+        if start < len(index):
+            done_ranges.append((start, len(index)))
+        watermark = 0
+        if done_ranges and done_ranges[0][0] == 0:
+            watermark = done_ranges.pop(0)[1]
+        contents = index.query_watermark(watermark) + \
+            ''.join('%d %d\n' % r for r in done_ranges)
+        self.write_to_file(done_file, contents, verbose=False)
+
+    def _update_work_repo(self, repo_config, repo_map):
+        """ Pull one repo's stage mirror into its work mirror and convert it,
+            recording the branches in repo_map.  See update_work_mirror().
             """
         hg = self._query_hg_exe()
         git = self.query_exe("git", return_type="list")
         dirs = self.query_abs_dirs()
-        repo_map = self._read_repo_update_json()
-        timestamp = int(time.time())
-        datetime = time.strftime('%Y-%m-%d %H:%M %Z')
-        repo_map['last_pull_timestamp'] = timestamp
-        repo_map['last_pull_datetime'] = datetime
-        for repo_config in self.query_all_non_failed_repos():
-            repo_name = repo_config['repo_name']
-            source = os.path.join(dirs['abs_source_dir'], repo_name)
-            dest = self.query_abs_conversion_dir(repo_config)
-            if not dest:
-                self.fatal("No conversion_dir for %s!" % repo_name)
-            if not os.path.exists(dest):
-                self.mkdir_p(os.path.dirname(dest))
-                self.run_command(hg + ['clone', '--noupdate', source, dest],
-                                 error_list=HgErrorList,
-                                 halt_on_failure=False)
-                if os.path.exists(dest):
-                    self.write_hggit_hgrc(dest)
-                    self.init_git_repo('%s/.git' % dest, additional_args=['--bare'])
-                    self.run_command(
-                    git + ['--git-dir', '%s/.git' % dest, 'config', 'gc.auto', '0'],
-                    )
-                else:
-                    self.add_failure(
-                        repo_name,
-                        message="Failed to clone %s!" % source,
-                        level=ERROR,
-                    )
-                    continue
-            # Build branch map.
-            branch_map = self.query_branches(
-                repo_config.get('branch_config', {}),
-                source,
+        repo_name = repo_config['repo_name']
+        source = os.path.join(dirs['abs_source_dir'], repo_name)
+        dest = self.query_abs_conversion_dir(repo_config)
+        if not dest:
+            self.fatal("No conversion_dir for %s!" % repo_name)
+        if not os.path.exists(dest):
+            self.mkdir_p(os.path.dirname(dest))
+            self.run_command(hg + ['clone', '--noupdate', source, dest],
+                             error_list=HgErrorList,
+                             halt_on_failure=False)
+            if os.path.exists(dest):
+                self.write_hggit_hgrc(dest)
+                self.init_git_repo('%s/.git' % dest, additional_args=['--bare'])
+                self.run_command(
+                git + ['--git-dir', '%s/.git' % dest, 'config', 'gc.auto', '0'],
+                )
+            else:
+                self.add_failure(
+                    repo_name,
+                    message="Failed to clone %s!" % source,
+                    level=ERROR,
+                )
+                return
+        # Build branch map.
+        branch_map = self.query_branches(
+            repo_config.get('branch_config', {}),
+            source,
+        )
+        for (branch, target_branch) in branch_map.items():
+            output = self.get_output_from_command(
+                hg + ['id', '-r', branch],
+                cwd=source
             )
-            for (branch, target_branch) in branch_map.items():
-                output = self.get_output_from_command(
-                    hg + ['id', '-r', branch],
-                    cwd=source
+            if output:
+                rev = output.split(' ')[0]
+            else:
+                self.add_failure(
+                    repo_name,
+                    message="Branch %s doesn't exist in %s (%s cloned into staging directory %s)!" % (branch, repo_name, repo_config.get('repo'), source),
+                    level=ERROR,
                 )
-                if output:
-                    rev = output.split(' ')[0]
-                else:
-                    self.add_failure(
-                        repo_name,
-                        message="Branch %s doesn't exist in %s (%s cloned into staging directory %s)!" % (branch, repo_name, repo_config.get('repo'), source),
-                        level=ERROR,
-                    )
-                    continue
-                timestamp = int(time.time())
-                datetime = time.strftime('%Y-%m-%d %H:%M %Z')
-                if self.run_command(hg + ['pull', '-r', rev, source], cwd=dest,
-                                    error_list=HgErrorList):
-                    # We shouldn't have an issue pulling!
-                    self.add_failure(
-                        repo_name,
-                        message="Unable to pull %s from stage_source; clobbering and skipping!" % repo_name,
-                        level=ERROR,
-                    )
-                    self._update_repo_previous_status(repo_name, successful_flag=False, write_update=True)
-                    # don't leave a dirty checkout behind, and skip remaining branches
-                    self.rmtree(source)
-                    break
-                self.run_command(
-                    hg + ['bookmark', '-f', '-r', rev, target_branch],
-                    cwd=dest, error_list=HgErrorList,
+                continue
+            timestamp = int(time.time())
+            datetime = time.strftime('%Y-%m-%d %H:%M %Z')
+            if self.run_command(hg + ['pull', '-r', rev, source], cwd=dest,
+                                error_list=HgErrorList):
+                # We shouldn't have an issue pulling!
+                self.add_failure(
+                    repo_name,
+                    message="Unable to pull %s from stage_source; clobbering and skipping!" % repo_name,
+                    level=ERROR,
                 )
-                # This might get a little large.
+                self._update_repo_previous_status(repo_name, successful_flag=False, write_update=True)
+                # don't leave a dirty checkout behind, and skip remaining branches
+                self.rmtree(source)
+                break
+            self.run_command(
+                hg + ['bookmark', '-f', '-r', rev, target_branch],
+                cwd=dest, error_list=HgErrorList,
+            )
+            # This might get a little large.
+            with self.repo_map_lock:
                 repo_map.setdefault('repos', {}).setdefault(repo_name, {}).setdefault('branches', {})[branch] = {
                     'hg_branch': branch,
                     'hg_revision': rev,
@@ -868,42 +1299,74 @@ intree=1
                     'pull_timestamp': timestamp,
                     'pull_datetime': datetime,
                 }
-            if self.query_failure(repo_name):
-                # We hit an error in the for loop above
-                continue
-            self.retry(
-                self.run_command,
-                args=(hg + ['-v', 'gexport'], ),
-                kwargs={
-                    'output_timeout': 15 * 60,
-                    'cwd': dest,
-                    'error_list': HgErrorList,
-                },
-                error_level=FATAL,
-            )
-            generated_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
-            self.copy_to_upload_dir(
-                generated_mapfile,
-                dest=repo_config.get('mapfile_name', self.config.get('mapfile_name', "gecko-mapfile")),
-                log_level=INFO
-            )
-            for (branch, target_branch) in branch_map.items():
-                git_revision = self._query_mapped_revision(
-                    revision=rev, mapfile=generated_mapfile)
-                repo_map['repos'][repo_name]['branches'][branch]['git_revision'] = git_revision
-        self._write_repo_update_json(repo_map)
+        if self.query_failure(repo_name):
+            # We hit an error in the for loop above
+            return
+        self.retry(
+            self.run_command,
+            args=(hg + ['-v', 'gexport'], ),
+            kwargs={
+                'output_timeout': 15 * 60,
+                'cwd': dest,
+                'error_list': HgErrorList,
+            },
+            error_level=FATAL,
+        )
+        generated_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
+        self.copy_to_upload_dir(
+            generated_mapfile,
+            dest=repo_config.get('mapfile_name', self.config.get('mapfile_name', "gecko-mapfile")),
+            log_level=INFO
+        )
+        for (branch, target_branch) in branch_map.items():
+            with self.repo_map_lock:
+                branch_info = repo_map['repos'][repo_name]['branches'][branch]
+            git_revision = self._query_mapped_revision(
+                revision=branch_info['hg_revision'], mapfile=generated_mapfile)
+            with self.repo_map_lock:
+                branch_info['git_revision'] = git_revision
 
+    def update_work_mirror(self):
+        """ Pull the latest changes into the work mirror, update the repo_map
+            json, and run |hg gexport| to convert those latest changes into
+            the git conversion repo.
+
+            Repos with different conversion dirs are converted several at a
+            time; see _run_on_repos().
+            """
+        repo_map = self.query_repo_map()
+        timestamp = int(time.time())
+        datetime = time.strftime('%Y-%m-%d %H:%M %Z')
+        with self.repo_map_lock:
+            repo_map['last_pull_timestamp'] = timestamp
+            repo_map['last_pull_datetime'] = datetime
+        # This only works with local clones, so there's no need to limit the
+        # number of repos per remote host.  Repos that share a conversion dir
+        # pull, bookmark and gexport in the same work repo, so they run one
+        # at a time.
+        self._run_on_repos(
+            lambda repo_config: self._update_work_repo(repo_config, repo_map),
+            remote=False, by_conversion_dir=True,
+        )
+        self._write_repo_update_json(repo_map)
 
     def create_git_notes(self):
-        git = self.query_exe("git", return_type="list")
+        """ Add an "Upstream source" git note to each newly converted commit.
+
+            The existing notes are read in one go, the missing ones are
+            worked out in memory, and they're all written in a single
+            commit to refs/notes/commits.  Notes that are already there are
+            left alone, and any other notes on a commit (devs may have added
+            their own) are appended to, not replaced.
+            """
         for repo_config in self.query_all_non_failed_repos():
             repo = repo_config['repo']
             if repo_config.get('generate_git_notes', False):
                 dest = self.query_abs_conversion_dir(repo_config)
                 # 'git-mapfile' is created by hggit plugin, containing all the mappings
                 complete_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
-                # 'added-to-git-notes' is the set of mappings known to be recorded in the git notes
-                # of the project (typically 'git-mapfile' from previous run)
+                # 'added-to-git-notes' is a watermark in the git-mapfile index, up to which the
+                # mappings are known to be recorded in the git notes of the project
                 added_to_git_notes = os.path.join(dest, '.hg', 'added-to-git-notes')
                 # 'delta-git-notes' is the set of new mappings found on this iteration, that
                 # now need to be added to the git notes of the project (the diff between the
@@ -911,100 +1374,96 @@ intree=1
                 delta_git_notes = os.path.join(dest, '.hg', 'delta-git-notes')
                 git_dir = os.path.join(dest, '.git')
                 self.rmtree(delta_git_notes)
-                git_notes_adding_successful = True
+                sha_lookups = self.pull_out_new_sha_lookups(added_to_git_notes, complete_mapfile)
+                mappings = [sha_lookup.split() for sha_lookup in sha_lookups]
+                existing_notes = self._query_git_notes(git_dir, [git_sha for (git_sha, hg_sha) in mappings])
+                if existing_notes is None:
+                    self.error("Could not read the existing git notes in %s" % git_dir)
+                    continue
+                new_notes = {}
+                for (git_sha, hg_sha) in mappings:
+                    git_note_text = 'Upstream source: %s/rev/%s' % (repo, hg_sha)
+                    note = new_notes.get(git_sha, existing_notes.get(git_sha))
+                    if not note:
+                        new_notes[git_sha] = git_note_text + '\n'
+                    elif note.find(git_note_text) < 0:
+                        # Same as |git notes append|
+                        new_notes[git_sha] = note.rstrip('\n') + '\n\n' + git_note_text + '\n'
+                self.info("Adding %d git notes for %d new mappings in %s." %
+                          (len(new_notes), len(mappings), git_dir))
+                git_notes_adding_successful = self._write_git_notes(git_dir, new_notes)
+                if not git_notes_adding_successful:
+                    self.error("Was not able to append the required git notes in %s" % git_dir)
                 with self.opened(delta_git_notes, open_mode='w') as (delta_out, err):
                     if err:
                         git_notes_adding_successful = False
                         self.warn("Could not write list of unprocessed git note mappings to file %s - not critical" % delta_git_notes)
                     else:
-                        for sha_lookup in self.pull_out_new_sha_lookups(added_to_git_notes, complete_mapfile):
-                            print >>delta_out, sha_lookup,
-                            (git_sha, hg_sha) = sha_lookup.split()
-                            # only add git note if not already there - note
-                            # devs may have added their own notes, so don't
-                            # replace any existing notes, just add to them
-                            output = self.get_output_from_command(
-                                git + ['notes', 'show', git_sha],
-                                cwd=git_dir,
-                                ignore_errors=True
-                            )
-                            git_note_text='Upstream source: %s/rev/%s' % (repo, hg_sha)
-                            git_notes_add_return_code = 1
-                            if not output or output.find(git_note_text) < 0:
-                                git_notes_add_return_code = self.run_command(
-                                    git + ['notes', 'append', '-m', git_note_text, git_sha],
-                                    cwd=git_dir
-                                )
-                            # if note was successfully added, or it was already there, we can
-                            # mark it as added, by putting it in the delta file...
-                            if git_notes_add_return_code == 0 or output.find(git_note_text) >= 0:
+                        # If the notes were successfully added, or they were
+                        # already there, we can mark them as added, by putting
+                        # them in the delta file...
+                        for sha_lookup, (git_sha, hg_sha) in zip(sha_lookups, mappings):
+                            if git_notes_adding_successful or git_sha not in new_notes:
                                 print >>delta_out, sha_lookup,
-                            else:
-                                self.error("Was not able to append required git note for git commit %s ('%s')" % (git_sha, git_note_text))
-                                git_notes_adding_successful = False
                 if git_notes_adding_successful:
-                    self.copyfile(complete_mapfile, added_to_git_notes)
+                    self.mark_sha_lookups_done(added_to_git_notes,
+                                               self.query_mapfile_index(complete_mapfile))
             else:
                 self.info("Not creating git notes for repo %s (generate_git_notes not set to True)" % repo)
 
     def publish_to_mapper(self):
-        """ This method will attempt to create git notes for any new git<->hg mappings
-            found in the generated_mapfile file and also push new mappings to mapper service."""
+        """ Publish any new git<->hg mappings found in the generated_mapfile
+            to the mapper service, several chunks at a time (see
+            MapperMixin.publish_mappings()).
+
+            Whatever gets published is recorded in published-to-mapper,
+            even if some chunks failed, so the next run only retries the
+            mappings that didn't make it.
+            """
         for repo_config in self.query_all_non_failed_repos():
             dest = self.query_abs_conversion_dir(repo_config)
             # 'git-mapfile' is created by hggit plugin, containing all the mappings
             complete_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
-            # 'published-to-mapper' is all the mappings that are known to be published
-            # to mapper, for this project (typically the 'git-mapfile' from the previous
-            # run)
+            # 'published-to-mapper' records which mappings in the git-mapfile index are
+            # known to be published to mapper, for this project
             published_to_mapper = os.path.join(dest, '.hg', 'published-to-mapper')
             # 'delta-for-mapper' is the set of mappings that need to be published to
-            # mapper on this iteration, i.e. the diff between the previous two files
-            # described
+            # mapper on this iteration
             delta_for_mapper = os.path.join(dest, '.hg', 'delta-for-mapper')
             self.rmtree(delta_for_mapper)
-            # we only replace published_to_mapper if we successfully updated
-            # pushed to mapper
+            index, new_lookups = self.query_new_sha_lookups(published_to_mapper, complete_mapfile)
             mapper_config = repo_config.get('mapper', {})
-            if mapper_config:
-                site_packages_path = self.query_python_site_packages_path()
-                if site_packages_path not in sys.path:
-                    sys.path.append(site_packages_path)
-                try:
-                    import requests
-                except ImportError as e:
-                    self.error("Can't import requests: %s\nDid you create-virtualenv?" % str(e))
-                mapper_url = mapper_config['url']
-                mapper_project = mapper_config['project']
-                insert_url = "%s/%s/insert/ignoredups" % (mapper_url, mapper_project)
-                headers = {
-                    'Content-Type': 'text/plain',
-                    'Authentication': 'Bearer %s' % os.environ["RELENGAPI_INSERT_HGGIT_MAPPINGS_AUTH_TOKEN"]
-                }
-                all_new_mappings = []
-                all_new_mappings.extend(self.pull_out_new_sha_lookups(published_to_mapper, complete_mapfile))
-                self.write_to_file(delta_for_mapper, "".join(all_new_mappings))
-                # due to timeouts on load balancer, we only push 200 lines at a time
-                # this means that we should get http response back within 30 seconds
-                # including the time it takes to insert the mappings in the database
-                publish_successful = True
-                for i in range(0, len(all_new_mappings), 200):
-                    r = requests.post(insert_url, data="".join(all_new_mappings[i:i+200]), headers=headers)
-                    if (r.status_code != 200):
-                        self.error("Could not publish mapfile ('%s') line range [%s, %s] to mapper (%s) - received http %s code" % (delta_for_mapper, i, i+200, insert_url, r.status_code))
-                        publish_successful = False
-                        # we won't break out, since we may be able to publish other mappings
-                        # and duplicates are allowed, so we will push the whole lot again next
-                        # time anyway
-                    else:
-                        self.info("Published mapfile ('%s') line range [%s, %s] to mapper (%s)" % (delta_for_mapper, i, i+200, insert_url))
-                if publish_successful:
-                    # if we get this far, we know we could successfully post to mapper, so now
-                    # we can copy the mapfile over "previously generated" version
-                    # so that we don't push to mapper for these commits again
-                    self.copyfile(complete_mapfile, published_to_mapper)
-            else:
-                self.copyfile(complete_mapfile, published_to_mapper)
+            if not mapper_config:
+                self.mark_sha_lookups_done(published_to_mapper, index)
+                continue
+            mapper_url = mapper_config['url']
+            mapper_project = mapper_config['project']
+            insert_url = "%s/%s/insert/ignoredups" % (mapper_url, mapper_project)
+            headers = {
+                'Content-Type': 'text/plain',
+                'Authentication': 'Bearer %s' % os.environ["RELENGAPI_INSERT_HGGIT_MAPPINGS_AUTH_TOKEN"]
+            }
+            lines = [line for (position, line) in new_lookups]
+            self.write_to_file(delta_for_mapper, "".join(lines))
+            # Chunks start at 200 lines and are resized to get an http
+            # response back well within the load balancer's timeout,
+            # including the time it takes to insert the mappings in the
+            # database.
+            published = self.publish_mappings(
+                insert_url, lines, headers=headers,
+                num_threads=mapper_config.get('publish_threads'),
+                chunk_size=mapper_config.get('chunk_size', 200),
+                project_name=mapper_project,
+            )
+            unfinished = set(position for (position, line) in new_lookups)
+            for (start, end) in published:
+                unfinished.difference_update(position for (position, line) in new_lookups[start:end])
+            if unfinished:
+                self.error("Could not publish %d of %d mappings from %s to mapper (%s); they'll be retried next time." %
+                           (len(unfinished), len(lines), delta_for_mapper, insert_url))
+            # Duplicates are allowed, but there's no need to push the
+            # published mappings again.
+            self.mark_sha_lookups_done(published_to_mapper, index, unfinished)
 
     def combine_mapfiles(self):
         """ This method is for any job (l10n, project-branches) that needs to combine
@@ -1034,22 +1493,15 @@ intree=1
             return
         self._combine_mapfiles(mapfiles, self.config['combined_mapfile'])
 
-    def push(self):
-        """ Push to all targets.  test_targets are local directory test repos;
-            the rest are remote.  Updates the repo_map json.
+    def _push_and_record(self, repo_config, repo_map):
+        """ Push one repo with _push_repo(), and record how it went in
+            repo_map.  Returns _push_repo()'s status.
             """
-        self.create_test_targets()
-        repo_map = self._read_repo_update_json()
-        failure_msg = ""
         timestamp = int(time.time())
         datetime = time.strftime('%Y-%m-%d %H:%M %Z')
-        repo_map['last_push_timestamp'] = timestamp
-        repo_map['last_push_datetime'] = datetime
-        for repo_config in self.query_all_non_failed_repos():
-            timestamp = int(time.time())
-            datetime = time.strftime('%Y-%m-%d %H:%M %Z')
-            status = self._push_repo(repo_config)
-            repo_name = repo_config['repo_name']
+        status = self._push_repo(repo_config)
+        repo_name = repo_config['repo_name']
+        with self.repo_map_lock:
             if not status:  # good
                 if repo_name not in self.successful_repos:
                     self.successful_repos.append(repo_name)
@@ -1067,12 +1519,35 @@ intree=1
                     message="Unable to push %s." % repo_name,
                     level=ERROR,
                 )
-                failure_msg += status + "\n"
                 self._update_repo_previous_status(repo_name, successful_flag=False, repo_map=repo_map, write_update=True)
-        if not failure_msg:
-            repo_map['last_successful_push_timestamp'] = repo_map['last_push_timestamp']
-            repo_map['last_successful_push_datetime'] = repo_map['last_push_datetime']
-        self._write_repo_update_json(repo_map)
+        return status
+
+    def push(self):
+        """ Push to all targets.  test_targets are local directory test repos;
+            the rest are remote.  Updates the repo_map json.
+
+            Repos with different conversion dirs are pushed several at a
+            time; see _run_on_repos().
+            """
+        self.create_test_targets()
+        repo_map = self.query_repo_map()
+        timestamp = int(time.time())
+        datetime = time.strftime('%Y-%m-%d %H:%M %Z')
+        with self.repo_map_lock:
+            repo_map['last_push_timestamp'] = timestamp
+            repo_map['last_push_datetime'] = datetime
+        # Repos that share a conversion dir push from the same git repo, so
+        # they're pushed one at a time.
+        statuses = self._run_on_repos(
+            lambda repo_config: self._push_and_record(repo_config, repo_map),
+            push=True, by_conversion_dir=True,
+        )
+        failure_msg = "".join(status + "\n" for status in statuses if status)
+        with self.repo_map_lock:
+            if not failure_msg:
+                repo_map['last_successful_push_timestamp'] = repo_map['last_push_timestamp']
+                repo_map['last_successful_push_datetime'] = repo_map['last_push_datetime']
+            self._write_repo_update_json(repo_map)
         if failure_msg:
             self.fatal("Unable to push these repos:\n%s" % failure_msg)
 
@@ -0,0 +1,34 @@
+"""A threaded local HTTP server for tests that talk to fake web services.
+
+The tests set whatever state their request handler needs as attributes on
+the server, e.g.
+
+    server, base_url = start_fake_server(FakeHandler, requests=[])
+    ...
+    stop_fake_server(server)
+"""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_fake_server(handler_class, **attributes):
+    """Serve handler_class on a free 127.0.0.1 port from a daemon thread,
+    with `attributes` set on the server.  Returns (server, base_url)."""
+    server = FakeServer(('127.0.0.1', 0), handler_class)
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+def stop_fake_server(server):
+    server.shutdown()
+    server.server_close()
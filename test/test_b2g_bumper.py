@@ -0,0 +1,116 @@
+import gc
+import imp
+import json
+import mock
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+import mozharness.base.log as log
+from mozharness.base.log import ERROR
+import mozharness.base.script as script
+
+MH_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+b2g_bumper = imp.load_source('b2g_bumper',
+                             os.path.join(MH_DIR, 'scripts', 'b2g_bumper.py'))
+
+
+class CleanupObj(script.ScriptMixin, log.LogMixin):
+    def __init__(self):
+        super(CleanupObj, self).__init__()
+        self.log_obj = None
+        self.config = {'log_level': ERROR}
+
+
+def cleanup():
+    gc.collect()
+    c = CleanupObj()
+    for f in ('test_logs', 'test_dir'):
+        c.rmtree(f)
+
+
+def git(*args, **kwargs):
+    env = dict(os.environ)
+    env.update({
+        'GIT_AUTHOR_NAME': 'test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+        'GIT_COMMITTER_NAME': 'test', 'GIT_COMMITTER_EMAIL': 'test@example.com',
+    })
+    return subprocess.check_output(('git', ) + args, env=env, **kwargs).strip()
+
+
+class TestGitRefs(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        self.remote = os.path.abspath('test_dir/remote')
+        git('init', '-q', self.remote)
+        git('commit', '-q', '--allow-empty', '-m', 'one', cwd=self.remote)
+        self.master = git('rev-parse', 'HEAD', cwd=self.remote)
+        git('tag', 'foo', cwd=self.remote)
+        git('checkout', '-q', '-b', 'b2g/v2.0', cwd=self.remote)
+        git('commit', '-q', '--allow-empty', '-m', 'two', cwd=self.remote)
+        self.branch = git('rev-parse', 'HEAD', cwd=self.remote)
+        config_file = os.path.abspath('test_dir/b2g_bumper.json')
+        with open(config_file, 'w') as fh:
+            json.dump({'gecko_local_dir': 'gecko'}, fh)
+        argv = sys.argv
+        sys.argv = ['b2g_bumper.py', '--config-file', config_file,
+                    '--log-level', 'error',
+                    '--base-work-dir', 'test_dir', '--work-dir', 'build']
+        try:
+            self.s = b2g_bumper.B2GBumper()
+        finally:
+            sys.argv = argv
+
+    def tearDown(self):
+        del self.s
+        cleanup()
+
+    def test_resolve_git_refs(self):
+        revisions = {
+            'b2g/v2.0': self.branch,
+            'refs/heads/b2g/v2.0': self.branch,
+            'tags/foo': self.master,
+            'foo': self.master,
+            'missing': None,
+        }
+        with mock.patch.object(self.s, 'query_git_refs',
+                               wraps=self.s.query_git_refs) as query_git_refs:
+            self.s.resolve_git_refs([(self.remote, r) for r in revisions])
+            # One git ls-remote for all the refs on the remote
+            self.assertEqual(query_git_refs.call_count, 1)
+            for revision, expected in revisions.items():
+                self.assertEqual(self.s.resolve_git_ref(self.remote, revision),
+                                 expected, msg=revision)
+            # Everything but the missing ref was cached.
+            self.assertEqual(query_git_refs.call_count, 2)
+
+    def test_git_ref_cache_ttl(self):
+        now = time.time()
+        self.s.write_to_file(self.s.git_ref_cache_file, json.dumps({
+            'url:fresh': {'revision': 'a' * 40, 'time': now - 60},
+            'url:expired': {'revision': 'b' * 40, 'time': now - 7200},
+        }), create_parent_dir=True)
+        self.s.import_git_ref_cache()
+        self.assertEqual(self.s._git_ref_cache, {'url:fresh': 'a' * 40})
+        self.s.export_git_ref_cache()
+        self.assertEqual(json.load(open(self.s.git_ref_cache_file)),
+                         {'url:fresh': {'revision': 'a' * 40, 'time': now - 60}})
+
+    def test_git_ref_cache_old_format(self):
+        # Entries without times are as old as the file.
+        self.s.write_to_file(self.s.git_ref_cache_file,
+                             json.dumps({'url:ref': 'c' * 40}),
+                             create_parent_dir=True)
+        self.s.import_git_ref_cache()
+        self.assertEqual(self.s._git_ref_cache, {'url:ref': 'c' * 40})
+        self.s._git_ref_cache = {}
+        old = time.time() - 7200
+        os.utime(self.s.git_ref_cache_file, (old, old))
+        self.s.import_git_ref_cache()
+        self.assertEqual(self.s._git_ref_cache, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
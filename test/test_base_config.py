@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import unittest
 
 JSON_TYPE = None
@@ -304,5 +306,114 @@ class TestActions(unittest.TestCase):
         self.assertEqual(['a', 'e'], c.get_actions(),
                          msg="--ACTION broken")
 
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.config_dir = tempfile.mkdtemp()
+        self.old_env = dict(os.environ)
+        os.environ['MOZHARNESS_CONFIG_CACHE'] = self.cache_dir
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.old_env)
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.config_dir)
+
+    def _write_config(self, contents, name='test_config.py'):
+        path = os.path.join(self.config_dir, name)
+        with open(path, 'w') as fh:
+            fh.write(contents)
+        return path
+
+    def test_cache_hit(self):
+        path = self._write_config('config = {"a": 1, "b": [2, 3]}\n')
+        self.assertEqual(config.parse_config_file(path), {"a": 1, "b": [2, 3]})
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        # Tamper with the cache entry to prove it's what we read back.
+        cache_path = config._query_config_cache_path(path, 'config')
+        with open(cache_path, 'rb') as fh:
+            entry = config.marshal.load(fh)
+        entry['config'] = {"a": 2}
+        with open(cache_path, 'wb') as fh:
+            config.marshal.dump(entry, fh)
+        self.assertEqual(config.parse_config_file(path), {"a": 2})
+        self.assertEqual(config.parse_config_file(path, cache=False),
+                         {"a": 1, "b": [2, 3]})
+
+    def test_content_change(self):
+        path = self._write_config('config = {"a": 1}\n')
+        self.assertEqual(config.parse_config_file(path), {"a": 1})
+        mtime = os.stat(path).st_mtime
+        self._write_config('config = {"a": 2}\n')
+        # Same size and mtime; only the contents differ.
+        os.utime(path, (mtime, mtime))
+        self.assertEqual(config.parse_config_file(path), {"a": 2})
+
+    def test_json(self):
+        path = self._write_config('{"a": 1}', name='test_config.json')
+        self.assertEqual(config.parse_config_file(path), {"a": 1})
+        self.assertEqual(config.parse_config_file(path), {"a": 1})
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_environment_input(self):
+        path = self._write_config(
+            'import os\nconfig = {"a": os.environ.get("MH_TEST_VALUE"), "cwd": os.getcwd()}\n')
+        os.environ['MH_TEST_VALUE'] = 'one'
+        self.assertEqual(config.parse_config_file(path)['a'], 'one')
+        os.environ['MH_TEST_VALUE'] = 'two'
+        self.assertEqual(config.parse_config_file(path)['a'], 'two')
+        cwd = os.getcwd()
+        os.chdir(self.config_dir)
+        try:
+            self.assertEqual(config.parse_config_file(path)['cwd'], os.getcwd())
+        finally:
+            os.chdir(cwd)
+
+    def test_uncacheable(self):
+        for contents in ('import os\nconfig = {"a": os.environ}\n',
+                         'import os\nconfig = {"a": os.listdir(".")}\n',
+                         'import os\nconfig = {"a": open(os.devnull).read() + "x"}\n'):
+            path = self._write_config(contents)
+            self.assertTrue(config.parse_config_file(path))
+            self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_missing_config_dict(self):
+        path = self._write_config('not_config = {"a": 1}\n')
+        self.assertRaises(config.MissingConfigDictError,
+                          config.parse_config_file, path)
+        # Still a KeyError, as before
+        self.assertRaises(KeyError, config.parse_config_file, path)
+        path = self._write_config('config = {"a": {}["b"]}\n', name='raises.py')
+        try:
+            config.parse_config_file(path)
+        except KeyError, e:
+            self.assertFalse(isinstance(e, config.MissingConfigDictError))
+        else:
+            self.fail("no KeyError")
+
+    def test_disabled(self):
+        os.environ['MOZHARNESS_CONFIG_CACHE'] = ''
+        path = self._write_config('config = {"a": 1}\n')
+        self.assertEqual(config.parse_config_file(path), {"a": 1})
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_repo_configs(self):
+        """Every config in configs/ reads back the same from the cache."""
+        paths = []
+        for root, dirs, files in os.walk(os.path.join(MH_DIR, 'configs')):
+            for name in files:
+                if name.endswith('.py') or name.endswith('.json'):
+                    paths.append(os.path.join(root, name))
+        for path in paths:
+            try:
+                uncached = config.parse_config_file(path, cache=False)
+            except Exception:
+                # Not every config loads outside of its build environment.
+                continue
+            self.assertEqual(config.parse_config_file(path), uncached, msg=path)
+            self.assertEqual(config.parse_config_file(path), uncached, msg=path)
+        self.assertTrue(os.listdir(self.cache_dir))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -38,5 +38,40 @@ class TestLog(unittest.TestCase):
         self.assertTrue(os.path.exists(get_log_file_path()))
         del(l)
 
+    def test_async_multi_log(self):
+        l = log.MultiFileLogger(log_dir=tmp_dir, log_name=log_name,
+                                log_to_console=False, log_async=True)
+        for i in range(100):
+            l.log_message('info %d' % i)
+        l.log_message('warning', level=log.WARNING)
+        l.log_message('error', level=log.ERROR)
+        l.flush()
+        info_lines = open(get_log_file_path('info')).read().splitlines()
+        self.assertEqual(len(info_lines), 103)
+        self.assertTrue(info_lines[1].endswith('info 0'))
+        self.assertTrue(info_lines[100].endswith('info 99'))
+        warning_lines = open(get_log_file_path('warning')).read().splitlines()
+        self.assertEqual(len(warning_lines), 2)
+        self.assertRaises(SystemExit, l.log_message, 'fatal', level=log.FATAL)
+        self.assertTrue(open(get_log_file_path('critical')).read().endswith('Exiting -1\n'))
+        del(l)
+
+    def test_buffered_log(self):
+        l = log.MultiFileLogger(log_dir=tmp_dir, log_name=log_name,
+                                log_to_console=False)
+        buffered_log = log.BufferedLog(l)
+        parser = log.OutputParser(config={}, log_obj=buffered_log,
+                                  error_list=[{'substr': 'bad', 'level': log.ERROR}])
+        parser.add_lines(['good', 'bad \xff'])
+        l.log_message('between')
+        buffered_log.flush()
+        buffered_log.close()
+        info_lines = open(get_log_file_path('info')).read().splitlines()
+        self.assertTrue(info_lines[-3].endswith('between'))
+        self.assertTrue(info_lines[-2].endswith(' good'))
+        self.assertTrue(info_lines[-1].endswith(' bad \xef\xbf\xbd'))
+        self.assertTrue(open(get_log_file_path('error')).read().rstrip().endswith(' bad \xef\xbf\xbd'))
+        del(l)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,18 @@
+import BaseHTTPServer
+import bz2
 import gc
+import gzip
+import imp
 import mock
 import os
 import re
+import sys
 import types
+import threading
 import unittest
+import zipfile
+import zlib
+from StringIO import StringIO
 PYWIN32 = False
 if os.name == 'nt':
     try:
@@ -19,6 +28,8 @@ from mozharness.base.log import DEBUG, INFO, WARNING, ERROR, CRITICAL, FATAL, IG
 import mozharness.base.script as script
 from mozharness.base.config import parse_config_file
 
+from fake_server import start_fake_server, stop_fake_server
+
 test_string = '''foo
 bar
 baz'''
@@ -319,6 +330,201 @@ class TestHelperFunctions(unittest.TestCase):
                          msg="%s and %s are different sizes after copyfile()" %
                              (self.temp_file, temp_file2))
 
+    def test_copyfile_compress(self):
+        self._create_temp_file()
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.assertEqual(self.s.copyfile(self.temp_file, 'test_dir/mozilla.gz',
+                                         compress=True), None)
+        self.assertEqual(gzip.open('test_dir/mozilla.gz').read(), test_string)
+        # Compressed at level 9 by default (the gzip header's XFL byte)
+        self.assertEqual(open('test_dir/mozilla.gz', 'rb').read()[8], '\x02')
+
+    def test_compress_files(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.s.mkdir_p('test_dir')
+        contents = ''.join('line %d\n' % i for i in range(5000))
+        for name in ('a', 'b', 'empty'):
+            self.s.write_to_file('test_dir/%s' % name,
+                                 '' if name == 'empty' else contents,
+                                 verbose=False)
+        files = [('test_dir/%s' % n, 'test_dir/%s.gz' % n) for n in ('a', 'b', 'empty')]
+        self.assertEqual(self.s.compress_files(files, num_threads=3,
+                                               block_size=1000), 0)
+        # A single gzip member, however many blocks
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(decompressor.decompress(open('test_dir/a.gz', 'rb').read()),
+                         contents)
+        self.assertEqual(decompressor.unused_data, '')
+        self.assertEqual(gzip.open('test_dir/a.gz').read(), contents)
+        self.assertEqual(gzip.open('test_dir/b.gz').read(), contents)
+        self.assertEqual(gzip.open('test_dir/empty.gz').read(), '')
+        self.assertEqual(self.s.compress_files([('test_dir/a', 'test_dir/fast.gz')],
+                                               level=script.FAST_COMPRESSION_LEVEL), 0)
+        self.assertEqual(gzip.open('test_dir/fast.gz').read(), contents)
+        # The gzip header's XFL byte says which level was used.
+        self.assertEqual(open('test_dir/a.gz', 'rb').read()[8], '\x02')
+        self.assertEqual(open('test_dir/fast.gz', 'rb').read()[8], '\x04')
+
+    def test_compress_files_bzip2(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.s.mkdir_p('test_dir')
+        contents = ''.join('line %d\n' % i for i in range(5000))
+        self.s.write_to_file('test_dir/a.img', contents, verbose=False)
+        self.assertEqual(self.s.compress_files([('test_dir/a.img', 'test_dir/a.img.bz2')],
+                                               compression='bzip2', remove_src=True,
+                                               block_size=1000), 0)
+        self.assertFalse(os.path.exists('test_dir/a.img'))
+        # A single stream, which python 2's BZ2File can read
+        self.assertEqual(bz2.BZ2File('test_dir/a.img.bz2').read(), contents)
+
+    def test_compress_files_missing(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.assertEqual(self.s.compress_files([('test_dir/missing', 'test_dir/missing.gz')],
+                                               error_level=IGNORE), 1)
+        self.assertFalse(os.path.exists('test_dir/missing.gz'))
+
+    def test_zip_files(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.s.mkdir_p('test_dir/profile/sub')
+        big = ''.join('line %d\n' % i for i in range(5000))
+        self.s.write_to_file('test_dir/big', big, verbose=False)
+        self.s.write_to_file('test_dir/profile/a', 'a', verbose=False)
+        self.s.write_to_file('test_dir/profile/sub/b', 'bb', verbose=False)
+        self.s.write_to_file('test_dir/profile/empty', '', verbose=False)
+        self.assertEqual(self.s.zip_files('test_dir/test.zip',
+                                          [('test_dir/big', 'distro/images/big'),
+                                           ('test_dir/profile', 'gaia/profile')],
+                                          num_threads=3, block_size=1000), None)
+        zf = zipfile.ZipFile('test_dir/test.zip')
+        self.assertEqual(zf.testzip(), None)
+        self.assertEqual(sorted(zf.namelist()),
+                         ['distro/images/big', 'gaia/profile/a',
+                          'gaia/profile/empty', 'gaia/profile/sub/b'])
+        self.assertEqual(zf.read('distro/images/big'), big)
+        self.assertEqual(zf.read('gaia/profile/sub/b'), 'bb')
+        self.assertEqual(zf.read('gaia/profile/empty'), '')
+        zf.close()
+
+    def test_zip_files_update(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.s.mkdir_p('test_dir')
+        contents = ''.join('line %d\n' % i for i in range(5000))
+        for name in ('a', 'b', 'c'):
+            self.s.write_to_file('test_dir/%s' % name, contents, verbose=False)
+        self.s.zip_files('test_dir/test.zip',
+                         [('test_dir/%s' % n, n) for n in ('a', 'b', 'c')], level=1)
+        old_sizes = dict((z.filename, z.compress_size) for z in
+                         zipfile.ZipFile('test_dir/test.zip').infolist())
+        self.s.write_to_file('test_dir/b', contents + 'changed', verbose=False)
+        os.utime('test_dir/b', (0, 0))
+        self.assertEqual(self.s.zip_files('test_dir/test.zip',
+                                          [('test_dir/%s' % n, n) for n in ('a', 'b')],
+                                          level=9), None)
+        zf = zipfile.ZipFile('test_dir/test.zip')
+        self.assertEqual(zf.testzip(), None)
+        # a wasn't recompressed, b was, and c was kept
+        self.assertEqual(zf.getinfo('a').compress_size, old_sizes['a'])
+        self.assertNotEqual(zf.getinfo('b').compress_size, old_sizes['b'])
+        self.assertEqual(zf.read('b'), contents + 'changed')
+        self.assertEqual(zf.read('c'), contents)
+        zf.close()
+
+    def test_rewrite_zip(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.s.mkdir_p('test_dir')
+        contents = ''.join('line %d\n' % i for i in range(5000))
+        omni = StringIO()
+        zf = zipfile.ZipFile(omni, 'w', zipfile.ZIP_DEFLATED)
+        zf.writestr('defaults/pref/a.js', 'pref("a", 1);')
+        zf.close()
+        zf = zipfile.ZipFile('test_dir/test.apk', 'w', zipfile.ZIP_DEFLATED)
+        zf.writestr('META-INF/MANIFEST.MF', 'signed')
+        zf.writestr('classes.dex', contents)
+        zf.writestr('omni.ja', omni.getvalue())
+        zf.close()
+        old_sizes = dict((z.filename, z.compress_size) for z in
+                         zipfile.ZipFile('test_dir/test.apk').infolist())
+        new_omni = StringIO()
+        script.rewrite_zip(StringIO(zipfile.ZipFile('test_dir/test.apk').read('omni.ja')),
+                           new_omni, replace={'defaults/pref/partner.js': 'partner'})
+        script.rewrite_zip('test_dir/test.apk', 'test_dir/repack.apk',
+                           remove=['META-INF/*'],
+                           replace={'omni.ja': new_omni.getvalue()})
+        zf = zipfile.ZipFile('test_dir/repack.apk')
+        self.assertEqual(zf.testzip(), None)
+        # omni.ja kept its place, and classes.dex wasn't recompressed
+        self.assertEqual(zf.namelist(), ['classes.dex', 'omni.ja'])
+        self.assertEqual(zf.getinfo('classes.dex').compress_size,
+                         old_sizes['classes.dex'])
+        self.assertEqual(zf.read('classes.dex'), contents)
+        omni_zf = zipfile.ZipFile(StringIO(zf.read('omni.ja')))
+        self.assertEqual(omni_zf.namelist(),
+                         ['defaults/pref/a.js', 'defaults/pref/partner.js'])
+        self.assertEqual(omni_zf.read('defaults/pref/partner.js'), 'partner')
+        zf.close()
+        self.assertRaises(zipfile.BadZipfile, script.rewrite_zip,
+                          StringIO('not a zip'), StringIO())
+
+    def _create_copytree_src(self):
+        self.s.mkdir_p('test_dir/src/sub')
+        self.s.write_to_file('test_dir/src/a', 'a', verbose=False)
+        self.s.write_to_file('test_dir/src/sub/b', 'bb', verbose=False)
+
+    def test_copytree(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self._create_copytree_src()
+        self.assertEqual(self.s.copytree('test_dir/src', 'test_dir/dest/new'), None)
+        self.assertEqual(self.s.read_from_file('test_dir/dest/new/sub/b', verbose=False), 'bb')
+
+    def test_copytree_no_overwrite(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self._create_copytree_src()
+        self.s.mkdir_p('test_dir/dest')
+        self.s.write_to_file('test_dir/dest/a', 'keep', verbose=False)
+        self.s.copytree('test_dir/src', 'test_dir/dest')
+        self.assertEqual(self.s.read_from_file('test_dir/dest/a', verbose=False), 'keep')
+        self.assertTrue(os.path.exists('test_dir/dest/sub/b'))
+
+    def test_copytree_overwrite_if_exists(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self._create_copytree_src()
+        self.s.mkdir_p('test_dir/dest/sub')
+        self.s.write_to_file('test_dir/dest/a', 'old', verbose=False)
+        self.s.write_to_file('test_dir/dest/sub/c', 'c', verbose=False)
+        self.s.copytree('test_dir/src', 'test_dir/dest', overwrite='overwrite_if_exists')
+        self.assertEqual(self.s.read_from_file('test_dir/dest/a', verbose=False), 'a')
+        self.assertFalse(os.path.exists('test_dir/dest/sub/c'))
+
+    def test_copytree_incremental(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self._create_copytree_src()
+        self.s.copytree('test_dir/src', 'test_dir/dest')
+        self.s.write_to_file('test_dir/dest/sub/c', 'c', verbose=False)
+        # Same size and mtime as the source, so it should be left alone.
+        self.s.write_to_file('test_dir/dest/a', 'x', verbose=False)
+        os.utime('test_dir/dest/a', (0, os.stat('test_dir/src/a').st_mtime))
+        self.s.write_to_file('test_dir/src/sub/b', 'bbb', verbose=False)
+        self.s.copytree('test_dir/src', 'test_dir/dest',
+                        overwrite='overwrite_if_exists', incremental=True)
+        self.assertEqual(self.s.read_from_file('test_dir/dest/a', verbose=False), 'x')
+        self.assertEqual(self.s.read_from_file('test_dir/dest/sub/b', verbose=False), 'bbb')
+        self.assertTrue(os.path.exists('test_dir/dest/sub/c'))
+
+    def test_copytree_hardlink(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self._create_copytree_src()
+        self.s.copytree('test_dir/src', 'test_dir/dest', copy_mode='hardlink')
+        self.assertEqual(self.s.read_from_file('test_dir/dest/sub/b', verbose=False), 'bb')
+        if hasattr(os, 'link'):
+            self.assertEqual(os.stat('test_dir/src/sub/b').st_ino,
+                             os.stat('test_dir/dest/sub/b').st_ino)
+
+    def test_copytree_reflink(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self._create_copytree_src()
+        self.s.copytree('test_dir/src', 'test_dir/dest', copy_mode='reflink')
+        self.assertEqual(self.s.read_from_file('test_dir/dest/sub/b', verbose=False), 'bb')
+
     def test_existing_rmtree(self):
         self._create_temp_file()
         self.s = script.BaseScript(initial_config_file='test/test.json')
@@ -327,6 +533,18 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertFalse(os.path.exists('test_dir'),
                          msg="rmtree unsuccessful")
 
+    def test_background_rmtree(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        for d in ('foo', 'bar', 'baz'):
+            self.s.mkdir_p(os.path.join('test_dir', 'clobber', d, 'qux'))
+            self.s.write_to_file(os.path.join('test_dir', 'clobber', d, 'file'), d)
+        self.s.rmtree(os.path.join('test_dir', 'clobber'), background=True)
+        self.assertFalse(os.path.exists(os.path.join('test_dir', 'clobber')),
+                         msg="background rmtree didn't move the directory")
+        self.assertEqual(self.s.wait_for_background_rmtree(), 0)
+        self.assertEqual(os.listdir('test_dir'), [],
+                         msg="background rmtree left %s behind" % os.listdir('test_dir'))
+
     def test_nonexistent_rmtree(self):
         self.s = script.BaseScript(initial_config_file='test/test.json')
         status = self.s.rmtree('test_dir')
@@ -422,6 +640,73 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertEqual(contents, None)
 
 
+# TestDownloadFiles {{{1
+class FakeDownloadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves /file/<name>, redirects /redirect/<name> there, and 404s
+    anything else."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'redirect':
+            self.send_response(302)
+            self.send_header('Location', '/file/%s' % parts[1])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif len(parts) == 2 and parts[0] == 'file':
+            body = 'contents of %s\n' % parts[1]
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownloadFiles(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        self.server, self.base_url = start_fake_server(FakeDownloadHandler,
+                                                       connections=set())
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+
+    def tearDown(self):
+        stop_fake_server(self.server)
+        if hasattr(self, 's') and isinstance(self.s, object):
+            del(self.s)
+        cleanup()
+
+    def test_download_files(self):
+        files = [('%s/file/%d' % (self.base_url, i), 'test_dir/%d/file' % i)
+                 for i in range(20)]
+        files.append(('%s/redirect/r' % self.base_url, 'test_dir/r'))
+        results = self.s.download_files(files, num_threads=3)
+        self.assertEqual(results, [f[1] for f in files])
+        for i in range(20):
+            self.assertEqual(self.s.read_from_file('test_dir/%d/file' % i, verbose=False),
+                             'contents of %d\n' % i)
+        self.assertEqual(self.s.read_from_file('test_dir/r', verbose=False),
+                         'contents of r\n')
+        # Each thread reused its connection.
+        self.assertTrue(len(self.server.connections) <= 3)
+
+    def test_download_files_missing(self):
+        files = [('%s/file/a' % self.base_url, 'test_dir/a'),
+                 ('%s/missing' % self.base_url, 'test_dir/missing'),
+                 ('%s/file/b' % self.base_url, 'test_dir/b')]
+        with mock.patch.object(self.s, 'retry', wraps=self.s.retry) as retry:
+            results = self.s.download_files(files, num_threads=1,
+                                            retry_config={'attempts': 1})
+        self.assertEqual(results, ['test_dir/a', None, 'test_dir/b'])
+        # Concurrent downloads spread their retries out.
+        self.assertTrue(all(c[1]['jitter'] for c in retry.call_args_list))
+        self.assertEqual(self.s.download_files([]), [])
+
+
 # TestScriptLogging {{{1
 class TestScriptLogging(unittest.TestCase):
     # I need a log watcher helper function, here and in test_log.
@@ -536,6 +821,10 @@ class OtherError(Exception):
     pass
 
 
+class NewSubError(NewError):
+    pass
+
+
 class TestRetry(unittest.TestCase):
     def setUp(self):
         self.ATTEMPT_N = 1
@@ -614,6 +903,101 @@ class TestRetry(unittest.TestCase):
         self.assertEqual(ret[0], args)
         self.assertEqual(ret[1], kwargs)
 
+    def testRetrySleeptimeBackoff(self):
+        sleeps = [self.s._query_retry_sleeptime(n, 10, 60, jitter=False)
+                  for n in range(1, 6)]
+        self.assertEqual(sleeps, [10, 20, 40, 60, 60])
+
+    def testRetrySleeptimeJitter(self):
+        for n in range(1, 6):
+            sleep = self.s._query_retry_sleeptime(n, 10, 60, jitter=True)
+            self.assertTrue(0 <= sleep <= min(10 * 2 ** (n - 1), 60))
+
+    @mock.patch('time.sleep')
+    def testRetryStats(self, sleep):
+        self.s.retry(self._succeedOnSecondAttempt, attempts=2, sleeptime=3,
+                     jitter=False)
+        sleep.assert_called_once_with(3)
+        self.assertEqual(self.s.query_retry_stats(),
+                         {'calls': 1, 'retries': 1, 'sleep': 3})
+
+    @mock.patch('time.sleep')
+    def testRetryJitterOptIn(self, sleep):
+        self.s.retry(self._succeedOnSecondAttempt, attempts=2, sleeptime=3)
+        sleep.assert_called_once_with(3)
+        self.ATTEMPT_N = 1
+        with mock.patch('random.uniform', return_value=0.5) as uniform:
+            self.s.retry(self._succeedOnSecondAttempt, attempts=2, sleeptime=3,
+                         jitter=True)
+            uniform.assert_called_once_with(0, 3)
+        self.assertEqual(sleep.call_args[0][0], 0.5)
+
+    @mock.patch('time.sleep')
+    def testRetryExceptionPolicy(self, sleep):
+        self.s.retry(self._raiseCustomException, attempts=2, sleeptime=30,
+                     jitter=False, exception_policies={NewError: {'sleeptime': 1}})
+        sleep.assert_called_once_with(1)
+
+    @mock.patch('time.sleep')
+    def testRetryExceptionPolicySubclass(self, sleep):
+        policies = {Exception: {'sleeptime': 20}, NewError: {'sleeptime': 10},
+                    NewSubError: {'sleeptime': 1}}
+        self.s.retry(self._succeedOnSecondAttempt, attempts=2, sleeptime=30,
+                     jitter=False, kwargs={'exception': NewSubError},
+                     exception_policies=policies)
+        sleep.assert_called_once_with(1)
+        self.ATTEMPT_N = 1
+        self.s.retry(self._raiseCustomException, attempts=2, sleeptime=30,
+                     jitter=False, exception_policies=policies)
+        self.assertEqual(sleep.call_args[0][0], 10)
+
+    def testRetryExceptionPolicyAttempts(self):
+        ret = self.s.retry(self._raiseCustomException, attempts=5, sleeptime=0,
+                           exception_policies={NewError: {'attempts': 1}})
+        self.assertEqual(ret, -1)
+        self.assertEqual(self.ATTEMPT_N, 2)
+
+    def _alwaysRaiseCustomException(self):
+        self.ATTEMPT_N += 1
+        raise NewError("Fail")
+
+    def testRetryExceptionPolicyMoreAttempts(self):
+        ret = self.s.retry(self._alwaysRaiseCustomException, attempts=2,
+                           sleeptime=0, failure_status='failed',
+                           exception_policies={NewError: {'attempts': 5}})
+        self.assertEqual(ret, 'failed')
+        self.assertEqual(self.ATTEMPT_N, 6)
+
+    @mock.patch('time.sleep')
+    def testRetryBudget(self, sleep):
+        del(self.s)
+        self.s = script.BaseScript(config={'retry_budget': 5},
+                                   initial_config_file='test/test.json')
+        ret = self.s.retry(self._alwaysFail, attempts=10, sleeptime=4, jitter=False)
+        self.assertEqual(ret, -1)
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [4, 1])
+        self.assertEqual(self.s.query_retry_stats()['sleep'], 5)
+
+    @mock.patch('time.sleep')
+    def testRetryStatsThreaded(self, sleep):
+        del(self.s)
+        self.s = script.BaseScript(config={'retry_budget': 50},
+                                   initial_config_file='test/test.json')
+
+        def _retry():
+            self.s.retry(self._alwaysFail, attempts=3, sleeptime=1,
+                         jitter=False)
+        threads = [threading.Thread(target=_retry) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.s.query_retry_stats()
+        self.assertEqual((stats['calls'], stats['sleep']), (20, 50))
+        # Threads that find the budget used up give up after one retry.
+        self.assertTrue(20 <= stats['retries'] <= 40)
+        self.assertEqual(sum(c[0][0] for c in sleep.call_args_list), 50)
+
 
 class BaseScriptWithDecorators(script.BaseScript):
     def __init__(self, *args, **kwargs):
@@ -808,6 +1192,68 @@ class TestScriptDecorators(unittest.TestCase):
         self.assertEqual(len(self.s.post_run_1_args), 1)
         self.assertEqual(len(self.s.post_run_2_args), 1)
 
+def scan_listeners(obj):
+    """BaseScript's old listener discovery: getattr() everything."""
+    listeners = dict(pre_run=[], pre_action=[], post_action=[], post_run=[])
+    for k in dir(obj):
+        item = getattr(obj, k)
+        if not isinstance(item, types.MethodType):
+            continue
+        if hasattr(item, '_pre_run_listener'):
+            listeners['pre_run'].append(k)
+        if hasattr(item, '_pre_action_listener'):
+            listeners['pre_action'].append((k, item._pre_action_listener))
+        if hasattr(item, '_post_action_listener'):
+            listeners['post_action'].append((k, item._post_action_listener))
+        if hasattr(item, '_post_run_listener'):
+            listeners['post_run'].append(k)
+    return listeners
+
+
+class TestListenerRegistry(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+
+    def tearDown(self):
+        cleanup()
+
+    def test_inherited(self):
+        class SubScript(BaseScriptWithDecorators):
+            @script.PostScriptRun
+            def post_run_3(self):
+                pass
+
+        s = SubScript(initial_config_file='test/test.json')
+        self.assertEqual(s._listeners, scan_listeners(s))
+        self.assertEqual(len(s._listeners['post_run']), 3)
+        self.assertEqual(len(BaseScriptWithDecorators._query_listener_registry()['post_run']), 2)
+
+    def test_scripts(self):
+        """The cached registry matches scanning DesktopUnittest and
+        BuildScript instances."""
+        from mozharness.mozilla.building.buildbase import BuildScript
+        desktop_unittest = imp.load_source(
+            'desktop_unittest',
+            os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'scripts', 'desktop_unittest.py'))
+        argv = sys.argv
+        sys.argv = ['desktop_unittest.py', '--log-level', 'error']
+        try:
+            for factory in (
+                lambda: desktop_unittest.DesktopUnittest(require_config_file=False),
+                lambda: BuildScript(
+                    config={'branch': 'b', 'stage_platform': 'p',
+                            'log_level': ERROR, 'log_to_console': False},
+                    initial_config_file='test/test.json'),
+            ):
+                s = factory()
+                self.assertEqual(s._listeners, scan_listeners(s))
+                # The registry is cached on the class for the next instance.
+                self.assertTrue('_listener_registry' in type(s).__dict__)
+                del s
+        finally:
+            sys.argv = argv
+
 
 # main {{{1
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+import gc
+import os
+import stat
+import unittest
+
+import mozharness.base.log as log
+from mozharness.base.log import ERROR
+import mozharness.base.script as script
+from mozharness.base.signing import AndroidSigningMixin
+
+FAKE_JARSIGNER = """#!/bin/sh
+# jarsigner -keystore KEYSTORE -storepass PASS -keypass PASS APK ALIAS
+if [ ! -f "$7" ]; then
+    echo "jarsigner: unable to open jar file: $7"
+    exit 1
+fi
+echo signed >> "$7"
+"""
+
+FAKE_ZIPALIGN = """#!/bin/sh
+# zipalign -f 4 SRC DEST
+case "$3" in
+    *unalignable*) echo "Unable to open '$3' as a zip archive"; exit 1;;
+esac
+cp "$3" "$4"
+"""
+
+
+class CleanupObj(script.ScriptMixin, log.LogMixin):
+    def __init__(self):
+        super(CleanupObj, self).__init__()
+        self.log_obj = None
+        self.config = {'log_level': ERROR}
+
+
+def cleanup():
+    gc.collect()
+    c = CleanupObj()
+    for f in ('test_logs', 'test_dir'):
+        c.rmtree(f)
+
+
+def write_exe(path, contents):
+    with open(path, 'w') as fh:
+        fh.write(contents)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+class SigningScript(AndroidSigningMixin, script.BaseScript):
+    pass
+
+
+class TestAndroidSigning(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        os.mkdir('test_dir')
+        write_exe('test_dir/jarsigner', FAKE_JARSIGNER)
+        write_exe('test_dir/zipalign', FAKE_ZIPALIGN)
+        self.s = SigningScript(config={
+            'log_level': ERROR,
+            'exes': {
+                'jarsigner': os.path.abspath('test_dir/jarsigner'),
+                'zipalign': os.path.abspath('test_dir/zipalign'),
+            },
+        }, initial_config_file='test/test.json')
+
+    def tearDown(self):
+        del self.s
+        cleanup()
+
+    def test_sign_and_align_apks(self):
+        apks = []
+        for name in ('a', 'b', 'c', 'unalignable'):
+            unsigned = os.path.abspath('test_dir/unsigned/%s.apk' % name)
+            self.s.write_to_file(unsigned, name, create_parent_dir=True)
+            apks.append((unsigned, os.path.abspath('test_dir/signed/%s/%s.apk' % (name, name))))
+        apks.append((os.path.abspath('test_dir/unsigned/missing.apk'),
+                     os.path.abspath('test_dir/signed/missing.apk')))
+        results = self.s.sign_and_align_apks(apks, 'keystore', 'storepass',
+                                             'keypass', 'alias',
+                                             remove_signature=False,
+                                             num_threads=3,
+                                             error_list=[{
+                                                 'substr': 'unable to open jar file',
+                                                 'level': ERROR,
+                                             }])
+        self.assertEqual([results[apk] for apk in apks],
+                         [None, None, None, 'align', 'sign'])
+        for (unsigned, signed) in apks[:3]:
+            self.assertEqual(self.s.read_from_file(signed, verbose=False),
+                             '%ssigned\n' % os.path.basename(unsigned)[0])
+        self.assertFalse(os.path.exists(apks[4][1]))
+        self.assertEqual(self.s.sign_and_align_apks([], 'keystore', 'storepass',
+                                                    'keypass', 'alias'), {})
+
+    def test_sign_and_align_apks_fatal(self):
+        # A missing apk is fatal with the default JarsignerErrorList.
+        apks = [(os.path.abspath('test_dir/missing.apk'),
+                 os.path.abspath('test_dir/signed.apk'))]
+        self.assertRaises(SystemExit, self.s.sign_and_align_apks, apks,
+                          'keystore', 'storepass', 'keypass', 'alias',
+                          remove_signature=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
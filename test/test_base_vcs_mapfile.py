@@ -0,0 +1,199 @@
+import gc
+import hashlib
+import os
+import random
+import subprocess
+import threading
+import unittest
+
+import mozharness.base.log as log
+from mozharness.base.log import ERROR
+import mozharness.base.script as script
+import mozharness.base.vcs.mapfile as mapfile
+from mozharness.base.vcs.mapfile import MapfileIndex, merge_mapfiles
+
+
+class CleanupObj(script.ScriptMixin, log.LogMixin):
+    def __init__(self):
+        super(CleanupObj, self).__init__()
+        self.log_obj = None
+        self.config = {'log_level': ERROR}
+
+
+def cleanup():
+    gc.collect()
+    c = CleanupObj()
+    c.rmtree('test_dir')
+
+
+def sha(*args):
+    return hashlib.sha1(repr(args)).hexdigest()
+
+
+def make_mappings(count, name='gecko'):
+    return [(sha(name, 'git', i), sha(name, 'hg', i)) for i in range(count)]
+
+
+def write_mapfile(path, mappings):
+    with open(path, 'w') as fh:
+        for m in mappings:
+            fh.write('%s %s\n' % m)
+
+
+class TestMapfileIndex(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        os.mkdir('test_dir')
+        self.index_path = os.path.join('test_dir', 'git-mapfile.index')
+        self.mappings = make_mappings(100)
+
+    def tearDown(self):
+        cleanup()
+
+    def test_lookups(self):
+        index = MapfileIndex(self.index_path)
+        self.assertEqual(index.add(self.mappings), 100)
+        for (git_sha, hg_sha) in self.mappings:
+            self.assertEqual(index.lookup_hg(git_sha), hg_sha)
+            self.assertEqual(index.lookup_git(hg_sha), git_sha)
+            # |hg id| gives abbreviated revisions
+            self.assertEqual(index.lookup_git(hg_sha[:12]), git_sha)
+            self.assertEqual(index.lookup_git(hg_sha[:13].upper()), git_sha)
+        self.assertEqual(index.lookup_git('0' * 40), None)
+        self.assertEqual(index.lookup_git('not hex'), None)
+        # ambiguous
+        self.assertEqual(index.lookup_git(''), None)
+
+    def test_compacted_lookups(self):
+        index = MapfileIndex(self.index_path)
+        index.add(self.mappings[:60])
+        index.compact()
+        index.add(self.mappings[60:])
+        self.assertEqual(index.meta['indexed'], 60)
+        for (git_sha, hg_sha) in self.mappings:
+            self.assertEqual(index.lookup_hg(git_sha[:10]), hg_sha)
+            self.assertEqual(index.lookup_git(hg_sha), git_sha)
+        self.assertEqual([m for m in index.mappings(order='git')],
+                         sorted(self.mappings))
+
+    def test_persists(self):
+        index = MapfileIndex(self.index_path)
+        index.add(self.mappings[:60])
+        index.compact()
+        index.add(self.mappings[60:])
+        index.close()
+        index = MapfileIndex(self.index_path)
+        self.assertEqual(len(index), 100)
+        self.assertEqual(index.add(self.mappings), 0)
+        self.assertEqual(index.lookup_git(self.mappings[80][1]), self.mappings[80][0])
+
+    def test_partial_record(self):
+        index = MapfileIndex(self.index_path)
+        index.add(self.mappings[:10])
+        index.close()
+        with open(self.index_path, 'ab') as fh:
+            fh.write('\0' * 13)
+        index = MapfileIndex(self.index_path)
+        self.assertEqual(len(index), 10)
+        self.assertEqual(os.path.getsize(self.index_path), 10 * mapfile.RECORD_SIZE)
+
+    def test_rebuilds_sorted_files(self):
+        index = MapfileIndex(self.index_path)
+        index.add(self.mappings)
+        index.compact()
+        index.close()
+        os.remove(self.index_path + '.hg')
+        index = MapfileIndex(self.index_path)
+        self.assertEqual(index.lookup_git(self.mappings[5][1]), self.mappings[5][0])
+
+    def test_update(self):
+        text_mapfile = os.path.join('test_dir', 'git-mapfile')
+        write_mapfile(text_mapfile, self.mappings[:50])
+        index = MapfileIndex(self.index_path)
+        self.assertEqual(index.update(text_mapfile), 50)
+        # hg-git rewrites the mapfile in no particular order
+        reordered = self.mappings[:]
+        random.Random(0).shuffle(reordered)
+        write_mapfile(text_mapfile, reordered)
+        self.assertEqual(index.update(text_mapfile), 50)
+        self.assertEqual(len(index), 100)
+        self.assertEqual(index.update(text_mapfile), 0)
+
+    def test_since(self):
+        index = MapfileIndex(self.index_path)
+        index.add(self.mappings[:50])
+        watermark = index.query_watermark()
+        index.add(self.mappings)
+        index.close()
+        index = MapfileIndex(self.index_path)
+        count = index.parse_watermark(watermark)
+        self.assertEqual(count, 50)
+        self.assertEqual(sorted(index.since(count)), sorted(self.mappings[50:]))
+        self.assertEqual(list(index.since(len(index))), [])
+        other = MapfileIndex(os.path.join('test_dir', 'other.index'))
+        self.assertEqual(other.parse_watermark(watermark), None)
+        self.assertEqual(index.parse_watermark(self.mappings[0][0]), None)
+
+    def test_merge_mapfiles(self):
+        mapfiles = []
+        indexes = []
+        for (i, mappings) in enumerate((self.mappings[:70], self.mappings[30:],
+                                        make_mappings(20, name='l10n'))):
+            mapfiles.append(os.path.join('test_dir', 'mapfile%d' % i))
+            write_mapfile(mapfiles[-1], mappings)
+            indexes.append(MapfileIndex(mapfiles[-1] + '.index'))
+            indexes[-1].update(mapfiles[-1])
+        indexes[0].compact()
+        combined = os.path.join('test_dir', 'combined')
+        self.assertEqual(merge_mapfiles(indexes, combined), 120)
+        expected = subprocess.check_output(
+            ['sort', '--unique', '-t', ' ', '--key=2'] + mapfiles,
+            env={'LC_ALL': 'C'})
+        self.assertEqual(open(combined).read(), expected)
+
+    def test_large_mapfile(self):
+        count = 50000
+        text_mapfile = os.path.join('test_dir', 'git-mapfile')
+        mappings = make_mappings(count)
+        write_mapfile(text_mapfile, mappings)
+        index = MapfileIndex(self.index_path)
+        self.assertEqual(index.update(text_mapfile), count)
+        write_mapfile(text_mapfile, mappings + make_mappings(100, name='new'))
+        self.assertEqual(index.update(text_mapfile), 100)
+        watermark = index.query_watermark()
+        self.assertEqual(index.update(text_mapfile), 0)
+        self.assertEqual(len(list(index.since(index.parse_watermark(watermark)))), 0)
+        for (git_sha, hg_sha) in mappings[:1000]:
+            self.assertEqual(index.lookup_git(hg_sha[:12]), git_sha)
+
+    def test_threads(self):
+        # Lookups, and updates that compact, all from different threads.
+        count = 4 * mapfile.COMPACT_MIN
+        mappings = make_mappings(count)
+        index = MapfileIndex(self.index_path)
+        index.add(mappings[:mapfile.COMPACT_MIN])
+        errors = []
+
+        def add(start):
+            for i in range(start, count, 1000):
+                index.add(mappings[i:i + 1000])
+
+        def lookup():
+            for (git_sha, hg_sha) in mappings[:mapfile.COMPACT_MIN:7]:
+                if index.lookup_git(hg_sha) != git_sha:
+                    errors.append(hg_sha)
+
+        threads = [threading.Thread(target=add, args=(mapfile.COMPACT_MIN, )),
+                   threading.Thread(target=add, args=(mapfile.COMPACT_MIN + 500, ))]
+        threads += [threading.Thread(target=lookup) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(index), count)
+        self.assertEqual(sorted(index.mappings(order='git')), sorted(mappings))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import gc
+import imp
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mozharness.base.log as log
+from mozharness.base.log import ERROR
+import mozharness.base.script as script
+
+MH_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+configtest = imp.load_source('configtest',
+                             os.path.join(MH_DIR, 'scripts', 'configtest.py'))
+
+
+class CleanupObj(script.ScriptMixin, log.LogMixin):
+    def __init__(self):
+        super(CleanupObj, self).__init__()
+        self.log_obj = None
+        self.config = {'log_level': ERROR}
+
+
+def cleanup():
+    gc.collect()
+    c = CleanupObj()
+    for f in ('test_logs', 'test_dir'):
+        c.rmtree(f)
+
+
+class TestCheckConfigSchema(unittest.TestCase):
+    def test_good(self):
+        self.assertEqual(configtest.check_config_schema({
+            'exes': {'python': '/usr/bin/python', 'hg': ['python', 'hg']},
+            'default_actions': ['clobber', 'build'],
+            'virtualenv_modules': ['mozinfo', {'mozprocess': 'path'}],
+        }), [])
+        self.assertEqual(configtest.check_config_schema({}), [])
+
+    def test_exes(self):
+        self.assertEqual(configtest.check_config_schema({'exes': ['python']}),
+                         ["exes is a list, not a dict"])
+        self.assertEqual(configtest.check_config_schema({'exes': {'python': 2}}),
+                         ["exes['python'] is neither a string nor a list of strings"])
+
+    def test_default_actions(self):
+        self.assertEqual(configtest.check_config_schema(
+            {'default_actions': ['build', 'clobber', 'build']}),
+            ["default_actions lists build more than once"])
+        self.assertEqual(configtest.check_config_schema({'default_actions': 'build'}),
+                         ["default_actions is not a list of strings"])
+
+    def test_virtualenv_modules(self):
+        self.assertEqual(configtest.check_config_schema(
+            {'virtualenv_modules': ['mozinfo', 3]}),
+            ["virtualenv_modules entry 3 is neither a string nor a dict"])
+        self.assertEqual(configtest.check_config_schema({'virtualenv_modules': 'mozinfo'}),
+                         ["virtualenv_modules is a str, not a list"])
+
+
+class TestConfigTest(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        os.mkdir('test_dir')
+        self.cache_dir = tempfile.mkdtemp()
+        self.old_env = dict(os.environ)
+        os.environ['MOZHARNESS_CONFIG_CACHE'] = self.cache_dir
+        self.files = {}
+        for name, contents in (
+                ('good.py', 'config = {"exes": {"python": "python"}}\n'),
+                ('good.json', '{"default_actions": ["build"]}'),
+                ('no_config.py', 'not_config = {}\n'),
+                ('not_a_dict.py', 'config = ["a"]\n'),
+                ('syntax.py', 'config = {\n'),
+                ('key_error.py', 'config = {"a": {}["b"]}\n'),
+                ('bad_json.json', '{"a": '),
+                ('bad_schema.py', 'config = {"default_actions": ["a", "a"]}\n')):
+            path = os.path.abspath(os.path.join('test_dir', name))
+            with open(path, 'w') as fh:
+                fh.write(contents)
+            self.files[name] = path
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.old_env)
+        shutil.rmtree(self.cache_dir)
+        cleanup()
+
+    def test_evaluate_config_file(self):
+        statuses = dict((name, configtest.evaluate_config_file(path)['status'])
+                        for (name, path) in self.files.items())
+        self.assertEqual(statuses, {
+            'good.py': 'good',
+            'good.json': 'good',
+            'no_config.py': 'no-config',
+            'not_a_dict.py': 'no-config',
+            'syntax.py': 'invalid',
+            # A KeyError raised by the config isn't a missing config dict.
+            'key_error.py': 'invalid',
+            'bad_json.json': 'invalid',
+            'bad_schema.py': 'bad-schema',
+        })
+        result = configtest.evaluate_config_file(self.files['bad_schema.py'])
+        self.assertEqual(result['type'], 'python')
+        self.assertEqual(result['schema_errors'],
+                         ["default_actions lists a more than once"])
+        # Evaluated python configs go through the config cache.
+        self.assertTrue(os.listdir(self.cache_dir))
+
+    def test_write_report(self):
+        report_file = os.path.abspath('test_dir/report.json')
+        argv = sys.argv
+        sys.argv = ['configtest.py', '--log-level', 'error',
+                    '--work-dir', 'test_dir', '--report-file', report_file]
+        for path in sorted(self.files.values()):
+            sys.argv += ['--test-file', path]
+        try:
+            s = configtest.ConfigTest()
+        finally:
+            sys.argv = argv
+        s.write_report()
+        report = json.load(open(report_file))
+        self.assertEqual(report['counts'], {'good': 2, 'no-config': 2,
+                                            'invalid': 3, 'bad-schema': 1})
+        self.assertEqual([f['file'] for f in report['files']], sorted(self.files.values()))
+        for result in report['files']:
+            self.assertEqual(sorted(result), ['error', 'file', 'schema_errors',
+                                              'seconds', 'status', 'type'])
+        self.assertTrue(isinstance(report['seconds'], float))
+        del s
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+MH_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that mozharness.base.script (and config, log) only import when
+# they're actually used.
+LAZY_MODULES = (
+    'httplib', 'inspect', 'mozprocess', 'multiprocessing',
+    'multiprocessing.pool', 'ssl', 'urllib', 'urllib2', 'uuid', 'zipfile',
+)
+
+IMPORT_CHECK = """
+import json, sys
+import %(module)s
+print json.dumps([m for m in %(lazy)r if sys.modules.get(m)])
+"""
+
+
+def query_lazy_imports(module):
+    """Import `module` in a fresh interpreter; return which LAZY_MODULES
+    it pulled in."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = MH_DIR
+    output = subprocess.check_output(
+        [sys.executable, '-c',
+         IMPORT_CHECK % {'module': module, 'lazy': LAZY_MODULES}],
+        cwd=MH_DIR, env=env)
+    return json.loads(output)
+
+
+class TestImportTime(unittest.TestCase):
+    def test_lazy_imports(self):
+        for module in ('mozharness.base.config', 'mozharness.base.log',
+                       'mozharness.base.script', 'mozharness.base.transfer'):
+            loaded = query_lazy_imports(module)
+            self.assertEqual(loaded, [],
+                             msg="%s imports %s" % (module, ', '.join(loaded)))
+
+    def test_list_actions(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = MH_DIR
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join('scripts', 'fx_desktop_build.py'),
+             '--list-actions'],
+            cwd=MH_DIR, env=env, stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        self.assertEqual(proc.returncode, 0)
+        self.assertTrue(output.startswith("Actions available:"))
+        self.assertTrue("* build" in output)
+
+
+if __name__ == '__main__':
+    unittest.main()
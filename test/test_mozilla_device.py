@@ -0,0 +1,108 @@
+import gc
+import os
+import stat
+import unittest
+
+import mozharness.base.log as log
+from mozharness.base.log import ERROR
+import mozharness.base.script as script
+from mozharness.mozilla.testing.device import ADBDeviceHandler, \
+    install_apps_on_devices
+
+# Pretends to be adb for a few devices.  emulator-5554 boots on the second
+# getprop; emulator-5556 refuses installs; emulator-5558 never attaches.
+FAKE_ADB = """#!/bin/sh
+state=test_dir/$2
+case "$3" in
+  wait-for-device)
+    if [ "$2" = emulator-5558 ]; then sleep 30; fi
+    ;;
+  shell)
+    case "$4" in
+      getprop)
+        echo x >> $state.getprop
+        if [ "$2" != emulator-5554 ] || [ `wc -l < $state.getprop` -gt 1 ]; then
+          echo 1
+        fi
+        ;;
+      ls*) echo "$5: No such file or directory" ;;
+      *) ;;
+    esac
+    ;;
+  install)
+    echo "$5" >> $state.installs
+    if [ "$2" = emulator-5556 ]; then echo Failure; else echo Success; fi
+    ;;
+esac
+"""
+
+
+class CleanupObj(script.ScriptMixin, log.LogMixin):
+    def __init__(self):
+        super(CleanupObj, self).__init__()
+        self.log_obj = None
+        self.config = {'log_level': ERROR}
+
+
+def cleanup():
+    gc.collect()
+    c = CleanupObj()
+    for f in ('test_logs', 'test_dir'):
+        c.rmtree(f)
+
+
+class TestInstallAppsOnDevices(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        os.mkdir('test_dir')
+        adb = os.path.join('test_dir', 'adb')
+        with open(adb, 'w') as fh:
+            fh.write(FAKE_ADB)
+        os.chmod(adb, os.stat(adb).st_mode | stat.S_IEXEC)
+        self.config = {
+            'exes': {'adb': os.path.abspath(adb)},
+            'enable_automation': False,
+            'device_boot_timeout': 2,
+            'device_install_sleeptime': 0,
+        }
+
+    def tearDown(self):
+        cleanup()
+
+    def _query_handler(self, device_id):
+        dh = ADBDeviceHandler(config=dict(self.config), log_obj=None)
+        dh.device_id = device_id
+        return dh
+
+    def _query_installs(self, device_id):
+        return open('test_dir/%s.installs' % device_id).read().splitlines()
+
+    def test_wait_for_boot_completed(self):
+        dh = self._query_handler('emulator-5554')
+        self.assertTrue(dh.wait_for_boot_completed())
+        self.assertEqual(len(open('test_dir/emulator-5554.getprop').readlines()), 2)
+
+    def test_wait_for_boot_completed_timeout(self):
+        dh = self._query_handler('emulator-5558')
+        self.assertFalse(dh.wait_for_boot_completed(timeout=1))
+
+    def test_install_apps_on_devices(self):
+        self.config['enable_automation'] = True
+        results = install_apps_on_devices([
+            (self._query_handler('emulator-5554'),
+             [('fennec.apk', 'org.mozilla.fennec'), ('robocop.apk', 'org.mozilla.roboexample.test')]),
+            (self._query_handler('emulator-5556'),
+             [('fennec.apk', 'org.mozilla.fennec')]),
+        ])
+        self.assertTrue(results['emulator-5554']['booted'])
+        self.assertEqual(results['emulator-5554']['installed'], ['fennec.apk', 'robocop.apk'])
+        self.assertEqual(results['emulator-5554']['failed'], [])
+        self.assertEqual(self._query_installs('emulator-5554'), ['fennec.apk', 'robocop.apk'])
+        self.assertEqual(results['emulator-5556']['installed'], [])
+        self.assertEqual(results['emulator-5556']['failed'], ['fennec.apk'])
+        # 6 attempts before giving up
+        self.assertEqual(len(self._query_installs('emulator-5556')), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+import BaseHTTPServer
+import gc
+import os
+import threading
+import unittest
+
+import mozharness.base.log as log
+from mozharness.base.log import INFO, ERROR, FATAL
+import mozharness.base.script as script
+from mozharness.mozilla.mapper import MapperMixin
+
+from fake_server import start_fake_server, stop_fake_server
+
+MAPPINGS = [
+    ('a' * 40, '1' * 40),
+    ('b' * 40, '2' * 40),
+    ('c' * 40, '3' * 40),
+]
+
+
+class CleanupObj(script.ScriptMixin, log.LogMixin):
+    def __init__(self):
+        super(CleanupObj, self).__init__()
+        self.log_obj = None
+        self.config = {'log_level': ERROR}
+
+
+def cleanup():
+    gc.collect()
+    c = CleanupObj()
+    for f in ('test_logs', 'test_dir'):
+        c.rmtree(f)
+
+
+class FakeMapperHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves /<project>/<vcs>/<rev> lookups and /<project>/mapfile, and
+    takes /<project>/insert/ignoredups posts."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        parts = self.path.strip('/').split('/')
+        if parts[1:] == ['mapfile'] and self.server.serve_mapfile:
+            body = ''.join('%s %s\n' % m for m in MAPPINGS)
+        elif len(parts) == 3:
+            vcs, rev = parts[1:]
+            mapped = None
+            for hg_rev, git_rev in MAPPINGS:
+                if vcs == 'git' and rev == hg_rev:
+                    mapped = git_rev
+                elif vcs == 'hg' and rev == git_rev:
+                    mapped = hg_rev
+            body = '{"%s_rev": %s}\n' % (vcs, '"%s"' % mapped if mapped else 'null')
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        lines = body.splitlines(True)
+        with self.server.lock:
+            self.server.connections.add(self.client_address)
+            self.server.posts.append(len(lines))
+            # Pretend big posts time out at the load balancer, and that
+            # one mapping is always rejected.
+            status = 200
+            if len(lines) > self.server.max_post_lines or \
+                    self.server.bad_line in lines:
+                status = 504
+            else:
+                self.server.inserted.extend(lines)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class MapperScript(script.BaseScript, MapperMixin):
+    def __init__(self, **kwargs):
+        super(MapperScript, self).__init__(
+            config={'mapper_cache_dir': 'test_dir'},
+            initial_config_file='test/test.json',
+            **kwargs
+        )
+
+
+class TestMapperMixin(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        self.server, base_url = start_fake_server(
+            FakeMapperHandler, requests=[], serve_mapfile=True,
+            lock=threading.Lock(), connections=set(), posts=[], inserted=[],
+            max_post_lines=1000, bad_line=None)
+        self.mapper_url = base_url + '/{project}/{vcs}/{rev}'
+        self.mapfile_url = base_url + '/{project}/mapfile'
+        self.insert_url = base_url + '/gecko/insert/ignoredups'
+        self.s = MapperScript()
+
+    def tearDown(self):
+        stop_fake_server(self.server)
+        del(self.s)
+        cleanup()
+
+    def test_query_mapper(self):
+        rev = self.s.query_mapper(self.mapper_url, 'gecko', 'git', 'a' * 40,
+                                  attempts=1, sleeptime=0)
+        self.assertEqual(rev, '1' * 40)
+
+    def test_query_mapper_is_cached(self):
+        for _ in range(3):
+            self.s.query_mapper_hg_revision(self.mapper_url, 'gecko', '2' * 40,
+                                            attempts=1, sleeptime=0)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_cache_persists(self):
+        self.s.query_mapper(self.mapper_url, 'gecko', 'git', 'b' * 40,
+                            attempts=1, sleeptime=0)
+        self.assertEqual(open(self.s.query_mapper_cache_file(self.mapper_url, 'gecko')).read(),
+                         '%s %s\n' % MAPPINGS[1])
+        del(self.s)
+        self.s = MapperScript()
+        rev = self.s.query_mapper(self.mapper_url, 'gecko', 'hg', '2' * 40,
+                                  attempts=1, sleeptime=0)
+        self.assertEqual(rev, 'b' * 40)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_no_answer_not_cached(self):
+        rev = self.s.query_mapper(self.mapper_url, 'gecko', 'git', 'd' * 40,
+                                  require_answer=False, attempts=1, sleeptime=0)
+        self.assertEqual(rev, None)
+        self.assertFalse(os.path.exists(self.s.query_mapper_cache_file(self.mapper_url, 'gecko')))
+
+    def test_cache_per_mapper_url(self):
+        self.s.query_mapper(self.mapper_url, 'gecko', 'git', 'a' * 40,
+                            attempts=1, sleeptime=0)
+        other_url = self.mapper_url.replace('127.0.0.1', 'localhost')
+        self.assertNotEqual(self.s.query_mapper_cache_file(self.mapper_url, 'gecko'),
+                            self.s.query_mapper_cache_file(other_url, 'gecko'))
+        self.s.query_mapper(other_url, 'gecko', 'git', 'a' * 40,
+                            attempts=1, sleeptime=0)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_query_mapper_error_level(self):
+        rev = self.s.query_mapper(self.mapper_url, 'gecko', 'git', 'd' * 40,
+                                  attempts=1, sleeptime=0, error_level=ERROR)
+        self.assertEqual(rev, None)
+
+    def test_revisions_from_mapfile(self):
+        revs = [hg_rev for hg_rev, _ in MAPPINGS]
+        results = self.s.query_mapper_revisions(self.mapper_url, 'gecko', 'git', revs,
+                                                mapfile_url=self.mapfile_url)
+        self.assertEqual(results, dict(MAPPINGS))
+        self.assertEqual(self.server.requests, ['/gecko/mapfile'])
+
+    def test_revisions_fall_back_to_single_lookups(self):
+        self.server.serve_mapfile = False
+        revs = [git_rev for _, git_rev in MAPPINGS]
+        results = self.s.query_mapper_revisions(self.mapper_url, 'gecko', 'hg', revs,
+                                                mapfile_url=self.mapfile_url,
+                                                attempts=1, sleeptime=0)
+        self.assertEqual(results, dict((g, h) for h, g in MAPPINGS))
+        self.assertEqual(len(self.server.requests), len(revs) + 1)
+
+    def test_revisions_fatal_on_unknown(self):
+        levels = []
+        log = self.s.log
+
+        def _log(message, level=INFO, exit_code=-1):
+            levels.append(level)
+            return log(message, level=level, exit_code=exit_code)
+        self.s.log = _log
+        self.assertRaises(SystemExit, self.s.query_mapper_revisions,
+                          self.mapper_url, 'gecko', 'git',
+                          ['a' * 40, 'd' * 40, 'e' * 40],
+                          attempts=1, sleeptime=0)
+        # One fatal, from the main thread, for all the unknown revisions
+        self.assertEqual(levels.count(FATAL), 1)
+
+    def _publish_lines(self, count):
+        return ['%040x %040x\n' % (i, i * 7) for i in range(count)]
+
+    def test_publish_mappings(self):
+        lines = self._publish_lines(2000)
+        published = self.s.publish_mappings(self.insert_url, lines,
+                                            num_threads=3, chunk_size=50,
+                                            sleeptime=0)
+        self.assertEqual(published, [(0, 2000)])
+        self.assertEqual(sorted(self.server.inserted), lines)
+        # Connections are kept open between chunks...
+        self.assertTrue(len(self.server.connections) <= 3)
+        # ...and quick posts get bigger.
+        self.assertTrue(max(self.server.posts) > 50)
+
+    def test_publish_mappings_shrinks_chunks(self):
+        self.server.max_post_lines = 60
+        lines = self._publish_lines(500)
+        published = self.s.publish_mappings(self.insert_url, lines,
+                                            num_threads=2, chunk_size=200,
+                                            sleeptime=0)
+        self.assertEqual(published, [(0, 500)])
+        self.assertEqual(sorted(self.server.inserted), lines)
+
+    def test_publish_mappings_partial(self):
+        lines = self._publish_lines(500)
+        self.server.bad_line = lines[321]
+        published = self.s.publish_mappings(self.insert_url, lines,
+                                            num_threads=2, chunk_size=100,
+                                            min_chunk_size=10, attempts=3,
+                                            sleeptime=0)
+        self.assertEqual(len(published), 2)
+        self.assertEqual(published[0][0], 0)
+        self.assertEqual(published[1][1], 500)
+        self.assertTrue(published[0][1] <= 321 < published[1][0])
+        self.assertTrue(published[1][0] - published[0][1] <= 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
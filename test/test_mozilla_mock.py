@@ -0,0 +1,79 @@
+import gc
+import os
+import unittest
+
+import mozharness.base.log as log
+from mozharness.base.log import ERROR
+import mozharness.base.script as script
+from mozharness.mozilla.mock import MockMixin
+
+
+class CleanupObj(script.ScriptMixin, log.LogMixin):
+    def __init__(self):
+        super(CleanupObj, self).__init__()
+        self.log_obj = None
+        self.config = {'log_level': ERROR}
+
+
+def cleanup():
+    gc.collect()
+    c = CleanupObj()
+    for f in ('test_logs', 'test_dir'):
+        c.rmtree(f)
+
+
+class MockScript(MockMixin, script.BaseScript):
+    pass
+
+
+class TestRunConcurrentCommands(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        self.s = MockScript(config={'log_level': ERROR},
+                            initial_config_file='test/test.json')
+
+    def tearDown(self):
+        del self.s
+        cleanup()
+
+    def test_run_concurrent_commands_m(self):
+        work_dir = os.path.abspath('test_dir/jobs')
+        self.s.mkdir_p('test_dir/src')
+        jobs = []
+        for name in ('de', 'fr', 'it'):
+            jobs.append({'name': name, 'commands': [
+                {'command': 'echo "$LOCALE" > %s.txt' % name,
+                 'cwd': os.path.abspath('test_dir/src'),
+                 'env': {'LOCALE': name}},
+                {'command': ['test', name, '!=', 'fr']},
+                {'command': ['cat', '%s.txt' % name],
+                 'cwd': os.path.abspath('test_dir/src')},
+            ]})
+        results = self.s.run_concurrent_commands_m(jobs, work_dir, num_jobs=2)
+        self.assertEqual(sorted(results), ['de', 'fr', 'it'])
+        self.assertEqual(results['de']['failed'], None)
+        self.assertEqual(results['de']['status'], 0)
+        self.assertEqual(len(results['de']['logs']), 3)
+        self.assertEqual(self.s.read_from_file(results['it']['logs'][2], verbose=False),
+                         'it\n')
+        self.assertEqual(results['fr']['failed'], 1)
+        self.assertEqual(results['fr']['status'], 1)
+        self.assertEqual(len(results['fr']['logs']), 2)
+
+    def test_run_concurrent_commands_m_unfinished(self):
+        work_dir = os.path.abspath('test_dir/jobs')
+        # The second command kills the job's shell before it can record
+        # a status.
+        jobs = [{'name': 'killed', 'commands': [
+            {'command': 'echo started'},
+            {'command': 'kill -9 $$'},
+            {'command': 'echo never'},
+        ]}]
+        results = self.s.run_concurrent_commands_m(jobs, work_dir)
+        self.assertEqual(results['killed']['failed'], None)
+        self.assertEqual(results['killed']['status'], None)
+        self.assertEqual(len(results['killed']['logs']), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
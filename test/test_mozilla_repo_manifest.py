@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mozharness.mozilla import repo_manifest
+
+MANIFEST_DIR = os.path.join(os.path.dirname(__file__), 'helper_files',
+                            'repo_manifests')
+
+
+class TestRepoManifest(unittest.TestCase):
+    def setUp(self):
+        self.manifest = repo_manifest.load_manifest(
+            os.path.join(MANIFEST_DIR, 'dev.xml'))
+
+    def test_include_and_remove_project(self):
+        names = [p.getAttribute('name') for p in
+                 self.manifest.getElementsByTagName('project')]
+        self.assertEqual(names, ['platform_build', 'dropme', 'gaia', 'device/x'])
+        self.assertEqual(self.manifest.getElementsByTagName('remove-project'), [])
+        self.assertEqual(repo_manifest.get_project(self.manifest, name='gaia').getAttribute('remote'),
+                         'caf')
+
+    def test_comments_kept(self):
+        xml = self.manifest.toxml()
+        self.assertTrue('<!-- top comment -->' in xml)
+        self.assertTrue('<!-- Gonk specific things and forks -->' in xml)
+
+    def test_unsupported_tag(self):
+        tmpdir = tempfile.mkdtemp()
+        bad = os.path.join(tmpdir, 'bad.xml')
+        with open(bad, 'w') as f:
+            f.write('<manifest><notes/></manifest>')
+        try:
+            self.assertRaises(ValueError, repo_manifest.load_manifest, bad)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_included_files_are_cached(self):
+        base = os.path.abspath(os.path.join(MANIFEST_DIR, 'base.xml'))
+        cached = repo_manifest._parsed_manifests[base]
+        other = repo_manifest.load_manifest(os.path.join(MANIFEST_DIR, 'dev.xml'))
+        self.assertTrue(repo_manifest._parsed_manifests[base] is cached)
+        # Each load still gets its own nodes
+        repo_manifest.remove_project(other, name='dropme')
+        self.assertNotEqual(repo_manifest.get_project(self.manifest, name='dropme'), None)
+
+    def test_get_project(self):
+        build = repo_manifest.get_project(self.manifest, path='build')
+        self.assertEqual(build.getAttribute('name'), 'platform_build')
+        self.assertEqual(repo_manifest.get_project(self.manifest, name='nope'), None)
+        # With both, the first match in the manifest wins
+        self.assertEqual(repo_manifest.get_project(self.manifest, name='gaia', path='build'),
+                         build)
+
+    def test_project_defaults(self):
+        p = repo_manifest.get_project(self.manifest, name='device/x')
+        self.assertEqual(repo_manifest.get_project_remote_url(self.manifest, p),
+                         'git://codeaurora.org/device/x')
+        self.assertEqual(repo_manifest.get_project_revision(self.manifest, p),
+                         'refs/tags/android-4.0.4_r2.1')
+
+    def test_remove_and_add_project(self):
+        removed = repo_manifest.remove_project(self.manifest, path='gaia')
+        self.assertEqual(removed.getAttribute('name'), 'gaia')
+        self.assertEqual(repo_manifest.get_project(self.manifest, path='gaia'), None)
+        repo_manifest.add_project(self.manifest, name='gaia', path='gaia', remote='b2g')
+        self.assertEqual(repo_manifest.get_project(self.manifest, path='gaia').getAttribute('remote'),
+                         'b2g')
+
+    def test_remove_group(self):
+        removed = repo_manifest.remove_group(self.manifest, 'darwin')
+        self.assertEqual([p.getAttribute('name') for p in removed], ['dropme'])
+        self.assertEqual(repo_manifest.get_project(self.manifest, name='dropme'), None)
+
+    def test_rewrite_remotes(self):
+        mappings = {'https://git.mozilla.org/b2g': 'https://example.com/b2g'}
+        repo_manifest.rewrite_remotes(
+            self.manifest, lambda r: repo_manifest.map_remote(r, mappings),
+            force_all=False)
+        self.assertEqual(repo_manifest.get_remote(self.manifest, 'b2g').getAttribute('fetch'),
+                         'https://example.com/b2g')
+
+
+if __name__ == '__main__':
+    unittest.main()